@@ -0,0 +1,32 @@
+#!/bin/bash
+
+# 比較 jq 腳本 (1-covert-json-to-csv.sh) 與 Python 串流轉換的執行時間
+# 兩者使用相同的區域過濾條件，並確認輸出內容一致
+INPUT_FILE="ServiceTags_Public.json"
+PY_TOOL="../azure-service-tag-ip-query/azure_service_tag_ip_query.py"
+PY_OUTPUT="ServiceTags_Public.py.csv"
+
+# 檢查輸入檔案是否存在
+if [ ! -f "${INPUT_FILE}" ]; then
+  echo "錯誤: 找不到 ${INPUT_FILE}，請先執行 0-download.sh。"
+  exit 1
+fi
+
+echo "== jq =="
+time bash ./1-covert-json-to-csv.sh > /dev/null
+
+echo "== Python =="
+time python3 "${PY_TOOL}" \
+  --input "${INPUT_FILE}" \
+  --convert "${PY_OUTPUT}" \
+  --region japaneast japanwest westus3 taiwannorth
+
+# jq 的 @csv 會為每個欄位加上引號，比較前先移除
+if diff \
+  <(tail -n +2 ServiceTags_Public.csv | tr -d '"' | sort) \
+  <(tail -n +2 "${PY_OUTPUT}" | sort) > /dev/null; then
+  echo "輸出內容一致"
+else
+  echo "輸出內容不一致，請檢查 ${PY_OUTPUT}"
+  exit 1
+fi
@@ -1,78 +1,1208 @@
+#!/usr/bin/env python3
 """
 Query Azure Service Tag Public IP List
+
+Usable as a command line tool or imported as a module, e.g.
+
+    import azure_service_tag_ip_query as st
+    st.get_prefixes('AzureFrontDoor.Frontend', 'japaneast')
+    st.lookup('20.43.64.10')
+
+The Azure SDK and numpy are only imported when they are needed, so cached and
+offline queries do not pay for their import time.
 """
-#!/usr/bin/env python3
 
 import sys
+import os
+import time
 import argparse
 import json
 import csv
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.network import NetworkManagementClient
+import gc
+import bisect
+import ipaddress
+import itertools
+import socket
+import threading
+import re
+import fnmatch
+import mmap
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 # Default values
 SERVICE_TAG="AzureCloud.taiwannorth"
 SUBSCRIPTION_ID="587f8045-973f-43b7-965c-d368921946a2"
 LOCATION="japaneast"
+CACHE_DIR=os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'azure-service-tag-ip-query')
+CACHE_TTL=86400
+FETCH_WORKERS=8
+CONVERT_COLUMNS=['ServiceTag', 'IPPrefix', 'Region', 'SystemService']
+PARQUET_BATCH_SIZE=100000
+INDEX_MAGIC=b'STIX'
+INDEX_VERSION=1
+INDEX_HEADER=struct.Struct('=4sI7Q')
+ENRICH_BATCH_SIZE=65536
+ENRICH_MEMO_SIZE=1000000
+
+NETWORK_CLIENTS = {}
+NETWORK_CLIENT_LOCK = threading.Lock()
+NUMPY = []
+IP_INDEXES = {}
+
+def get_network_client(subscription_id):
+    """Return the NetworkManagementClient of a subscription, created on first use.
+
+    The Azure SDK is imported here rather than at module import, the client is shared
+    by all threads fetching for that subscription.
+    """
+    with NETWORK_CLIENT_LOCK:
+        if subscription_id not in NETWORK_CLIENTS:
+            from azure.identity import DefaultAzureCredential # pylint: disable=import-outside-toplevel
+            from azure.mgmt.network import NetworkManagementClient # pylint: disable=import-outside-toplevel
+            NETWORK_CLIENTS[subscription_id] = NetworkManagementClient(DefaultAzureCredential(), subscription_id)
+        return NETWORK_CLIENTS[subscription_id]
+
+def load_numpy():
+    """Return the numpy module, or None if it is not installed. Imported on first use."""
+    if not NUMPY:
+        try:
+            import numpy # pylint: disable=import-outside-toplevel
+        except ImportError:
+            numpy = None
+        NUMPY.append(numpy)
+    return NUMPY[0]
 
-parser = argparse.ArgumentParser(description="Query Azure Service Tag Public IP List")
-parser.add_argument('--output', choices=['csv', 'json'], default='csv', help='Format: csv or json (default is csv)') # pylint: disable=line-too-long
-parser.add_argument('--service-tag', default=SERVICE_TAG, help='Service Tag Name (default: AzureFrontDoor.Frontend)') # pylint: disable=line-too-long
-parser.add_argument('--location', default=LOCATION, help='Azure region (default: japaneast)')
-parser.add_argument('--subscription-id', default=SUBSCRIPTION_ID, help='Azure Subscription ID')
-parser.add_argument('--list-tags', action='store_true', help='List all of Service Tag Name')
-args = parser.parse_args()
+def service_tags_to_dict(tag_info):
+    """Convert a ServiceTagsListResult into the ServiceTags_Public.json layout."""
+    return {
+        "changeNumber": tag_info.change_number,
+        "cloud": tag_info.cloud,
+        "values": [
+            {
+                "name": tag.name,
+                "id": tag.id,
+                "properties": {
+                    "changeNumber": tag.properties.change_number,
+                    "region": tag.properties.region,
+                    "systemService": tag.properties.system_service,
+                    "addressPrefixes": list(tag.properties.address_prefixes or []),
+                },
+            }
+            for tag in tag_info.values
+        ],
+    }
 
-if args.list_tags:
+def cache_path(cache_dir, subscription_id, location):
+    """Return the cache file of a (subscription, location) pair."""
+    return os.path.join(cache_dir, f"servicetags-{subscription_id}-{location.lower()}.json")
+
+def read_cache(path):
+    """Return the cache entry stored at path, or None if there is none."""
     try:
-        network_client = NetworkManagementClient(DefaultAzureCredential(), args.subscription_id)
-        tag_info = network_client.service_tags.list(args.location)
-        print("All Service Tag Names in the region:")
-        for tag in tag_info.values:
-            print(tag.name)
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cache(path, subscription_id, location, document):
+    """Atomically store a service tag document in the cache."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {
+        "subscriptionId": subscription_id,
+        "location": location,
+        "fetchedAt": time.time(),
+        "document": document,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    return entry
+
+def tag_change_numbers(network_client, location):
+    """Return {tag name: changeNumber} without downloading any address prefixes."""
+    return {
+        tag.name: tag.properties.change_number
+        for tag in network_client.service_tag_information.list(location, no_address_prefixes=True)
+    }
+
+def is_cache_current(network_client, location, document):
+    """Check whether Azure still publishes the change numbers recorded in document."""
+    try:
+        live = tag_change_numbers(network_client, location)
+    except Exception: # pylint: disable=broad-except
+        # Older API versions do not offer the prefix-less listing, fall back to a full fetch
+        return False
+    cached = {tag['name']: tag['properties'].get('changeNumber') for tag in document['values']}
+    return live == cached
+
+def get_service_tags(client_factory, subscription_id, location, cache_dir=CACHE_DIR, ttl=CACHE_TTL, offline=False, refresh=False):
+    """Return the service tag document of a location, served from the cache when possible.
+
+    A cache entry younger than ttl seconds is used as is. An older entry is revalidated
+    against the per-tag change numbers and only re-downloaded when Azure published a new
+    version. In offline mode the cache is used regardless of its age. client_factory is
+    only called when Azure has to be contacted.
+    """
+    path = cache_path(cache_dir, subscription_id, location)
+    entry = None if refresh else read_cache(path)
+
+    if offline:
+        if entry is None:
+            raise RuntimeError(f"No cached service tags for subscription {subscription_id} in {location}")
+        return entry['document']
+
+    if entry is not None:
+        if time.time() - entry['fetchedAt'] < ttl:
+            return entry['document']
+        if is_cache_current(client_factory(), location, entry['document']):
+            return write_cache(path, subscription_id, location, entry['document'])['document']
+
+    document = service_tags_to_dict(client_factory().service_tags.list(location))
+    write_cache(path, subscription_id, location, document)
+    return document
+
+def get_service_tags_by_location(client_factory, subscription_id, locations, workers=FETCH_WORKERS, **kwargs):
+    """Fetch the service tag documents of several locations concurrently.
+
+    Every location is fetched once through get_service_tags in a bounded thread pool,
+    the client returned by client_factory is shared by all threads.
+
+    Returns:
+        dict: {location: service tag document}
+    """
+    locations = list(dict.fromkeys(locations))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(locations)))) as executor:
+        futures = {
+            location: executor.submit(get_service_tags, client_factory, subscription_id, location, **kwargs)
+            for location in locations
+        }
+        return {location: future.result() for location, future in futures.items()}
+
+def prefix_range(prefix):
+    """Return (IP version, first address, last address) of a prefix as integers."""
+    address, _, length = prefix.partition('/')
+    version, value = ip_to_int(address)
+    host_bits = (32 if version == 4 else 128) - int(length) if length else 0
+    first = value >> host_bits << host_bits
+    return version, first, first | ((1 << host_bits) - 1)
+
+def build_ip_index(tags_iter):
+    """Build a reverse lookup index from every tag's address prefixes.
+
+    The prefixes of all tags are cut into disjoint, sorted address segments and each
+    segment records the set of tags covering it, so overlapping tags such as AzureCloud
+    and AzureCloud.<region> are all returned by a single binary search.
+
+    Args:
+        tags_iter (iterable): Tags in the ServiceTags_Public.json layout, e.g. document['values'].
+
+    Returns:
+        dict: {'tags': [(name, region, systemService)], 'tagsets': [tuple of tag ids],
+               4: (starts, ends, tagset ids), 6: (starts, ends, tagset ids)}
+    """
+    tags = []
+    events = {4: [], 6: []}
+    for tag in tags_iter:
+        properties = tag['properties']
+        tag_id = len(tags)
+        tags.append((tag['name'], properties.get('region') or '', properties.get('systemService') or ''))
+        for prefix in properties.get('addressPrefixes') or []:
+            version, first, last = prefix_range(prefix)
+            events[version].append((first, 1, tag_id))
+            events[version].append((last + 1, -1, tag_id))
+
+    tagsets = []
+    tagset_ids = {}
+    index = {'tags': tags, 'tagsets': tagsets}
+    for version, version_events in events.items():
+        version_events.sort()
+        starts, ends, set_ids = [], [], []
+        active = {}
+        i = 0
+        while i < len(version_events):
+            boundary = version_events[i][0]
+            while i < len(version_events) and version_events[i][0] == boundary:
+                _, delta, tag_id = version_events[i]
+                active[tag_id] = active.get(tag_id, 0) + delta
+                if not active[tag_id]:
+                    del active[tag_id]
+                i += 1
+            if not active:
+                continue
+            key = tuple(sorted(active))
+            set_id = tagset_ids.get(key)
+            if set_id is None:
+                set_id = tagset_ids[key] = len(tagsets)
+                tagsets.append(key)
+            end = version_events[i][0] - 1
+            if set_ids and set_ids[-1] == set_id and ends[-1] + 1 == boundary:
+                ends[-1] = end
+            else:
+                starts.append(boundary)
+                ends.append(end)
+                set_ids.append(set_id)
+        index[version] = (starts, ends, set_ids)
+    return index
+
+class BigEndianInts:
+    """Read-only sequence over a buffer of fixed-width big-endian integers.
+
+    Lets bisect run directly on the IPv6 ranges of a memory-mapped index.
+    """
+    def __init__(self, buffer, width):
+        self.buffer = buffer
+        self.width = width
+
+    def __len__(self):
+        return len(self.buffer) // self.width
+
+    def __getitem__(self, i):
+        return int.from_bytes(self.buffer[i * self.width:(i + 1) * self.width], 'big')
+
+def write_ip_index(index, path):
+    """Write an index made by build_ip_index to a binary file for open_ip_index.
+
+    Layout after the header, every section padded to 8 bytes: string table offsets and
+    UTF-8 blob, (name, region, systemService) string ids per tag, tagset offsets and
+    tag ids, then the IPv4 starts, ends and tagset ids as uint32 arrays and the IPv6
+    starts and ends as 16-byte big-endian integers followed by their tagset ids.
+    Arrays use the native byte order of the machine building the index.
+    """
+    strings = {}
+    for tag in index['tags']:
+        for value in tag:
+            strings.setdefault(value, len(strings))
+    encoded = [value.encode('utf-8') for value in strings]
+    string_offsets = array('I', [0])
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+    tag_strings = array('I', [strings[value] for tag in index['tags'] for value in tag])
+    tagset_offsets = array('I', [0])
+    for ids in index['tagsets']:
+        tagset_offsets.append(tagset_offsets[-1] + len(ids))
+    tagset_items = array('I', [tag_id for ids in index['tagsets'] for tag_id in ids])
+    starts4, ends4, sets4 = index[4]
+    starts6, ends6, sets6 = index[6]
+
+    sections = [
+        string_offsets.tobytes(), b''.join(encoded), tag_strings.tobytes(),
+        tagset_offsets.tobytes(), tagset_items.tobytes(),
+        array('I', starts4).tobytes(), array('I', ends4).tobytes(), array('I', sets4).tobytes(),
+        b''.join(value.to_bytes(16, 'big') for value in starts6),
+        b''.join(value.to_bytes(16, 'big') for value in ends6),
+        array('I', sets6).tobytes(),
+    ]
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(strings), string_offsets[-1], len(index['tags']),
+                               len(index['tagsets']), len(tagset_items), len(starts4), len(starts6))
+    with open(path, 'wb') as f:
+        f.write(header)
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * (-len(section) % 8))
+
+def open_ip_index(path):
+    """Open an index written by write_ip_index, usable with lookup_ip and enrich_stream.
+
+    The file is memory-mapped and the address ranges are searched in place, only the
+    small tag and tagset tables are decoded up front.
+    """
+    with open(path, 'rb') as f:
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, n_strings, blob_size, n_tags, n_tagsets, n_items, n4, n6 = INDEX_HEADER.unpack_from(buffer)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise ValueError(f"{path} is not a service tag index of this version or byte order, please rebuild it")
+
+    offset = INDEX_HEADER.size
+    def section(size, item_format=None):
+        nonlocal offset
+        view = buffer[offset:offset + size]
+        offset += size + (-size % 8)
+        return view.cast(item_format) if item_format else view
+
+    string_offsets = section(4 * (n_strings + 1), 'I')
+    blob = section(blob_size)
+    strings = [bytes(blob[string_offsets[i]:string_offsets[i + 1]]).decode('utf-8') for i in range(n_strings)]
+    tag_strings = section(4 * 3 * n_tags, 'I')
+    tags = [tuple(strings[tag_strings[3 * i + k]] for k in range(3)) for i in range(n_tags)]
+    tagset_offsets = section(4 * (n_tagsets + 1), 'I')
+    tagset_items = section(4 * n_items, 'I')
+    tagsets = [tuple(tagset_items[tagset_offsets[i]:tagset_offsets[i + 1]]) for i in range(n_tagsets)]
+    return {
+        'tags': tags,
+        'tagsets': tagsets,
+        4: (section(4 * n4, 'I'), section(4 * n4, 'I'), section(4 * n4, 'I')),
+        6: (BigEndianInts(section(16 * n6), 16), BigEndianInts(section(16 * n6), 16), section(4 * n6, 'I')),
+    }
+
+def lookup_ip(index, ip):
+    """Return the (name, region, systemService) of every tag containing ip."""
+    version, value = ip_to_int(ip.strip())
+    starts, ends, set_ids = index[version]
+    i = bisect.bisect_right(starts, value) - 1
+    if i < 0 or value > ends[i]:
+        return []
+    return [index['tags'][tag_id] for tag_id in index['tagsets'][set_ids[i]]]
+
+def ip_to_int(ip):
+    """Return (IP version, integer value) of an address."""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+    except OSError:
+        raise ValueError(f"{ip!r} does not appear to be an IPv4 or IPv6 address") from None
+
+def index_labels(index):
+    """Return the ';'-joined tag names of each tagset of an index, computed once per index."""
+    if 'labels' not in index:
+        index['labels'] = [';'.join(index['tags'][tag_id][0] for tag_id in ids) for ids in index['tagsets']]
+    return index['labels']
+
+def match_ipv4(np, index, values):
+    """Return the tagset id of each IPv4 address of a uint32 array, -1 where no tag matches.
+
+    All addresses are matched in one searchsorted call over the IPv4 ranges of the index.
+    """
+    if 'np4' not in index:
+        starts, ends, set_ids = index[4]
+        index['np4'] = (np.array(starts, dtype=np.uint32), np.array(ends, dtype=np.uint32), np.array(set_ids, dtype=np.int64))
+    starts, ends, set_ids = index['np4']
+    if not len(starts):
+        return np.full(len(values), -1, dtype=np.int64)
+    positions = np.searchsorted(starts, values, side='right') - 1
+    clipped = np.maximum(positions, 0)
+    return np.where((positions >= 0) & (values <= ends[clipped]), set_ids[clipped], -1)
+
+def parse_ipv4_bytes(np, raw):
+    """Parse dotted-quad IPv4 addresses from a (16, n) uint8 array, one NUL-padded address per column.
+
+    Returns:
+        tuple: (uint32 addresses, bool array). The flag is False for anything but a plain
+               dotted quad without leading zeros, e.g. IPv6, blanks or padded values, which
+               are left to ip_to_int.
+    """
+    count = raw.shape[1]
+    value = np.zeros(count, dtype=np.uint32)
+    octet = np.zeros(count, dtype=np.uint16)
+    digits = np.zeros(count, dtype=np.uint8)
+    dots = np.zeros(count, dtype=np.uint8)
+    ended = np.zeros(count, dtype=bool)
+    ok = raw[15] == 0
+    for char in raw:
+        digit = char - np.uint8(48)
+        is_digit = digit < 10
+        is_end = char == 0
+        is_separator = (char == 46) | (is_end & ~ended)
+        ok &= (is_digit | is_separator | ended) & ~(ended & ~is_end)
+        ok &= ~(is_digit & (digits == 1) & (octet == 0))
+        octet = octet * np.where(is_digit, 10, 1).astype(np.uint16) + digit * is_digit
+        digits += is_digit
+        ok &= ~is_separator | ((digits - np.uint8(1) < 3) & (octet <= 255))
+        value = np.where(is_separator, (value << np.uint32(8)) | octet, value)
+        octet *= ~is_separator
+        digits *= ~is_separator
+        dots += char == 46
+        ended |= is_end
+    return value, ok & (dots == 3)
+
+def enrich_ips(index, ips, memo):
+    """Resolve a batch of IP strings to Service Tag labels, filling memo in place.
+
+    Flow logs repeat the same addresses over and over, so only IPs missing from memo
+    are resolved. The IPv4 ones are matched in one vectorized searchsorted call when
+    numpy is available, everything else falls back to a bisect per address.
+    """
+    if len(memo) > ENRICH_MEMO_SIZE:
+        memo.clear()
+    labels = index_labels(index)
+
+    np = load_numpy()
+    pending_v4, pending_v4_values = [], []
+    for ip in set(ips).difference(memo):
+        try:
+            version, value = ip_to_int(ip.strip())
+        except ValueError:
+            memo[ip] = ''
+            continue
+        if version == 4 and np is not None:
+            pending_v4.append(ip)
+            pending_v4_values.append(value)
+            continue
+        starts, ends, set_ids = index[version]
+        i = bisect.bisect_right(starts, value) - 1
+        memo[ip] = labels[set_ids[i]] if i >= 0 and value <= ends[i] else ''
+
+    if pending_v4:
+        set_ids = match_ipv4(np, index, np.array(pending_v4_values, dtype=np.uint32))
+        for ip, set_id in zip(pending_v4, set_ids.tolist()):
+            memo[ip] = labels[set_id] if set_id >= 0 else ''
+
+def label_columns(index, columns, memo):
+    """Return the Service Tag labels of each column of IP strings, a list per column.
+
+    Every cell costs a single memo.get, only the addresses missing from memo are
+    collected and passed to enrich_ips, so batches of already seen addresses are not
+    hashed into a set again.
+    """
+    if len(memo) > ENRICH_MEMO_SIZE:
+        memo.clear()
+    labels = [list(map(memo.get, column)) for column in columns]
+    missing = [k for k, column_labels in enumerate(labels) if None in column_labels]
+    if missing:
+        enrich_ips(index, [ip for k in missing for ip, label in zip(columns[k], labels[k]) if label is None], memo)
+        for k in missing:
+            labels[k] = [memo[ip] if label is None else label for ip, label in zip(columns[k], labels[k])]
+    return labels
+
+def enrich_csv_batch(np, index, text, positions, width, memo):
+    """Label the IP columns of a batch of plain CSV lines as whole arrays, see enrich_csv.
+
+    The commas and newlines of the batch are located in one pass over its bytes, the
+    first 16 bytes of each IP field are copied out of a sliding window over the batch,
+    then parsed and matched with match_ipv4 as whole arrays, so the Python work per row
+    is limited to writing it out. Cells that are not plain IPv4 addresses go through
+    label_columns.
+
+    Args:
+        np (module): The numpy module.
+        index (dict): The reverse lookup index.
+        text (str): The lines of the batch, each ending with a newline, without quotes or carriage returns.
+        positions (list): The positions of the IP columns.
+        width (int): The number of columns of the header.
+        memo (dict): The labels of the addresses seen so far.
+
+    Returns:
+        list: The labels of each IP column, or None if a row does not have exactly width
+              fields and the batch has to take the per-line path.
+    """
+    # 16 NUL bytes of padding keep the window of the last field inside the buffer
+    buffer = np.frombuffer(text.encode('utf-8') + bytes(16), dtype=np.uint8)
+    newlines = np.flatnonzero(buffer == 10)
+    commas = np.flatnonzero(buffer == 44)
+    count = len(newlines)
+    if len(commas) != count * (width - 1):
+        return None
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    commas = commas.reshape(count, width - 1)
+    # The commas of row k all lie within line k, so every row has exactly width fields
+    if width > 1 and not ((commas[:, 0] >= line_starts).all() and (commas[:, -1] < newlines).all()):
+        return None
+
+    labels = index_labels(index)
+    label_table = np.array(labels + ['', None], dtype=object)
+    windows = np.lib.stride_tricks.sliding_window_view(buffer, 16)
+    offsets = np.arange(16, dtype=np.uint8)
+    result = []
+    for position in positions:
+        field_starts = line_starts if position == 0 else commas[:, position - 1] + 1
+        field_ends = newlines if position == width - 1 else commas[:, position]
+        lengths = field_ends - field_starts
+        raw = np.ascontiguousarray((windows[field_starts] * (offsets < lengths[:, None])).T)
+        values, ok = parse_ipv4_bytes(np, raw)
+        # NUL bytes inside a field would pass for the padding
+        ok &= (lengths <= 15) & (np.count_nonzero(raw, axis=0) == lengths)
+        set_ids = match_ipv4(np, index, values)
+        set_ids = np.where(ok, np.where(set_ids >= 0, set_ids, len(labels)), len(labels) + 1)
+        column_labels = label_table[set_ids].tolist()
+
+        if None in column_labels:
+            rows = [k for k, label in enumerate(column_labels) if label is None]
+            cells = [bytes(buffer[field_starts[k]:field_ends[k]]).decode('utf-8') for k in rows]
+            for k, label in zip(rows, label_columns(index, [cells], memo)[0]):
+                column_labels[k] = label
+        result.append(column_labels)
+    return result
+
+def enrich_jsonl(index, infile, outfile, ip_columns, batch_size, memo):
+    """Enrich a JSONL stream, see enrich_stream."""
+    tag_columns = [f"{column}_ServiceTag" for column in ip_columns]
+    while True:
+        rows = [json.loads(line) for line in itertools.islice(infile, batch_size) if line.strip()]
+        if not rows:
+            break
+        columns = [[str(row.get(column) or '') for row in rows] for column in ip_columns]
+        for tag_column, column_labels in zip(tag_columns, label_columns(index, columns, memo)):
+            for row, label in zip(rows, column_labels):
+                row[tag_column] = label
+        outfile.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+
+def enrich_csv(index, infile, outfile, ip_columns, batch_size, memo):
+    """Enrich a CSV stream, see enrich_stream.
+
+    Rows are written back as the original line plus the new columns. With numpy, a batch
+    without quotes or carriage returns whose rows all have the header's width is labelled
+    as a whole by enrich_csv_batch. Other batches are split with str.split, only lines
+    holding quotes go through the csv module. Quoted fields spanning several lines are
+    not supported.
+    """
+    header_line = infile.readline().rstrip('\r\n')
+    if not header_line:
+        return
+    header = next(csv.reader([header_line]))
+    missing = [column for column in ip_columns if column not in header]
+    if missing:
+        raise ValueError(f"Columns not found in CSV header: {', '.join(missing)}")
+    positions = [header.index(column) for column in ip_columns]
+    width = len(header)
+    outfile.write(f"{header_line},{','.join(f'{column}_ServiceTag' for column in ip_columns)}\n")
+    np = load_numpy()
+    while True:
+        text = ''.join(itertools.islice(infile, batch_size))
+        if not text:
+            break
+        if not text.endswith('\n'):
+            text += '\n'
+        if np is not None and '"' not in text and '\r' not in text:
+            labels = enrich_csv_batch(np, index, text, positions, width, memo)
+            if labels is not None:
+                outfile.write('\n'.join(map(','.join, zip(text[:-1].split('\n'), *labels))) + '\n')
+                continue
+        lines = [line.rstrip('\r') for line in text[:-1].split('\n')]
+        if any('"' in line for line in lines):
+            rows = [next(csv.reader([line])) if '"' in line else line.split(',') for line in lines]
+        else:
+            rows = [line.split(',') for line in lines]
+        # Pad short rows so the new columns stay aligned with the header
+        if min(map(len, rows)) < width:
+            for k in [k for k, count in enumerate(map(len, rows)) if count < width]:
+                lines[k] += ',' * (width - len(rows[k]))
+                rows[k] += [''] * (width - len(rows[k]))
+        columns = [[row[i] for row in rows] for i in positions]
+        outfile.write('\n'.join(map(','.join, zip(lines, *label_columns(index, columns, memo)))) + '\n')
+
+def enrich_stream(index, infile, outfile, ip_columns, file_format='csv', batch_size=ENRICH_BATCH_SIZE):
+    """Add a <column>_ServiceTag field for each IP column of a CSV or JSONL stream.
+
+    Rows are processed in batches of batch_size, so memory use does not depend on the
+    size of the input. The batches hold no reference cycles, so the garbage collector
+    is paused instead of rescanning millions of short-lived row lists.
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if file_format == 'jsonl':
+            enrich_jsonl(index, infile, outfile, ip_columns, batch_size, {})
+        else:
+            enrich_csv(index, infile, outfile, ip_columns, batch_size, {})
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def find_tag_prefixes(document, name):
+    """Return the address prefixes of a tag (case-insensitive), or None if it does not exist."""
+    for tag in document['values']:
+        if tag['name'].lower() == name.lower():
+            return list(tag['properties'].get('addressPrefixes') or [])
+    return None
+
+def range_to_prefixes(first, last, bits):
+    """Yield (network, prefix length) of the fewest CIDR blocks covering first..last."""
+    while first <= last:
+        # The largest block aligned on first that does not run past last
+        size = min((first & -first).bit_length() - 1 if first else bits, (last - first + 1).bit_length() - 1)
+        yield first, bits - size
+        first += 1 << size
+
+def collapse_prefixes(prefixes):
+    """Merge adjacent and nested prefixes into the minimal covering set.
+
+    The prefixes are turned into integer ranges, sorted and merged in one pass, then cut
+    back into CIDR blocks, O(n log n) overall. IPv4 prefixes come before IPv6 ones.
+    """
+    ranges = {4: [], 6: []}
+    for prefix in prefixes:
+        version, first, last = prefix_range(prefix)
+        ranges[version].append((first, last))
+
+    collapsed = []
+    for version, bits, address_class in ((4, 32, ipaddress.IPv4Address), (6, 128, ipaddress.IPv6Address)):
+        merged = []
+        for first, last in sorted(ranges[version]):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        for first, last in merged:
+            collapsed.extend(f"{address_class(network)}/{length}" for network, length in range_to_prefixes(first, last, bits))
+    return collapsed
+
+def iter_service_tags_file(path, chunk_size=1 << 20):
+    """Yield the tags of a ServiceTags_Public.json file one at a time.
+
+    Only the "values" array is walked and every element is decoded on its own, so the
+    document is never held as one object tree.
+    """
+    decoder = json.JSONDecoder()
+    values_start = re.compile(r'"values"\s*:\s*\[')
+    with open(path, encoding='utf-8-sig') as f:
+        buffer = ''
+        while True:
+            match = values_start.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f'No "values" array found in {path}')
+            buffer = buffer[-16:] + chunk
+
+        read_size = chunk_size
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,')
+            if buffer.startswith(']'):
+                return
+            try:
+                tag, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # The element is cut off, read more; doubling keeps huge tags like AzureCloud linear
+                chunk = f.read(read_size)
+                if not chunk:
+                    raise
+                buffer += chunk
+                read_size *= 2
+                continue
+            read_size = chunk_size
+            buffer = buffer[end:]
+            yield tag
+
+def load_service_tags_file(path):
+    """Load a ServiceTags_Public.json download or a cache entry of this tool."""
+    with open(path, encoding='utf-8-sig') as f:
+        data = json.load(f)
+    return data.get('document', data)
+
+def prefix_key(prefix):
+    """Pack a prefix into one integer: network << 8 | length, with bit 137 set for IPv6."""
+    address, _, length = prefix.partition('/')
+    version, value = ip_to_int(address)
+    bits = 32 if version == 4 else 128
+    length = int(length) if length else bits
+    key = (value >> (bits - length) << (bits - length)) << 8 | length
+    return key | 1 << 137 if version == 6 else key
+
+def key_prefix(key):
+    """Turn an integer made by prefix_key back into a prefix string."""
+    address_class = ipaddress.IPv6Address if key >> 137 else ipaddress.IPv4Address
+    key &= ~(1 << 137)
+    return f"{address_class(key >> 8)}/{key & 0xff}"
+
+def diff_service_tags(old, new):
+    """Compare two service tag documents tag by tag.
+
+    Tags whose changeNumber did not move are skipped without looking at their
+    prefixes, the others are compared as sets of integers made by prefix_key.
+
+    Returns:
+        list: {'name', 'oldChangeNumber', 'newChangeNumber', 'added', 'removed'} per changed tag.
+    """
+    old_tags = {tag['name']: tag['properties'] for tag in old['values']}
+    new_tags = {tag['name']: tag['properties'] for tag in new['values']}
+    changes = []
+    for name in sorted(old_tags.keys() | new_tags.keys()):
+        old_properties = old_tags.get(name, {})
+        new_properties = new_tags.get(name, {})
+        old_change = old_properties.get('changeNumber')
+        new_change = new_properties.get('changeNumber')
+        if name in old_tags and name in new_tags and old_change is not None and old_change == new_change:
+            continue
+        old_keys = {prefix_key(prefix) for prefix in old_properties.get('addressPrefixes') or []}
+        new_keys = {prefix_key(prefix) for prefix in new_properties.get('addressPrefixes') or []}
+        added = new_keys - old_keys
+        removed = old_keys - new_keys
+        if not added and not removed and name in old_tags and name in new_tags:
+            continue
+        changes.append({
+            'name': name,
+            'oldChangeNumber': old_change,
+            'newChangeNumber': new_change,
+            'added': [key_prefix(key) for key in sorted(added)],
+            'removed': [key_prefix(key) for key in sorted(removed)],
+        })
+    return changes
+
+def analyze_overlaps(tags_iter):
+    """Find the containment and overlap relations between Service Tags.
+
+    All prefixes are sorted once by (first address, -last address) and swept with a
+    stack of the prefixes enclosing the current one. CIDR blocks are either nested or
+    disjoint, so the stack holds exactly the prefixes containing the current prefix,
+    O(n log n) plus the nesting depth per prefix. A prefix covered only by the union
+    of several smaller prefixes of another tag is not counted as contained.
+
+    Returns:
+        list: {'tagA', 'tagB', 'relation', 'tagAPrefixes', 'tagBPrefixes', 'aInB', 'bInA'}
+              per related pair. relation is 'equal', 'contained' (every prefix of tagA
+              lies in a prefix of tagB) or 'overlap'.
+    """
+    names = []
+    prefix_counts = []
+    intervals = {4: [], 6: []}
+    for tag in tags_iter:
+        tag_id = len(names)
+        names.append(tag['name'])
+        ranges = {prefix_range(prefix) for prefix in tag['properties'].get('addressPrefixes') or []}
+        prefix_counts.append(len(ranges))
+        for version, first, last in ranges:
+            intervals[version].append((first, -last, tag_id))
+
+    contained = {}
+    for version_intervals in intervals.values():
+        version_intervals.sort()
+        stack = []
+        i = 0
+        while i < len(version_intervals):
+            first, negative_last, _ = version_intervals[i]
+            group = set()
+            while i < len(version_intervals) and version_intervals[i][:2] == (first, negative_last):
+                group.add(version_intervals[i][2])
+                i += 1
+            while stack and stack[-1][0] < first:
+                stack.pop()
+            enclosing = group.union(*(tags for _, tags in stack))
+            for tag_a in group:
+                for tag_b in enclosing:
+                    if tag_a != tag_b:
+                        contained[(tag_a, tag_b)] = contained.get((tag_a, tag_b), 0) + 1
+            stack.append((-negative_last, group))
+
+    relations = []
+    for tag_a, tag_b in sorted({(min(pair), max(pair)) for pair in contained}):
+        a_in_b = contained.get((tag_a, tag_b), 0)
+        b_in_a = contained.get((tag_b, tag_a), 0)
+        a_full = a_in_b == prefix_counts[tag_a]
+        b_full = b_in_a == prefix_counts[tag_b]
+        if b_full and not a_full:
+            # List the contained tag first
+            tag_a, tag_b, a_in_b, b_in_a, a_full, b_full = tag_b, tag_a, b_in_a, a_in_b, b_full, a_full
+        relations.append({
+            'tagA': names[tag_a],
+            'tagB': names[tag_b],
+            'relation': 'equal' if a_full and b_full else 'contained' if a_full else 'overlap',
+            'tagAPrefixes': prefix_counts[tag_a],
+            'tagBPrefixes': prefix_counts[tag_b],
+            'aInB': a_in_b,
+            'bInA': b_in_a,
+        })
+    return relations
+
+def filter_tags(tags_iter, regions=None, tag_globs=None, system_services=None):
+    """Yield the tags matching every given filter, before their prefixes are expanded.
+
+    Args:
+        tags_iter (iterable): Tags in the ServiceTags_Public.json layout.
+        regions (list): Regions to keep, '' keeps the tags without a region.
+        tag_globs (list): Shell-style patterns matched against the tag name.
+        system_services (list): systemService values to keep.
+    """
+    regions = {region.lower() for region in regions} if regions else None
+    services = {service.lower() for service in system_services} if system_services else None
+    pattern = re.compile('|'.join(fnmatch.translate(glob) for glob in tag_globs), re.IGNORECASE) if tag_globs else None
+    for tag in tags_iter:
+        properties = tag['properties']
+        if regions is not None and (properties.get('region') or '').lower() not in regions:
+            continue
+        if services is not None and (properties.get('systemService') or '').lower() not in services:
+            continue
+        if pattern is not None and not pattern.match(tag['name']):
+            continue
+        yield tag
+
+class RowWriter:
+    """Write (ServiceTag, IPPrefix, Region, SystemService) rows as CSV, JSONL or Parquet."""
+    def __init__(self, path, file_format):
+        self.file_format = file_format
+        if file_format == 'parquet':
+            try:
+                import pyarrow # pylint: disable=import-outside-toplevel
+                import pyarrow.parquet # pylint: disable=import-outside-toplevel
+            except ImportError as e:
+                raise RuntimeError("Parquet output needs pyarrow, please run: pip install pyarrow") from e
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([(column, pyarrow.string()) for column in CONVERT_COLUMNS])
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+            self.pending = []
+            return
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        if file_format == 'csv':
+            self.writer = csv.writer(self.file, lineterminator='\n')
+            self.writer.writerow(CONVERT_COLUMNS)
+
+    def write(self, rows):
+        """Write a list of rows."""
+        if self.file_format == 'parquet':
+            self.pending.extend(rows)
+            if len(self.pending) >= PARQUET_BATCH_SIZE:
+                self.flush()
+        elif self.file_format == 'csv':
+            self.writer.writerows(rows)
+        else:
+            self.file.write(''.join(json.dumps(dict(zip(CONVERT_COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows))
+
+    def flush(self):
+        """Write the buffered Parquet rows as one row group."""
+        if self.pending:
+            columns = list(zip(*self.pending))
+            self.writer.write_table(self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, self.pyarrow.string()) for column in columns], schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        """Flush and close the output."""
+        if self.file_format == 'parquet':
+            self.flush()
+            self.writer.close()
+        elif self.file is not sys.stdout:
+            self.file.close()
+
+def convert_service_tags(tags_iter, output, file_format='csv', split_by_region=False):
+    """Write one row per (tag, prefix) to output, or to output/<region>.<format> files.
+
+    Returns:
+        tuple: (number of tags, number of rows) written.
+    """
+    writers = {}
+    tag_count = row_count = 0
+    try:
+        for tag in tags_iter:
+            properties = tag['properties']
+            region = properties.get('region') or ''
+            key = (region or 'global') if split_by_region else None
+            if key not in writers:
+                if split_by_region:
+                    os.makedirs(output, exist_ok=True)
+                    writers[key] = RowWriter(os.path.join(output, f"{key}.{file_format}"), file_format)
+                else:
+                    writers[key] = RowWriter(output, file_format)
+            service = properties.get('systemService') or ''
+            rows = [(tag['name'], prefix, region, service) for prefix in properties.get('addressPrefixes') or []]
+            writers[key].write(rows)
+            tag_count += 1
+            row_count += len(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return tag_count, row_count
+
+def get_prefixes(tag, region=LOCATION, subscription_id=SUBSCRIPTION_ID, input_file=None, **cache_options):
+    """Return the address prefixes of a Service Tag.
+
+    Args:
+        tag (str): The Service Tag name, case-insensitive.
+        region (str): The Azure region the service tag list is requested from.
+        subscription_id (str): The subscription used to call Azure.
+        input_file (str): Read this ServiceTags_Public.json instead of the cache/Azure.
+        **cache_options: cache_dir, ttl, offline and refresh, see get_service_tags.
+
+    Returns:
+        list: The address prefixes.
+
+    Raises:
+        LookupError: If the Service Tag does not exist.
+    """
+    if input_file:
+        document = load_service_tags_file(input_file)
+    else:
+        document = get_service_tags(lambda: get_network_client(subscription_id), subscription_id, region, **cache_options)
+    prefixes = find_tag_prefixes(document, tag)
+    if prefixes is None:
+        raise LookupError(f"Could not find Service Tag: {tag} in region {region}")
+    return prefixes
+
+def lookup(ip, region=LOCATION, subscription_id=SUBSCRIPTION_ID, index_file=None, input_file=None, **cache_options):
+    """Return every Service Tag containing an IP.
+
+    The lookup index is built once per source (index_file, input_file or the cached
+    list of subscription_id/region) and kept for the following calls. An index of a
+    file is rebuilt when the file changes. An index of the cached list is checked again
+    through get_service_tags once ttl seconds have passed, and rebuilt when the
+    changeNumber of the service tag list differs.
+
+    Returns:
+        list: {'name', 'region', 'systemService'} of each matching tag.
+
+    Raises:
+        ValueError: If ip is not an IPv4 or IPv6 address.
+    """
+    if index_file or input_file:
+        path = index_file or input_file
+        key = ('index', path) if index_file else ('input', path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = IP_INDEXES.get(key)
+        if entry is None or entry['version'] != version:
+            index = open_ip_index(path) if index_file else build_ip_index(iter_service_tags_file(path))
+            entry = IP_INDEXES[key] = {'index': index, 'version': version}
+    else:
+        key = ('azure', subscription_id, region.lower())
+        entry = IP_INDEXES.get(key)
+        ttl = cache_options.get('ttl', CACHE_TTL)
+        if entry is None or cache_options.get('refresh') or time.time() - entry['checkedAt'] >= ttl:
+            document = get_service_tags(lambda: get_network_client(subscription_id), subscription_id, region, **cache_options)
+            if entry is None or entry['version'] != document.get('changeNumber'):
+                entry = IP_INDEXES[key] = {'index': build_ip_index(document['values']), 'version': document.get('changeNumber')}
+            entry['checkedAt'] = time.time()
+    return [
+        {'name': name, 'region': tag_region, 'systemService': service}
+        for name, tag_region, service in lookup_ip(entry['index'], ip)
+    ]
+
+def read_ip_list(path):
+    """Yield the IPs listed in a file, one per line, '-' reads stdin."""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def load_documents(args, requested_locations):
+    """Return {location: service tag document} from --input or the cache/Azure for the CLI.
+
+    With --input, main allows a single location, the file is returned under it.
+    """
+    try:
+        if args.input:
+            document = load_service_tags_file(args.input)
+            return {requested_location: document for requested_location in requested_locations}
+        return get_service_tags_by_location(
+            lambda: get_network_client(args.subscription_id), args.subscription_id, requested_locations, args.workers,
+            cache_dir=args.cache_dir, ttl=args.cache_ttl, offline=args.offline, refresh=args.refresh)
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
-    sys.exit(0)
-
-service_tag = args.service_tag
-location = args.location
-if not location:
-    print("Location is required!")
-    sys.exit(1)
-
-credential = DefaultAzureCredential()
-subscription_id = args.subscription_id
-if not subscription_id:
-    print("Subscription ID is required!")
-    sys.exit(1)
-
-network_client = NetworkManagementClient(credential, subscription_id)
-
-try:
-    tag_info = network_client.service_tags.list(location)
-    FOUND = False
-    ip_list = []
-    for tag in tag_info.values:
-        if tag.name.lower() == service_tag.lower():
-            FOUND = True
-            if hasattr(tag.properties, 'address_prefixes'):
-                ip_list = tag.properties.address_prefixes
+
+def load_ip_index(args):
+    """Return the reverse lookup index from --index, --input or the service tag document for the CLI."""
+    try:
+        if args.index:
+            return open_ip_index(args.index)
+        if args.input:
+            return build_ip_index(iter_service_tags_file(args.input))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    location = args.location[0]
+    return build_ip_index(load_documents(args, [location])[location]['values'])
+
+def main():
+    """Parse command-line arguments and run the requested query."""
+    parser = argparse.ArgumentParser(description="Query Azure Service Tag Public IP List")
+    parser.add_argument('--output', choices=['csv', 'json'], default='csv', help='Format: csv or json (default is csv)') # pylint: disable=line-too-long
+    parser.add_argument('--service-tag', nargs='+', default=[SERVICE_TAG], help=f'One or more Service Tag Names (default: {SERVICE_TAG})') # pylint: disable=line-too-long
+    parser.add_argument('--location', nargs='+', default=[LOCATION], help=f'One or more Azure regions (default: {LOCATION})') # pylint: disable=line-too-long
+    parser.add_argument('--workers', type=int, default=FETCH_WORKERS, help=f'Regions fetched concurrently (default: {FETCH_WORKERS})') # pylint: disable=line-too-long
+    parser.add_argument('--subscription-id', default=SUBSCRIPTION_ID, help='Azure Subscription ID')
+    parser.add_argument('--list-tags', action='store_true', help='List all of Service Tag Name')
+    parser.add_argument('--lookup', nargs='+', metavar='IP', help='Show which Service Tags contain the given IPs')
+    parser.add_argument('--lookup-file', metavar='FILE', help='Like --lookup, reading one IP per line from FILE (- for stdin)') # pylint: disable=line-too-long
+    parser.add_argument('--enrich', metavar='FILE', help='Add Service Tag columns to a CSV/JSONL log file (- for stdin)') # pylint: disable=line-too-long
+    parser.add_argument('--enrich-format', choices=['csv', 'jsonl'], default='csv', help='Format of the --enrich input (default: csv)') # pylint: disable=line-too-long
+    parser.add_argument('--enrich-output', metavar='FILE', default='-', help='Where --enrich writes the enriched rows (default: stdout)') # pylint: disable=line-too-long
+    parser.add_argument('--ip-columns', default='SrcIP,DestIP', help='Comma separated IP columns for --enrich (default: SrcIP,DestIP)') # pylint: disable=line-too-long
+    parser.add_argument('--collapse', action='store_true', help='Merge adjacent and nested prefixes into the minimal covering set') # pylint: disable=line-too-long
+    parser.add_argument('--collapse-tags', nargs='+', metavar='TAG', help='Collapse the prefixes of several Service Tags into one set') # pylint: disable=line-too-long
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help='Show added/removed prefixes per tag between two snapshots, each a JSON file, "cache" or "live"') # pylint: disable=line-too-long
+    parser.add_argument('--overlaps', action='store_true', help='Show which Service Tags contain or overlap each other') # pylint: disable=line-too-long
+    parser.add_argument('--input', metavar='FILE', help='Read a downloaded ServiceTags_Public.json instead of calling Azure') # pylint: disable=line-too-long
+    parser.add_argument('--build-index', metavar='FILE', help='Compile the service tags into a binary index for --index') # pylint: disable=line-too-long
+    parser.add_argument('--index', metavar='FILE', help='Use a binary index made by --build-index for --lookup/--enrich') # pylint: disable=line-too-long
+    parser.add_argument('--convert', metavar='OUTPUT', help='Write one row per (tag, prefix) to OUTPUT (- for stdout), a directory with --split-by-region') # pylint: disable=line-too-long
+    parser.add_argument('--convert-format', choices=['csv', 'jsonl', 'parquet'], default='csv', help='Format of --convert (default: csv)') # pylint: disable=line-too-long
+    parser.add_argument('--split-by-region', action='store_true', help='With --convert, write one file per region')
+    parser.add_argument('--region', nargs='+', help='With --convert/--overlaps, only keep tags of these regions ("" for global tags)') # pylint: disable=line-too-long
+    parser.add_argument('--tag-glob', nargs='+', help='With --convert/--overlaps, only keep tags whose name matches a pattern, e.g. "AzureCloud.*"') # pylint: disable=line-too-long
+    parser.add_argument('--system-service', nargs='+', help='With --convert/--overlaps, only keep tags of these systemService values') # pylint: disable=line-too-long
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'Service tag cache directory (default: {CACHE_DIR})') # pylint: disable=line-too-long
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL, help=f'Seconds before a cached service tag list is revalidated (default: {CACHE_TTL})') # pylint: disable=line-too-long
+    parser.add_argument('--offline', action='store_true', help='Only use the cached service tag list, never call Azure')
+    parser.add_argument('--refresh', action='store_true', help='Ignore the cache and download the service tag list again')
+    args = parser.parse_args()
+
+    locations = args.location
+    location = locations[0]
+    if not location:
+        print("Location is required!")
+        sys.exit(1)
+
+    subscription_id = args.subscription_id
+    if not subscription_id:
+        print("Subscription ID is required!")
+        sys.exit(1)
+
+    # A downloaded file holds one service tag list, it cannot stand for several regions
+    if args.input and len(locations) > 1:
+        print("Only one --location can be given with --input!")
+        sys.exit(1)
+
+    if args.diff:
+        snapshots = []
+        try:
+            for source in args.diff:
+                if source == 'cache':
+                    cache_entry = read_cache(cache_path(args.cache_dir, subscription_id, location))
+                    if cache_entry is None:
+                        raise RuntimeError(f"No cached service tags for subscription {subscription_id} in {location}")
+                    snapshots.append(cache_entry['document'])
+                elif source == 'live':
+                    # Not stored in the cache, which may be the other side of the diff
+                    snapshots.append(service_tags_to_dict(get_network_client(subscription_id).service_tags.list(location)))
+                else:
+                    snapshots.append(load_service_tags_file(source))
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+        tag_changes = diff_service_tags(*snapshots)
+        if args.output == 'json':
+            print(json.dumps({
+                'oldChangeNumber': snapshots[0].get('changeNumber'),
+                'newChangeNumber': snapshots[1].get('changeNumber'),
+                'tags': tag_changes,
+            }, ensure_ascii=False, indent=2))
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['service_tag', 'old_change_number', 'new_change_number', 'change', 'ip_prefix'])
+            for change in tag_changes:
+                for kind in ('added', 'removed'):
+                    for prefix in change[kind]:
+                        writer.writerow([change['name'], change['oldChangeNumber'], change['newChangeNumber'], kind, prefix])
+        sys.exit(0)
+
+    if args.build_index:
+        ip_index = load_ip_index(args)
+        write_ip_index(ip_index, args.build_index)
+        print(f"Index {args.build_index}: {len(ip_index['tags'])} tags, {len(ip_index[4][0])} IPv4 and {len(ip_index[6][0])} IPv6 ranges") # pylint: disable=line-too-long
+        sys.exit(0)
+
+    if args.convert:
+        if args.split_by_region and args.convert == '-':
+            print("Error: --split-by-region needs an output directory")
+            sys.exit(1)
+        source_tags = iter_service_tags_file(args.input) if args.input else load_documents(args, [location])[location]['values']
+        try:
+            converted = convert_service_tags(
+                filter_tags(source_tags, args.region, args.tag_glob, args.system_service),
+                args.convert, args.convert_format, args.split_by_region)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"Converted {converted[0]} tags into {converted[1]} rows", file=sys.stderr)
+        sys.exit(0)
+
+    if args.overlaps:
+        source_tags = iter_service_tags_file(args.input) if args.input else load_documents(args, [location])[location]['values']
+        relations = analyze_overlaps(filter_tags(source_tags, args.region, args.tag_glob, args.system_service))
+        if args.output == 'json':
+            print(json.dumps(relations, ensure_ascii=False, indent=2))
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['tag_a', 'tag_b', 'relation', 'tag_a_prefixes', 'tag_b_prefixes', 'a_in_b', 'b_in_a'])
+            for relation in relations:
+                writer.writerow(relation.values())
+        sys.exit(0)
+
+    if args.list_tags:
+        print("All Service Tag Names in the region:")
+        for tag in load_documents(args, [location])[location]['values']:
+            print(tag['name'])
+        sys.exit(0)
+
+    if args.lookup or args.lookup_file:
+        ips = list(args.lookup or [])
+        if args.lookup_file:
+            ips.extend(read_ip_list(args.lookup_file))
+        ip_index = load_ip_index(args)
+        results = {}
+        for ip in ips:
+            try:
+                results[ip] = lookup_ip(ip_index, ip)
+            except ValueError as e:
+                print(f"Error: {e}", file=sys.stderr)
+
+        if args.output == 'json':
+            print(json.dumps({
+                ip: [{"name": name, "region": region, "systemService": service} for name, region, service in matches]
+                for ip, matches in results.items()
+            }, ensure_ascii=False, indent=2))
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['ip', 'service_tag', 'region', 'system_service'])
+            for ip, matches in results.items():
+                for match in matches or [('', '', '')]:
+                    writer.writerow([ip, *match])
+        sys.exit(0)
+
+    if args.enrich:
+        enrich_in = sys.stdin if args.enrich == '-' else open(args.enrich, encoding='utf-8', newline='')
+        enrich_out = sys.stdout if args.enrich_output == '-' else open(args.enrich_output, 'w', encoding='utf-8', newline='')
+        try:
+            enrich_stream(load_ip_index(args), enrich_in, enrich_out, [c.strip() for c in args.ip_columns.split(',') if c.strip()], args.enrich_format) # pylint: disable=line-too-long
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if enrich_in is not sys.stdin:
+                enrich_in.close()
+            if enrich_out is not sys.stdout:
+                enrich_out.close()
+        sys.exit(0)
+
+    documents = load_documents(args, locations)
+    try:
+        tag_groups = [args.collapse_tags] if args.collapse_tags else [[tag] for tag in args.service_tag]
+        results = {}
+        for region, document in documents.items():
+            for tag_group in tag_groups:
+                label = '+'.join(tag_group)
+                ip_list = []
+                for query_tag in tag_group:
+                    tag_prefixes = find_tag_prefixes(document, query_tag)
+                    if tag_prefixes is None:
+                        print(f"Could not find Service Tag: {query_tag} in region {region}")
+                        sys.exit(1)
+                    ip_list.extend(tag_prefixes)
+
+                if args.collapse or args.collapse_tags:
+                    collapsed = collapse_prefixes(ip_list)
+                    for version in (4, 6):
+                        before = sum(1 for prefix in ip_list if (':' in prefix) == (version == 6))
+                        after = sum(1 for prefix in collapsed if (':' in prefix) == (version == 6))
+                        print(f"{label} in {region}, IPv{version}: collapsed {before} prefixes into {after}", file=sys.stderr) # pylint: disable=line-too-long
+                    ip_list = collapsed
+                results[(label, region)] = ip_list
+
+        if len(results) == 1:
+            (label, region), ip_list = next(iter(results.items()))
+            if args.output == 'json':
+                print(json.dumps(ip_list, ensure_ascii=False, indent=2))
             else:
-                print("Could not find address_prefixes property, please check the debug output above")
-            break
-    if not FOUND:
-        print(f"Could not find Service Tag: {service_tag} in region {location}")
+                writer = csv.writer(sys.stdout)
+                writer.writerow([label])
+                for ip in ip_list:
+                    writer.writerow([ip])
+        elif args.output == 'json':
+            combined = {}
+            for (label, region), ip_list in results.items():
+                combined.setdefault(label, {})[region] = ip_list
+            print(json.dumps(combined, ensure_ascii=False, indent=2))
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['service_tag', 'region', 'ip_prefix'])
+            for (label, region), ip_list in results.items():
+                for ip in ip_list:
+                    writer.writerow([label, region, ip])
+
+    except Exception as e:
+        print(f"Error: {e}")
         sys.exit(1)
 
-    if args.output == 'json':
-        print(json.dumps(ip_list, ensure_ascii=False, indent=2))
-    else:
-        writer = csv.writer(sys.stdout)
-        writer.writerow([service_tag])
-        for ip in ip_list:
-            writer.writerow([ip])
-
-except Exception as e:
-    print(f"Error: {e}")
-    sys.exit(1)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Tests of azure_service_tag_ip_query as an importable module.
+
+Run from azure-service-tag-ip-query/ with: python -m pytest tests
+"""
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import pytest
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MODULE_DIR)
+
+import azure_service_tag_ip_query as st # pylint: disable=wrong-import-position
+
+SUBSCRIPTION_ID = '00000000-0000-0000-0000-000000000000'
+LOCATION = 'japaneast'
+# Cold imports on a small VM take ~50 ms, the Azure SDK alone takes about a second
+STARTUP_BUDGET = 0.5
+
+
+def service_tags_document(change_number, prefix):
+    """Return a minimal document in the ServiceTags_Public.json layout."""
+    return {
+        'changeNumber': change_number,
+        'cloud': 'Public',
+        'values': [{
+            'name': 'AzureFrontDoor.Frontend',
+            'id': 'AzureFrontDoor.Frontend',
+            'properties': {'changeNumber': change_number, 'region': '', 'systemService': 'AzureFrontDoor', 'addressPrefixes': [prefix]},
+        }],
+    }
+
+
+def run_isolated(code, cache_dir):
+    """Run code in a fresh interpreter and return the JSON it prints."""
+    result = subprocess.run(
+        [sys.executable, '-c', code, MODULE_DIR, cache_dir],
+        capture_output=True, text=True, check=True, timeout=60,
+    )
+    return json.loads(result.stdout)
+
+
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import azure_service_tag_ip_query as st
+imported = time.perf_counter() - started
+result = {}
+{body}
+result['importSeconds'] = imported
+result['sdkModules'] = sorted(name for name in ('azure.identity', 'azure.mgmt.network') if name in sys.modules)
+print(json.dumps(result))
+'''
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    """A cache directory holding a fresh service tag list for SUBSCRIPTION_ID/LOCATION."""
+    st.write_cache(st.cache_path(str(tmp_path), SUBSCRIPTION_ID, LOCATION), SUBSCRIPTION_ID, LOCATION,
+                   service_tags_document(1, '13.107.246.0/24'))
+    return str(tmp_path)
+
+
+def test_import_is_fast_and_does_not_load_the_sdk(cache_dir):
+    result = run_isolated(PROBE.replace('{body}', ''), cache_dir)
+    print(f"import: {result['importSeconds'] * 1000:.1f} ms")
+    assert result['sdkModules'] == []
+    assert result['importSeconds'] < STARTUP_BUDGET
+
+
+@pytest.mark.parametrize('options', ['offline=True', 'ttl=3600'], ids=['offline', 'cached'])
+def test_cached_queries_do_not_load_the_sdk(cache_dir, options):
+    body = f'''
+started = time.perf_counter()
+result['lookup'] = st.lookup('13.107.246.10', '{LOCATION}', '{SUBSCRIPTION_ID}', cache_dir=sys.argv[2], {options})
+result['prefixes'] = st.get_prefixes('AzureFrontDoor.Frontend', '{LOCATION}', '{SUBSCRIPTION_ID}', cache_dir=sys.argv[2], {options})
+result['querySeconds'] = time.perf_counter() - started
+'''
+    result = run_isolated(PROBE.replace('{body}', body), cache_dir)
+    print(f"import: {result['importSeconds'] * 1000:.1f} ms, lookup + get_prefixes: {result['querySeconds'] * 1000:.1f} ms")
+    assert result['lookup'] == [{'name': 'AzureFrontDoor.Frontend', 'region': '', 'systemService': 'AzureFrontDoor'}]
+    assert result['prefixes'] == ['13.107.246.0/24']
+    assert result['sdkModules'] == []
+    assert result['importSeconds'] + result['querySeconds'] < STARTUP_BUDGET
+
+
+def test_lookup_rebuilds_the_index_when_the_service_tags_change(monkeypatch):
+    documents = [service_tags_document(1, '13.107.246.0/24'), service_tags_document(2, '13.107.213.0/24')]
+    calls = []
+
+    def get_service_tags(client_factory, subscription_id, location, **kwargs): # pylint: disable=unused-argument
+        calls.append(location)
+        return documents[0] if len(calls) == 1 else documents[1]
+
+    monkeypatch.setattr(st, 'get_service_tags', get_service_tags)
+    monkeypatch.setattr(st, 'IP_INDEXES', {})
+
+    assert st.lookup('13.107.246.10', LOCATION, SUBSCRIPTION_ID, ttl=3600)
+    # Within the TTL the index is reused without asking for the service tags again
+    assert st.lookup('13.107.213.10', LOCATION, SUBSCRIPTION_ID, ttl=3600) == []
+    assert len(calls) == 1
+
+    # Once the TTL has passed, a new changeNumber rebuilds the index
+    assert st.lookup('13.107.213.10', LOCATION, SUBSCRIPTION_ID, ttl=0)
+    assert st.lookup('13.107.246.10', LOCATION, SUBSCRIPTION_ID, ttl=0) == []
+    assert len(calls) == 3
+
+
+def test_lookup_rebuilds_the_index_when_the_input_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(st, 'IP_INDEXES', {})
+    path = tmp_path / 'ServiceTags_Public.json'
+    path.write_text(json.dumps(service_tags_document(1, '13.107.246.0/24')))
+    assert st.lookup('13.107.246.10', input_file=str(path))
+
+    path.write_text(json.dumps(service_tags_document(2, '13.107.213.0/24')))
+    os.utime(path, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+    assert st.lookup('13.107.246.10', input_file=str(path)) == []
+    assert st.lookup('13.107.213.10', input_file=str(path))
+
+
+ENRICH_TAGS = [
+    {'name': 'AzureCloud', 'id': 'AzureCloud', 'properties': {
+        'region': '', 'systemService': '', 'addressPrefixes': ['13.64.0.0/11', '2603:1000::/24']}},
+    {'name': 'AzureFrontDoor.Frontend', 'id': 'AzureFrontDoor.Frontend', 'properties': {
+        'region': '', 'systemService': 'AzureFrontDoor', 'addressPrefixes': ['13.107.246.0/24', '255.255.255.255/32']}},
+    {'name': 'Storage.JapanEast', 'id': 'Storage.JapanEast', 'properties': {
+        'region': 'japaneast', 'systemService': 'AzureStorage', 'addressPrefixes': ['0.0.0.0/32', '20.38.116.0/23']}},
+]
+
+# Cells of the IP columns: matches, misses and everything the array parser must hand back
+ENRICH_CELLS = [
+    '13.107.246.10', '13.70.1.1', '20.38.117.255', '20.38.118.0', '8.8.8.8', '0.0.0.0', '255.255.255.255',
+    '013.107.246.10', '13.107.246.010', '13.107.246.00', '13.107.256.1', '300.1.1.1', '13.107.246.1000',
+    '13.107.246', '13.107.246.10.5', '13..246.10', '.13.107.246', '13.107.246.', ' 13.107.246.10', '13.107.246.10 ',
+    '', 'abc', '1.2.3.4/32', '111.111.111.111x', '13.107.246.10\x00', '2603:1000::1', '::1', '::ffff:13.107.246.10',
+]
+
+
+def expected_labels(index, cell):
+    """Label of one cell by the per-address lookup_ip path."""
+    try:
+        return ';'.join(tag[0] for tag in st.lookup_ip(index, cell))
+    except ValueError:
+        return ''
+
+
+def enrich_csv_text(index, text, batch_size):
+    """Return the rows of enrich_stream's CSV output, parsed with the csv module."""
+    output = io.StringIO()
+    st.enrich_stream(index, io.StringIO(text, newline=''), output, ['SrcIP', 'DestIP'], batch_size=batch_size)
+    return list(csv.reader(io.StringIO(output.getvalue())))
+
+
+def enrich_csv_lines(quoted=False, crlf=False, short=False):
+    """Return the lines of a CSV log with two IP columns, every pair of ENRICH_CELLS once."""
+    random.seed(3)
+    lines = []
+    for k, src in enumerate(ENRICH_CELLS):
+        for dest in random.sample(ENRICH_CELLS, 8):
+            note = f'"flow {k}, allowed"' if quoted and k % 3 == 0 else f'flow {k}'
+            line = f'{src},{k},{dest},{note}'
+            if quoted and k % 5 == 0:
+                line = f'"{src}",{k},"{dest}",{note}'
+            if short and k % 4 == 0:
+                line = f'{src},{k}'
+            lines.append(line + ('\r\n' if crlf else '\n'))
+    return ['SrcIP,Port,DestIP,Note\n'] + lines
+
+
+@pytest.fixture
+def enrich_index():
+    return st.build_ip_index(ENRICH_TAGS)
+
+
+@pytest.mark.parametrize('layout', ['plain', 'quoted', 'crlf', 'short'])
+@pytest.mark.parametrize('batch_size', [7, 65536])
+def test_enrich_csv_matches_lookup_ip(enrich_index, layout, batch_size):
+    lines = enrich_csv_lines(quoted=layout == 'quoted', crlf=layout == 'crlf', short=layout == 'short')
+    rows = list(csv.reader(io.StringIO(''.join(lines), newline='')))
+    enriched = enrich_csv_text(enrich_index, ''.join(lines), batch_size)
+    assert enriched[0] == rows[0] + ['SrcIP_ServiceTag', 'DestIP_ServiceTag']
+    assert len(enriched) == len(rows)
+    for row, out in zip(rows[1:], enriched[1:]):
+        row += [''] * (4 - len(row))
+        assert out[:4] == row
+        assert out[4:] == [expected_labels(enrich_index, row[0]), expected_labels(enrich_index, row[2])]
+
+
+def test_enrich_csv_plain_batches_take_the_array_path(enrich_index, monkeypatch):
+    pytest.importorskip('numpy')
+    batches = []
+    enrich_csv_batch = st.enrich_csv_batch
+
+    def spy(*args):
+        result = enrich_csv_batch(*args)
+        batches.append(result is not None)
+        return result
+
+    monkeypatch.setattr(st, 'enrich_csv_batch', spy)
+    lines = enrich_csv_lines()
+    with_numpy = enrich_csv_text(enrich_index, ''.join(lines), 7)
+    assert batches and all(batches)
+
+    # Without numpy every line is split and looked up on its own, with the same result
+    monkeypatch.setattr(st, 'NUMPY', [None])
+    assert enrich_csv_text(enrich_index, ''.join(lines), 7) == with_numpy
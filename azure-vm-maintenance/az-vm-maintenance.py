@@ -22,53 +22,404 @@ Dependencies:
 Ensure that you have the necessary Azure credentials configured in your environment before running this script.
 """
 
+# Only the standard library is imported here, pandas, python-dotenv and the
+# Azure SDK are imported when an action needs them (see load_config and
+# ClientRegistry), so --show-csv starts without them
 import argparse
+import atexit
+import csv
+import json
+import os
 import sys
-from dotenv import dotenv_values
-import pandas as pd
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.compute.models import Snapshot, DiskCreateOption, CreationData, NetworkAccessPolicy
-from azure.mgmt.subscription import SubscriptionClient
-from azure.mgmt.recoveryservicesbackup import RecoveryServicesBackupClient
-from azure.identity import DefaultAzureCredential
-from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
-
-# Read dotenv file
-config = dotenv_values("0-az-vm-protect.env")
-VM_PROJECT_CSV = config['VM_PROJECT_CSV']
-VM_SNAPSHOT_POSTFIX = config['VM_SNAPSHOT_POSTFIX']
-
-VAULT_SUBSCRIPTION = config['VAULT_SUBSCRIPTION']
-VAULT_RESOURCE_GROUP_NAME = config['VAULT_RESOURCE_GROUP_NAME']
-VAULT_NAME = config['VAULT_NAME']
-VAULT_BACKUP_POLICY = config['VAULT_BACKUP_POLICY']
-
-# Initialize credential
-credential = DefaultAzureCredential()
-
-def read_csv_file(csv_file: str) -> pd.DataFrame:
-    """Read a CSV file and return its contents as a DataFrame.
+import threading
+import time
+from datetime import datetime, timezone
+
+# Dotenv file, read by load_config()
+CONFIG_FILE = "0-az-vm-protect.env"
+VM_PROJECT_CSV = None
+VM_SNAPSHOT_POSTFIX = None
+
+VAULT_SUBSCRIPTION = None
+VAULT_RESOURCE_GROUP_NAME = None
+VAULT_NAME = None
+VAULT_BACKUP_POLICY = None
+# Optional comma separated "subscription/resource-group/vault" list checked by --check-backup
+VAULTS = ''
+VAULT_FETCH_WORKERS = 8
+
+# VM names per Resource Graph query and rows per result page
+RESOURCE_GRAPH_BATCH_SIZE = 200
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+
+# Subscription name/ID map, shared by back-to-back runs
+SUBSCRIPTION_CACHE_FILE = os.path.expanduser(os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or '~/.cache', 'az-vm-maintenance', 'subscriptions.json'))
+SUBSCRIPTION_CACHE_TTL = 3600
+
+# Snapshots running at once per subscription and per region of a subscription
+SNAPSHOT_MAX_PER_SUBSCRIPTION = 20
+SNAPSHOT_MAX_PER_REGION = 10
+SNAPSHOT_POLL_INTERVAL = 2
+SNAPSHOT_START_WORKERS = 8
+
+# Append-only log of the snapshot states of a run, read by --resume
+SNAPSHOT_JOURNAL = None
+
+# ARM requests in flight at once with --async
+ASYNC_CONCURRENCY = 16
+
+# Keep-alive connections to management.azure.com shared by every client
+HTTP_POOL_SIZE = 32
+
+def load_config(config_file: str = CONFIG_FILE) -> None:
+    """Read the dotenv file into the settings above.
 
     Args:
-        csv_file (str): The path to the CSV file.
+        config_file (str): The path to the dotenv file.
+    """
+    # pylint: disable=global-statement,import-outside-toplevel
+    global VM_PROJECT_CSV, VM_SNAPSHOT_POSTFIX, VAULT_SUBSCRIPTION, VAULT_RESOURCE_GROUP_NAME, VAULT_NAME
+    global VAULT_BACKUP_POLICY, VAULTS, SUBSCRIPTION_CACHE_FILE, SUBSCRIPTION_CACHE_TTL
+    global SNAPSHOT_MAX_PER_SUBSCRIPTION, SNAPSHOT_MAX_PER_REGION, SNAPSHOT_JOURNAL
+    from dotenv import dotenv_values
+
+    config = dotenv_values(config_file)
+    VM_PROJECT_CSV = config.get('VM_PROJECT_CSV')
+    VM_SNAPSHOT_POSTFIX = config.get('VM_SNAPSHOT_POSTFIX')
+
+    VAULT_SUBSCRIPTION = config.get('VAULT_SUBSCRIPTION')
+    VAULT_RESOURCE_GROUP_NAME = config.get('VAULT_RESOURCE_GROUP_NAME')
+    VAULT_NAME = config.get('VAULT_NAME')
+    VAULT_BACKUP_POLICY = config.get('VAULT_BACKUP_POLICY')
+    VAULTS = config.get('VAULTS') or ''
+
+    SUBSCRIPTION_CACHE_FILE = os.path.expanduser(config.get('SUBSCRIPTION_CACHE_FILE') or SUBSCRIPTION_CACHE_FILE)
+    SUBSCRIPTION_CACHE_TTL = int(config.get('SUBSCRIPTION_CACHE_TTL') or SUBSCRIPTION_CACHE_TTL)
+    SUBSCRIPTION_RESOLVER.cache_file = SUBSCRIPTION_CACHE_FILE
+    SUBSCRIPTION_RESOLVER.ttl = SUBSCRIPTION_CACHE_TTL
+
+    SNAPSHOT_MAX_PER_SUBSCRIPTION = int(config.get('SNAPSHOT_MAX_PER_SUBSCRIPTION') or SNAPSHOT_MAX_PER_SUBSCRIPTION)
+    SNAPSHOT_MAX_PER_REGION = int(config.get('SNAPSHOT_MAX_PER_REGION') or SNAPSHOT_MAX_PER_REGION)
+    SNAPSHOT_JOURNAL = config.get('SNAPSHOT_JOURNAL') or f"snapshot-journal-{VM_SNAPSHOT_POSTFIX}.jsonl"
+
+def sdk_client_class(kind: str):
+    """Import and return the management client class of kind.
+
+    Args:
+        kind (str): 'compute', 'subscription', 'backup' or 'graph'.
+    """
+    # pylint: disable=import-outside-toplevel
+    if kind == 'compute':
+        from azure.mgmt.compute import ComputeManagementClient
+        return ComputeManagementClient
+    if kind == 'subscription':
+        from azure.mgmt.subscription import SubscriptionClient
+        return SubscriptionClient
+    if kind == 'backup':
+        from azure.mgmt.recoveryservicesbackup import RecoveryServicesBackupClient
+        return RecoveryServicesBackupClient
+    if kind == 'graph':
+        from azure.mgmt.resourcegraph import ResourceGraphClient
+        return ResourceGraphClient
+    raise ValueError(f"Unknown client kind '{kind}'")
+
+class ClientRegistry:
+    """Management clients shared by every helper of a run.
+
+    Clients are created once per (client kind, subscription) and all of them
+    send their requests through one requests.Session, so the keep-alive
+    connections to management.azure.com (and their TLS handshakes) are
+    reused across clients instead of each client opening its own pool.
+    The credential and the session are created with the first client.
+    """
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.clients = {}
+        self.credential = None
+        self.session = None
+        self.adapter = None
+        self.requested = 0
+        self.lock = threading.Lock()
+
+    def get(self, kind: str, subscription: str = None):
+        """Return the shared client of kind for subscription, creating it on first use.
+
+        Args:
+            kind (str): 'compute', 'subscription', 'backup' or 'graph', see sdk_client_class.
+            subscription (str): The subscription ID, None for tenant level clients.
+        """
+        with self.lock:
+            self.requested += 1
+            key = (kind, subscription)
+            if key not in self.clients:
+                if self.session is None:
+                    # pylint: disable=import-outside-toplevel
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    from azure.identity import DefaultAzureCredential
+                    self.credential = DefaultAzureCredential()
+                    self.session = requests.Session()
+                    self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    self.session.mount('https://', self.adapter)
+                from azure.core.pipeline.transport import RequestsTransport # pylint: disable=import-outside-toplevel
+                kwargs = {'transport': RequestsTransport(session=self.session, session_owner=False)}
+                if subscription is not None:
+                    kwargs['subscription_id'] = subscription
+                self.clients[key] = sdk_client_class(kind)(credential=self.credential, **kwargs)
+            return self.clients[key]
+
+    def connections(self) -> int:
+        """Return the number of HTTPS connections (TLS handshakes) opened so far."""
+        if self.adapter is None:
+            return 0
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def summary(self) -> str:
+        """Return the client and connection counters as a printable line."""
+        return (f"Management clients: {len(self.clients)} created for {self.requested} uses, "
+                f"{self.connections()} HTTPS connections opened")
+
+    def close(self) -> None:
+        """Close every client and the shared session."""
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            if self.credential is not None:
+                self.credential.close()
+                self.credential = None
+
+CLIENT_REGISTRY = ClientRegistry(HTTP_POOL_SIZE)
+atexit.register(CLIENT_REGISTRY.close)
+
+class ResourceCache:
+    """Per-run cache of VM and disk models keyed by resource ID.
+
+    Every lookup of the same resource is served from memory after the first
+    GET, hits and misses are counted to show how many ARM calls were saved.
+    """
+    def __init__(self):
+        self.models = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, resource_id: str, fetch):
+        """Return the cached model of resource_id, calling fetch() on the first lookup."""
+        key = resource_id.lower()
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                return self.models[key]
+            self.misses += 1
+        model = fetch()
+        with self.lock:
+            self.models[key] = model
+        return model
+
+    def put(self, resource_id: str, model) -> None:
+        """Store a model fetched elsewhere (e.g. by AsyncEngine), counted as a miss."""
+        with self.lock:
+            self.misses += 1
+            self.models[resource_id.lower()] = model
+
+    def summary(self) -> str:
+        """Return the hit and miss counters as a printable line."""
+        return f"Resource cache: {self.hits} hits, {self.misses} misses ({len(self.models)} resources fetched)"
+
+RESOURCE_CACHE = ResourceCache()
+
+class SubscriptionResolver:
+    """Resolve subscription names or IDs to IDs from one subscription listing.
+
+    The listing is kept in cache_file for ttl seconds, so the following runs
+    do not call Azure at all. A name missing from a cached listing triggers
+    one fresh listing, in case the subscription was created since.
+    """
+    def __init__(self, cache_file: str, ttl: int):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.by_name = None
+        self.by_id = None
+        self.from_cache = False
+
+    def read_cache(self) -> bool:
+        """Load the cached listing if it is younger than the TTL."""
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - cached.get('fetchedAt', 0) > self.ttl:
+            return False
+        self.by_name = cached['byName']
+        self.by_id = cached['byId']
+        self.from_cache = True
+        return True
+
+    def refresh(self) -> None:
+        """List the subscriptions once and write the cache file."""
+        subscription_client = CLIENT_REGISTRY.get('subscription')
+        self.by_name = {}
+        self.by_id = {}
+        for subscription_entry in subscription_client.subscriptions.list():
+            # Keep the first subscription of a duplicated display name, like a linear search would
+            self.by_name.setdefault(subscription_entry.display_name, subscription_entry.subscription_id)
+            self.by_id[subscription_entry.subscription_id] = subscription_entry.subscription_id
+        self.from_cache = False
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'fetchedAt': time.time(), 'byName': self.by_name, 'byId': self.by_id}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print(f"Warning: cannot write subscription cache {self.cache_file}: {e}")
+
+    def resolve(self, subscription_name: str) -> str:
+        """Return the subscription ID of a subscription name or ID.
+
+        Raises:
+            ValueError: If the subscription name or ID is not found.
+        """
+        if self.by_id is None and not self.read_cache():
+            self.refresh()
+        for _ in range(2):
+            if subscription_name in self.by_id:
+                return self.by_id[subscription_name]
+            if subscription_name in self.by_name:
+                return self.by_name[subscription_name]
+            if not self.from_cache:
+                break
+            self.refresh()
+        raise ValueError(f"Subscription name or ID '{subscription_name}' not found.")
+
+SUBSCRIPTION_RESOLVER = SubscriptionResolver(SUBSCRIPTION_CACHE_FILE, SUBSCRIPTION_CACHE_TTL)
+
+def resource_id(subscription: str, resource_group: str, resource_type: str, name: str) -> str:
+    """Build the ARM resource ID of a Microsoft.Compute resource."""
+    return f"/subscriptions/{subscription}/resourceGroups/{resource_group}/providers/Microsoft.Compute/{resource_type}/{name}"
+
+def get_vm(subscription: str, resource_group: str, vm_name: str):
+    """Return the virtual machine model, fetched once per run.
+
+    Args:
+        subscription (str): The subscription ID.
+        resource_group (str): The resource group name.
+        vm_name (str): The virtual machine name.
 
     Returns:
-        pd.DataFrame: The contents of the CSV file as a DataFrame.
+        VirtualMachine: The virtual machine model.
+    """
+    def fetch():
+        az_client = CLIENT_REGISTRY.get('compute', subscription)
+        return az_client.virtual_machines.get(resource_group, vm_name)
+    return RESOURCE_CACHE.get(resource_id(subscription, resource_group, 'virtualMachines', vm_name), fetch)
+
+def get_disk(subscription: str, resource_group: str, disk_name: str):
+    """Return the managed disk model, fetched once per run.
+
+    Args:
+        subscription (str): The subscription ID.
+        resource_group (str): The resource group name.
+        disk_name (str): The name of the disk.
+
+    Returns:
+        Disk: The managed disk model.
+    """
+    def fetch():
+        az_client = CLIENT_REGISTRY.get('compute', subscription)
+        return az_client.disks.get(resource_group, disk_name)
+    return RESOURCE_CACHE.get(resource_id(subscription, resource_group, 'disks', disk_name), fetch)
+
+def iter_csv_rows(csv_file: str):
+    """Yield the rows of a CSV file as dicts keyed by the header, one at a time.
+
+    Like pandas.read_csv(comment='#'), the text after a '#' and blank lines
+    are skipped, and empty cells are read as None.
+
+    Args:
+        csv_file (str): The path to the CSV file.
 
     Raises:
         ValueError: If the CSV file path is not set.
     """
     if csv_file is None:
         raise ValueError("CSV file path is not set. Please check the environment variable 'VM_PROJECT_CSV'.")
-    result = pd.read_csv(csv_file, comment='#', skip_blank_lines=True)
-    return result
+    with open(csv_file, newline='', encoding='utf-8-sig') as f:
+        lines = (line.split('#', 1)[0] for line in f)
+        for row in csv.DictReader(line for line in lines if line.strip()):
+            yield {column: value if value != '' else None for column, value in row.items()}
+
+def read_csv_file(csv_file: str) -> list:
+    """Read a CSV file and return its rows.
+
+    Args:
+        csv_file (str): The path to the CSV file.
+
+    Returns:
+        list: One dict per row, keyed by the CSV header, see iter_csv_rows.
+
+    Raises:
+        ValueError: If the CSV file path is not set.
+    """
+    return list(iter_csv_rows(csv_file))
+
+def format_table(rows: list, columns: list = None) -> str:
+    """Format rows as a text table with a row number column, like a printed DataFrame.
+
+    Args:
+        rows (list): Dicts, one per row.
+        columns (list): The columns to show, by default the keys of the rows in first-seen order.
+
+    Returns:
+        str: The table, one line per row after the header.
+    """
+    if columns is None:
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+    table = [[''] + [str(column) for column in columns]]
+    table.extend([str(index)] + [str(row.get(column)) for column in columns] for index, row in enumerate(rows))
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns) + 1)]
+    return '\n'.join(
+        '  '.join([line[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(line[1:], widths[1:])])
+        for line in table
+    )
+
+# Row keys kept for later steps but not printed, see list_vm_details_graph
+HIDDEN_COLUMNS = ('DiskIds',)
+
+def print_table(rows: list, columns: list = None) -> None:
+    """Print rows as a table, rendered by pandas when it is installed.
+
+    pandas only shows the first and last rows of a long table, without it
+    every row is printed by format_table.
+
+    Args:
+        rows (list): Dicts, one per row.
+        columns (list): The columns to show, by default every key of the rows
+                        but those in HIDDEN_COLUMNS.
+    """
+    if columns is None:
+        columns = [column for column in dict.fromkeys(column for row in rows for column in row) if column not in HIDDEN_COLUMNS]
+    try:
+        import pandas as pd # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print(format_table(rows, columns))
+        return
+    print(pd.DataFrame.from_records(rows, columns=columns))
 
 def format_subscription_name(subscription_name: str) -> str:
     """Retrieve the subscription ID for a given subscription name.
 
     This function checks if the provided subscription name matches any
     existing subscription's display name or ID and returns the corresponding
-    subscription ID.
+    subscription ID. The subscriptions are listed once and cached, see
+    SubscriptionResolver.
 
     Args:
         subscription_name (str): The name or ID of the subscription.
@@ -79,55 +430,132 @@ def format_subscription_name(subscription_name: str) -> str:
     Raises:
         ValueError: If the subscription name or ID is not found.
     """
+    from azure.core.exceptions import HttpResponseError # pylint: disable=import-outside-toplevel
     try:
-        # Get the subscription ID
-        subscription_client = SubscriptionClient(credential)
-        subscription_list = subscription_client.subscriptions.list()
-
-        # Convert the subscription list to a list
-        for subscription_entry in subscription_list:
-            # Check if the subscription name matches the input name
-            if subscription_entry.display_name == subscription_name:
-                return subscription_entry.subscription_id
-            elif subscription_entry.subscription_id == subscription_name:
-                return subscription_entry.subscription_id
-        # If no match is found, raise an error
-        raise ValueError(f"Subscription name or ID '{subscription_name}' not found.")
+        return SUBSCRIPTION_RESOLVER.resolve(subscription_name)
     except HttpResponseError as e:
         print(f"Error retrieving subscription ID for '{subscription_name}': {e}")
         # Log the error details for further analysis
         print(f"Code: {e.error.code}, Message: {e.error.message}")
         raise
 
-def list_vm_details(vm_data: pd.DataFrame) -> pd.DataFrame:
-    """List details of virtual machines from the provided DataFrame.
+def list_vm_details(vm_data: list) -> list:
+    """List details of virtual machines from the provided rows.
 
-    This function iterates over each row in the DataFrame, retrieves
-    the subscription ID, resource group, and VM name, and updates the
-    DataFrame with the OS disk, data disk, and location of each VM.
+    This function iterates over each row, retrieves the subscription ID,
+    resource group, and VM name, and updates the row with the OS disk,
+    data disk, and location of each VM.
 
     Args:
-        vm_data (pd.DataFrame): DataFrame containing VM details.
+        vm_data (list): Rows containing VM details, see read_csv_file.
 
     Returns:
-        pd.DataFrame: Updated DataFrame with additional VM details.
+        list: The same rows with additional VM details.
     """
 
-    for index in vm_data.index:
-        subscription_id = format_subscription_name(
-            vm_data.loc[index]['SubscriptionIdorName']
-        )
-        resource_group = vm_data.loc[index]['ResourceGroupName']
-        vm_name = vm_data.loc[index]['VMName']
+    for row in vm_data:
+        subscription_id = format_subscription_name(row['SubscriptionIdorName'])
+        resource_group = row['ResourceGroupName']
+        vm_name = row['VMName']
 
-        vm_data.loc[index, 'OSDisk'] = find_os_disk(
-            subscription_id, resource_group, vm_name
-        )
-        vm_data.loc[index, 'DataDisk'] = find_data_disk(
-            subscription_id, resource_group, vm_name
+        row['OSDisk'] = find_os_disk(subscription_id, resource_group, vm_name)
+        row['DataDisk'] = find_data_disk(subscription_id, resource_group, vm_name)
+        row['Location'] = find_vm_location(subscription_id, resource_group, vm_name)
+    return vm_data
+
+def query_vm_inventory(subscriptions: list, vm_names: list) -> list:
+    """Query the location and disks of VMs through Azure Resource Graph.
+
+    One paginated query is sent for the given VM names across all given
+    subscriptions, instead of one virtual_machines.get per VM.
+
+    Args:
+        subscriptions (list): The subscription IDs to search.
+        vm_names (list): The VM names to look for.
+
+    Returns:
+        list: One dict per VM with 'subscriptionId', 'resourceGroup', 'name',
+              'location', 'osDisk', 'osDiskId' and 'dataDisks'.
+    """
+    names = ', '.join("'" + name.replace("'", "''") + "'" for name in vm_names)
+    query = (
+        "Resources"
+        " | where type =~ 'microsoft.compute/virtualmachines'"
+        f" | where name in~ ({names})"
+        " | project id, subscriptionId, resourceGroup, name, location,"
+        " osDisk = tostring(properties.storageProfile.osDisk.name),"
+        " osDiskId = tostring(properties.storageProfile.osDisk.managedDisk.id),"
+        " dataDisks = properties.storageProfile.dataDisks"
+    )
+    from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions, ResultFormat # pylint: disable=import-outside-toplevel
+    graph_client = CLIENT_REGISTRY.get('graph')
+    rows = []
+    skip_token = None
+    while True:
+        response = graph_client.resources(QueryRequest(
+            subscriptions=subscriptions,
+            query=query,
+            options=QueryRequestOptions(
+                top=RESOURCE_GRAPH_PAGE_SIZE,
+                skip_token=skip_token,
+                result_format=ResultFormat.OBJECT_ARRAY
+            )
+        ))
+        rows.extend(response.data)
+        skip_token = response.skip_token
+        if not skip_token:
+            return rows
+
+def list_vm_details_graph(vm_data: list) -> list:
+    """List details of virtual machines with a few Resource Graph queries.
+
+    Same columns as list_vm_details, plus 'DataDisks' with every data disk
+    and 'DiskIds' with {disk name: disk ID} of every disk, OS disk first,
+    which vm_snapshot_jobs uses instead of looking the disks up again.
+    The CSV rows are sent in batches of RESOURCE_GRAPH_BATCH_SIZE names and
+    the results are joined back on (subscription, resource group, VM name).
+    VMs missing from Resource Graph are reported and left without details.
+
+    Args:
+        vm_data (list): Rows containing VM details, see read_csv_file.
+
+    Returns:
+        list: The same rows with additional VM details.
+    """
+    keys = [
+        (
+            format_subscription_name(row['SubscriptionIdorName']).lower(),
+            row['ResourceGroupName'].lower(),
+            row['VMName'].lower()
         )
-        vm_data.loc[index, 'Location'] = find_vm_location(
-            subscription_id, resource_group, vm_name
+        for row in vm_data
+    ]
+
+    inventory = {}
+    for start in range(0, len(keys), RESOURCE_GRAPH_BATCH_SIZE):
+        batch = keys[start:start + RESOURCE_GRAPH_BATCH_SIZE]
+        subscriptions = sorted({key[0] for key in batch})
+        vm_names = sorted({key[2] for key in batch})
+        for vm in query_vm_inventory(subscriptions, vm_names):
+            inventory[(vm['subscriptionId'].lower(), vm['resourceGroup'].lower(), vm['name'].lower())] = vm
+
+    for row, key in zip(vm_data, keys):
+        vm = inventory.get(key)
+        if vm is None:
+            print(f"VM {row['VMName']} not found in resource group {row['ResourceGroupName']}")
+            row.update(OSDisk=None, DataDisk=None, Location=None, DataDisks=None, DiskIds=None)
+            continue
+        data_disks = vm.get('dataDisks') or []
+        disk_names = [disk['name'] for disk in data_disks]
+        disk_ids = {vm['osDisk']: vm.get('osDiskId') or None}
+        for disk in data_disks:
+            disk_ids[disk['name']] = (disk.get('managedDisk') or {}).get('id')
+        row.update(
+            OSDisk=vm['osDisk'],
+            DataDisk=disk_names[0] if disk_names else None,
+            Location=vm['location'],
+            DataDisks=','.join(disk_names) or None,
+            DiskIds=disk_ids
         )
     return vm_data
 
@@ -142,9 +570,7 @@ def find_vm_location(subscription: str, resource_group: str, vm_name: str) -> st
     Returns:
         str: The location of the virtual machine.
     """
-
-    az_client = ComputeManagementClient(credential=credential, subscription_id=subscription)
-    vm = az_client.virtual_machines.get(resource_group, vm_name)
+    vm = get_vm(subscription, resource_group, vm_name)
     return vm.location
 
 def find_os_disk(subscription: str, resource_group: str, vm_name: str) -> str:
@@ -158,8 +584,7 @@ def find_os_disk(subscription: str, resource_group: str, vm_name: str) -> str:
     Returns:
         str: The name of the OS disk.
     """
-    az_client = ComputeManagementClient(credential=credential, subscription_id=subscription)
-    vm = az_client.virtual_machines.get(resource_group, vm_name)
+    vm = get_vm(subscription, resource_group, vm_name)
     os_disk_name = vm.storage_profile.os_disk.name
     return os_disk_name
 
@@ -174,8 +599,7 @@ def find_data_disk(subscription: str, resource_group: str, vm_name: str) -> str:
     Returns:
         str: The name of the data disk, or None if no data disk is found.
     """
-    az_client = ComputeManagementClient(credential=credential, subscription_id=subscription)
-    vm = az_client.virtual_machines.get(resource_group, vm_name)
+    vm = get_vm(subscription, resource_group, vm_name)
 
     # check if the data disk is empty
     if vm.storage_profile.data_disks:
@@ -186,49 +610,187 @@ def find_data_disk(subscription: str, resource_group: str, vm_name: str) -> str:
 
     return data_disk_name
 
-def find_disk_id(subscription: str, resource_group: str, disk_name: str) -> str:
-    """Retrieve the ID of a specified disk.
+def find_vm_disks(subscription: str, resource_group: str, vm_name: str) -> list:
+    """Retrieve every disk attached to a virtual machine, OS disk first.
 
     Args:
         subscription (str): The subscription ID.
         resource_group (str): The resource group name.
-        disk_name (str): The name of the disk.
+        vm_name (str): The virtual machine name.
 
     Returns:
-        str: The ID of the disk.
+        list: (disk name, disk ID) of the OS disk and of each data disk.
     """
-    az_client = ComputeManagementClient(credential=credential, subscription_id=subscription)
-    disk = az_client.disks.get(resource_group, disk_name)
-    return disk.id
+    vm = get_vm(subscription, resource_group, vm_name)
+    disks = [vm.storage_profile.os_disk] + list(vm.storage_profile.data_disks or [])
+    return [(disk.name, disk.managed_disk.id) for disk in disks]
 
-def snapshot_disk(subscription: str, resource_group: str, vm_name: str, disk_name: str, location: str) -> None:
-    """Create a snapshot of a specified disk for a virtual machine.
+def find_disk_id(subscription: str, resource_group: str, disk_name: str) -> str:
+    """Retrieve the ID of a specified disk.
 
     Args:
         subscription (str): The subscription ID.
         resource_group (str): The resource group name.
-        vm_name (str): The virtual machine name.
-        disk_name (str): The name of the disk to snapshot.
-        location (str): The location of the virtual machine.
+        disk_name (str): The name of the disk.
 
     Returns:
-        None
+        str: The ID of the disk.
     """
-    snapshot_name = f"{disk_name}-{VM_SNAPSHOT_POSTFIX}"
-    print(f"{f'Create snapshot {snapshot_name} of disk {disk_name} of VM {vm_name} in resource group {resource_group}':=^50s}")
-    az_client = ComputeManagementClient(
-        credential=credential,
-        subscription_id=subscription
-    )
+    return get_disk(subscription, resource_group, disk_name).id
+
+class SnapshotJournal:
+    """Append-only JSON lines log of the snapshot states of a run.
 
+    There is one journal per VM_SNAPSHOT_POSTFIX. A line is appended when a
+    snapshot is started, succeeded, failed or deleted, the last line of a
+    snapshot is its state. A line cut short by a crash is ignored when reading.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(job: dict) -> tuple:
+        """Return the (subscription, resource group, snapshot name) of a snapshot job."""
+        return (job['subscription'].lower(), job['resource_group'].lower(),
+                f"{job['disk_name']}-{VM_SNAPSHOT_POSTFIX}".lower())
+
+    def states(self) -> dict:
+        """Return {key: last recorded state} from the journal file."""
+        states = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    states[(record['subscription'], record['resource_group'], record['snapshot'])] = record['state']
+        except FileNotFoundError:
+            pass
+        return states
+
+    def record(self, job: dict, state: str, error: str = None) -> None:
+        """Append the state ('started', 'succeeded', 'failed' or 'deleted') of a snapshot job."""
+        subscription, resource_group, snapshot = self.key(job)
+        line = json.dumps({
+            'time': datetime.now(timezone.utc).isoformat(),
+            'subscription': subscription,
+            'resource_group': resource_group,
+            'snapshot': snapshot,
+            'vm_name': job['vm_name'],
+            'disk_name': job['disk_name'],
+            'state': state,
+            'error': error,
+        })
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a+', encoding='utf-8')
+                # Do not append to a line cut short by a crash
+                if self.file.tell() > 0:
+                    self.file.seek(self.file.tell() - 1)
+                    if self.file.read(1) != '\n':
+                        self.file.write('\n')
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self) -> None:
+        """Close the journal file."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def find_snapshot_state(subscription: str, resource_group: str, snapshot_name: str) -> str:
+    """Return the provisioning state of a snapshot, or None if it does not exist."""
+    from azure.core.exceptions import ResourceNotFoundError # pylint: disable=import-outside-toplevel
+    az_client = CLIENT_REGISTRY.get('compute', subscription)
+    try:
+        return az_client.snapshots.get(resource_group, snapshot_name).provisioning_state
+    except ResourceNotFoundError:
+        return None
+
+def delete_snapshot(subscription: str, resource_group: str, snapshot_name: str) -> None:
+    """Delete a snapshot and wait until it is gone."""
+    az_client = CLIENT_REGISTRY.get('compute', subscription)
+    az_client.snapshots.begin_delete(resource_group, snapshot_name).result()
+
+def resume_snapshot_jobs(jobs: list, journal: SnapshotJournal) -> list:
+    """Drop the jobs whose snapshot is already done according to the journal or Azure.
+
+    Snapshots recorded as succeeded are skipped without any call. For those
+    recorded as started or failed, the snapshot is looked up (one GET each,
+    several at once) and only created again if it is missing or failed.
+
+    The snapshots of a group (see snapshot_group_jobs) are only consistent if
+    they are taken together, so a group is skipped only if all of its
+    snapshots are done. A group the earlier run left split is taken again as
+    a whole: its done snapshots are deleted first (and journaled as deleted).
+
+    Returns:
+        list: The jobs still to run, in their original order.
+    """
+    states = journal.states()
+    done = {SnapshotJournal.key(job) for job in jobs if states.get(SnapshotJournal.key(job)) == 'succeeded'}
+    unsure = [job for job in jobs if states.get(SnapshotJournal.key(job)) in ('started', 'failed')]
+
+    def check(job):
+        return find_snapshot_state(job['subscription'], job['resource_group'], f"{job['disk_name']}-{VM_SNAPSHOT_POSTFIX}")
+
+    def delete(job):
+        delete_snapshot(job['subscription'], job['resource_group'], f"{job['disk_name']}-{VM_SNAPSHOT_POSTFIX}")
+
+    from concurrent.futures import ThreadPoolExecutor # pylint: disable=import-outside-toplevel
+    found = 0
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_START_WORKERS) as executor:
+        for job, state in zip(unsure, executor.map(check, unsure)):
+            if state is None or state == 'Failed':
+                continue
+            found += 1
+            done.add(SnapshotJournal.key(job))
+            if state == 'Succeeded':
+                journal.record(job, 'succeeded')
+            else:
+                print(f"Snapshot {job['disk_name']}-{VM_SNAPSHOT_POSTFIX} of VM {job['vm_name']} exists ({state}), not created again")
+
+        # Take the groups left split by the earlier run again as a whole
+        groups = {}
+        for job in jobs:
+            if job.get('group') is not None:
+                groups.setdefault(job['group'], []).append(job)
+        stale = []
+        for group, members in groups.items():
+            group_done = [job for job in members if SnapshotJournal.key(job) in done]
+            if 0 < len(group_done) < len(members):
+                print(f"Snapshot group {group} split by the earlier run ({len(group_done)} of {len(members)} disks done), "
+                      f"deleting its snapshots and taking all {len(members)} again")
+                stale.extend(group_done)
+        # A delete cut short by a crash leaves 'started', which the next resume looks up
+        for job in stale:
+            journal.record(job, 'started')
+        list(executor.map(delete, stale))
+        for job in stale:
+            done.discard(SnapshotJournal.key(job))
+            journal.record(job, 'deleted')
+
+    remaining = [job for job in jobs if SnapshotJournal.key(job) not in done]
+    print(f"Resume from {journal.path}: {len(jobs) - len(remaining)} snapshots already done "
+          f"({found} found in Azure), {len(remaining)} to create")
+    return remaining
+
+def snapshot_parameters(location: str, disk_id: str, tags: dict = None):
+    """Return the Snapshot parameters of an incremental, network isolated snapshot of disk_id."""
+    from azure.mgmt.compute.models import Snapshot, DiskCreateOption, CreationData, NetworkAccessPolicy # pylint: disable=import-outside-toplevel
     # https://learn.microsoft.com/en-us/python/api/azure-mgmt-compute/azure.mgmt.compute.v2019_07_01.models.creationdata?view=azure-python
     creation_parameters = CreationData(
         create_option=DiskCreateOption.COPY,
-        source_resource_id=find_disk_id(subscription, resource_group, disk_name)
+        source_resource_id=disk_id
     )
 
-    snapshot_parameters = Snapshot(
+    return Snapshot(
         location=location,
+        tags=tags,
         creation_data=creation_parameters,
         # Disable network access to the snapshot
         # https://learn.microsoft.com/en-us/python/api/azure-mgmt-compute/azure.mgmt.compute.v2020_05_01.models.networkaccesspolicy?view=azure-python
@@ -236,15 +798,320 @@ def snapshot_disk(subscription: str, resource_group: str, vm_name: str, disk_nam
         incremental=True
     )
 
-    do_snapshot = az_client.snapshots.begin_create_or_update(
-        resource_group, snapshot_name, snapshot_parameters
+def begin_snapshot_disk(subscription: str, resource_group: str, disk_name: str, location: str, tags: dict = None, disk_id: str = None):
+    """Start an incremental snapshot of a disk without waiting for it.
+
+    Args:
+        subscription (str): The subscription ID.
+        resource_group (str): The resource group name.
+        disk_name (str): The name of the disk to snapshot.
+        location (str): The location of the virtual machine.
+        tags (dict): Tags of the snapshot.
+        disk_id (str): The ID of the disk when already known, saves looking it up.
+
+    Returns:
+        LROPoller: The poller of the snapshot creation.
+    """
+    snapshot_name = f"{disk_name}-{VM_SNAPSHOT_POSTFIX}"
+    az_client = CLIENT_REGISTRY.get('compute', subscription)
+    return az_client.snapshots.begin_create_or_update(
+        resource_group, snapshot_name,
+        snapshot_parameters(location, disk_id or find_disk_id(subscription, resource_group, disk_name), tags)
     )
+
+def snapshot_disk(subscription: str, resource_group: str, vm_name: str, disk_name: str, location: str) -> None:
+    """Create a snapshot of a specified disk for a virtual machine.
+
+    Args:
+        subscription (str): The subscription ID.
+        resource_group (str): The resource group name.
+        vm_name (str): The virtual machine name.
+        disk_name (str): The name of the disk to snapshot.
+        location (str): The location of the virtual machine.
+
+    Returns:
+        None
+    """
+    snapshot_name = f"{disk_name}-{VM_SNAPSHOT_POSTFIX}"
+    print(f"{f'Create snapshot {snapshot_name} of disk {disk_name} of VM {vm_name} in resource group {resource_group}':=^50s}")
+    do_snapshot = begin_snapshot_disk(subscription, resource_group, disk_name, location)
     do_snapshot.wait()
     print(f"{f'Snapshot {snapshot_name} of disk {disk_name} of VM {vm_name} in resource group {resource_group} created':=^50s}")
 
+def snapshot_disks(jobs: list, max_per_subscription: int, max_per_region: int, journal: SnapshotJournal = None) -> list:
+    """Snapshot many disks at once, with a limit per subscription and per region.
+
+    Every snapshot is started as soon as its subscription and region have a free
+    slot, the pollers are then checked together, so the run takes about as long
+    as the slowest snapshots instead of their sum. A line with the completed,
+    running and failed counts is printed whenever one of them changes.
+
+    Jobs sharing a 'group' (the disks of one VM) are started together, their
+    create requests are sent in parallel once the slots of the whole group are
+    free. A group larger than a limit still runs, alone.
+
+    Args:
+        jobs (list): Dicts with 'subscription', 'resource_group', 'vm_name', 'disk_name' and 'location',
+                     optionally 'disk_id', 'tags' and 'group'.
+        max_per_subscription (int): Snapshots running at once in one subscription.
+        max_per_region (int): Snapshots running at once in one region of a subscription.
+        journal (SnapshotJournal): Where the state of each snapshot is recorded.
+
+    Returns:
+        list: The jobs with 'snapshot_name', 'state' ('Succeeded' or 'Failed'), 'error', 'seconds'
+              and 'time_created' added.
+    """
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor
+    from azure.core.exceptions import AzureError
+
+    pending = []
+    for job in jobs:
+        if job.get('group') is not None and pending and pending[-1][0].get('group') == job['group']:
+            pending[-1].append(job)
+        else:
+            pending.append([job])
+    running = []
+    finished = []
+    per_subscription = {}
+    per_region = {}
+    # (subscription, region) each started job holds a slot of, as taken for its group
+    slots = {}
+    last_summary = None
+
+    def start(job):
+        job['snapshot_name'] = f"{job['disk_name']}-{VM_SNAPSHOT_POSTFIX}"
+        job['started'] = time.monotonic()
+        if journal:
+            journal.record(job, 'started')
+        return begin_snapshot_disk(job['subscription'], job['resource_group'], job['disk_name'], job['location'],
+                                   tags=job.get('tags'), disk_id=job.get('disk_id'))
+
+    def fits(count, size, limit):
+        return count + size <= limit or count == 0
+
+    def release(job):
+        subscription, region = slots.pop(id(job))
+        per_subscription[subscription] -= 1
+        per_region[region] -= 1
+
+    workers = max([SNAPSHOT_START_WORKERS] + [len(group) for group in pending])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # Start every pending snapshot (group) that fits into the limits
+            startable = []
+            waiting = []
+            for group in pending:
+                subscription = group[0]['subscription']
+                region = (subscription, group[0]['location'])
+                if not fits(per_subscription.get(subscription, 0), len(group), max_per_subscription) or \
+                        not fits(per_region.get(region, 0), len(group), max_per_region):
+                    waiting.append(group)
+                    continue
+                per_subscription[subscription] = per_subscription.get(subscription, 0) + len(group)
+                per_region[region] = per_region.get(region, 0) + len(group)
+                for job in group:
+                    slots[id(job)] = (subscription, region)
+                startable.extend(group)
+            pending = waiting
+            for job, future in [(job, executor.submit(start, job)) for job in startable]:
+                try:
+                    running.append((job, future.result()))
+                except AzureError as e:
+                    job.update(state='Failed', error=str(e.message), seconds=time.monotonic() - job['started'])
+                    if journal:
+                        journal.record(job, 'failed', job['error'])
+                    release(job)
+                    finished.append(job)
+                    print(f"Failed to start snapshot {job['snapshot_name']} of VM {job['vm_name']}: {e.message}")
+
+            # Collect the finished pollers
+            still_running = []
+            for job, poller in running:
+                if not poller.done():
+                    still_running.append((job, poller))
+                    continue
+                try:
+                    snapshot = poller.result()
+                    job.update(state='Succeeded', error=None, time_created=snapshot.time_created)
+                    print(f"Snapshot {job['snapshot_name']} of disk {job['disk_name']} of VM {job['vm_name']} created")
+                except AzureError as e:
+                    job.update(state='Failed', error=str(e.message))
+                    print(f"Snapshot {job['snapshot_name']} of VM {job['vm_name']} failed: {e.message}")
+                job['seconds'] = time.monotonic() - job['started']
+                if journal:
+                    journal.record(job, job['state'].lower(), job['error'])
+                release(job)
+                finished.append(job)
+            running = still_running
+
+            failed = sum(1 for job in finished if job['state'] == 'Failed')
+            summary = (len(finished) - failed, len(running), failed, sum(len(group) for group in pending))
+            if summary != last_summary:
+                print(f"Snapshots: {summary[0]} completed, {summary[1]} running, {summary[2]} failed, {summary[3]} pending")
+                last_summary = summary
+            if running and not any(poller.done() for _, poller in running):
+                time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+    return finished
+
+def snapshot_group_jobs(subscription: str, resource_group: str, vm_name: str, location: str, disks: list = None) -> list:
+    """Build the snapshot jobs of every disk of a VM as one crash-consistent group.
+
+    The group is keyed by subscription, resource group and VM name, so VMs
+    of the same name elsewhere form groups of their own. All snapshots of the
+    group carry the same SnapshotGroup and SnapshotGroupTime tags, so they
+    can be found and restored together.
+
+    Args:
+        disks (list): (disk name, disk ID) of every disk of the VM, OS disk first,
+                      looked up with find_vm_disks when not given.
+
+    Returns:
+        list: The jobs for snapshot_disks.
+    """
+    group = f"{subscription}/{resource_group}/{vm_name}"
+    tags = {
+        'SnapshotGroup': f"{group}/{VM_SNAPSHOT_POSTFIX}",
+        'SnapshotGroupTime': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'SnapshotGroupVM': vm_name,
+    }
+    return [
+        {
+            'subscription': subscription,
+            'resource_group': resource_group,
+            'vm_name': vm_name,
+            'location': location,
+            'disk_name': disk_name,
+            'disk_id': disk_id,
+            'tags': tags,
+            'group': group,
+        }
+        for disk_name, disk_id in disks or find_vm_disks(subscription, resource_group, vm_name)
+    ]
+
+def vm_snapshot_jobs(vm_data: list, group: bool = False) -> list:
+    """Build the snapshot jobs of the rows of list_vm_details or list_vm_details_graph.
+
+    Without group, the OS disk and the first data disk of each VM are
+    snapshotted, with group every disk of the VM, see snapshot_group_jobs.
+    The disk IDs found by list_vm_details_graph are set on the jobs, so no
+    VM or disk is fetched again, otherwise they are looked up when needed.
+    Rows without an OS disk (VMs Resource Graph did not find) are skipped.
+
+    Args:
+        vm_data (list): Rows with VM details.
+        group (bool): Snapshot every disk of a VM together.
+
+    Returns:
+        list: The jobs for snapshot_disks.
+    """
+    jobs = []
+    for row in vm_data:
+        if not row['OSDisk']:
+            continue
+        job = {
+            'subscription': format_subscription_name(row['SubscriptionIdorName']),
+            'resource_group': row['ResourceGroupName'],
+            'vm_name': row['VMName'],
+            'location': row['Location'],
+        }
+        disk_ids = row.get('DiskIds') or {}
+
+        # Snapshot every disk of the VM together
+        if group:
+            jobs.extend(snapshot_group_jobs(**job, disks=list(disk_ids.items()) if disk_ids else None))
+            continue
+
+        # Snapshot the OS disk and the data disk
+        for disk_name in (row['OSDisk'], row['DataDisk']):
+            if disk_name:
+                jobs.append(dict(job, disk_name=disk_name, disk_id=disk_ids.get(disk_name)))
+    return jobs
+
+def snapshot_group_skew(results: list) -> dict:
+    """Return {group: seconds between the earliest and latest snapshot of the group}.
+
+    Groups with a failed snapshot are left out.
+    """
+    created = {}
+    failed = set()
+    for job in results:
+        if job.get('group') is None:
+            continue
+        if job['state'] != 'Succeeded' or job.get('time_created') is None:
+            failed.add(job['group'])
+            continue
+        created.setdefault(job['group'], []).append(job['time_created'])
+    return {
+        group: (max(times) - min(times)).total_seconds()
+        for group, times in created.items() if group not in failed
+    }
+
+class VaultIndex:
+    """Names of the VMs protected by each Recovery Services vault.
+
+    The protected items of a vault are paged through once per run, every
+    following check of that vault is a set lookup.
+    """
+    def __init__(self):
+        self.vaults = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, vault: tuple) -> set:
+        """Page through the protected items of vault (subscription, resource group, name)."""
+        vault_subscription, vault_resource_group, vault_name = vault
+        backup_client = CLIENT_REGISTRY.get('backup', vault_subscription)
+        backup_items = backup_client.backup_protected_items.list(
+            resource_group_name=vault_resource_group,
+            vault_name=vault_name
+        )
+        protected_vms = set()
+        for backup_item in backup_items:
+            # VM;iaasvmcontainerv2;<resource group>;<vm name>
+            backup_item_details = backup_item.name.split(';')
+            if len(backup_item_details) > 3:
+                protected_vms.add(backup_item_details[3].lower())
+        if not protected_vms:
+            print(f"No protected VM found in {vault_name} in resource group {vault_resource_group}")
+        return protected_vms
+
+    def load(self, vaults: list, workers: int = VAULT_FETCH_WORKERS) -> None:
+        """Fetch the vaults not indexed yet, several at once."""
+        with self.lock:
+            missing = [vault for vault in dict.fromkeys(vaults) if vault not in self.vaults]
+        if not missing:
+            return
+        from concurrent.futures import ThreadPoolExecutor # pylint: disable=import-outside-toplevel
+        with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            for vault, protected_vms in zip(missing, executor.map(self.fetch, missing)):
+                with self.lock:
+                    self.vaults[vault] = protected_vms
+
+    def is_protected(self, vault: tuple, vm_name: str) -> bool:
+        """Return True if vm_name is a protected item of vault."""
+        self.load([vault])
+        return vm_name.lower() in self.vaults[vault]
+
+VAULT_INDEX = VaultIndex()
+
+def configured_vaults() -> list:
+    """Return the (subscription ID, resource group, vault name) of each vault in VAULTS."""
+    vaults = []
+    for entry in VAULTS.split(','):
+        if not entry.strip():
+            continue
+        parts = [part.strip() for part in entry.split('/')]
+        if len(parts) != 3:
+            raise ValueError(f"Invalid VAULTS entry '{entry}', expected subscription/resource-group/vault")
+        vaults.append((format_subscription_name(parts[0]), parts[1], parts[2]))
+    return vaults
+
 def backup_protection_check_vm(vault_subscription: str, vault_resource_group: str, vault_name: str, vm_name: str) -> bool:
     """Check if the VM has backup protection enabled.
 
+    The vault is listed once per run, see VaultIndex.
+
     Args:
         vault_subscription (str): The subscription ID of the backup vault.
         vault_resource_group (str): The resource group name of the backup vault.
@@ -254,59 +1121,268 @@ def backup_protection_check_vm(vault_subscription: str, vault_resource_group: st
     Returns:
         bool: True if the VM has backup protection enabled, False otherwise.
     """
+    from azure.core.exceptions import ResourceNotFoundError # pylint: disable=import-outside-toplevel
     try:
-        backup_client = RecoveryServicesBackupClient(
-            credential=credential,
-            subscription_id=vault_subscription
-        )
-        backup_items = backup_client.backup_protected_items.list(
-            resource_group_name=vault_resource_group,
-            vault_name=vault_name
-        )
-
-        if not backup_items:
-            print(f"No backup vault found for {vault_name} in resource group {vault_resource_group}")
-            return False
-
-        for backup_item in backup_items:
-            backup_item_details = backup_item.name.split(';')
-            if vm_name == backup_item_details[3]:
-                return True
-        return False
-
+        return VAULT_INDEX.is_protected((vault_subscription, vault_resource_group, vault_name), vm_name)
     except ResourceNotFoundError as e:
         print(f"Resource not found: {e.message}")
         sys.exit(1)
 
-def list_backup_vm_details(vm_data: pd.DataFrame) -> pd.DataFrame:
-    """List details of virtual machines from the provided DataFrame.
+def backup_vaults_of_rows(vm_data: list) -> list:
+    """Return [(subscription ID, resource group, vault name), ...] of the vaults to check, per row."""
+    shared_vaults = configured_vaults()
+    return [
+        shared_vaults or [(format_subscription_name(row['SubscriptionIdorName']), VAULT_RESOURCE_GROUP_NAME, VAULT_NAME)]
+        for row in vm_data
+    ]
+
+def list_backup_vm_details(vm_data: list) -> list:
+    """List the backup protection of virtual machines from the provided rows.
 
-    This function iterates over each row in the DataFrame, retrieves
-    the subscription ID, resource group, and VM name, and updates the
-    DataFrame with the OS disk, data disk, and location of each VM.
+    This function iterates over each row, retrieves the subscription ID,
+    resource group, and VM name, and updates the row with whether the
+    VM is protected. The VM is looked up in
+    every vault of VAULTS if set, otherwise in VAULT_NAME of the VM's
+    subscription. All vaults are listed once, concurrently, before the
+    rows are checked.
 
     Args:
-        vm_data (pd.DataFrame): DataFrame containing VM details.
+        vm_data (list): Rows containing VM details, see read_csv_file.
 
     Returns:
-        pd.DataFrame: Updated DataFrame with additional VM details.
+        list: The same rows with additional VM details.
     """
+    from azure.core.exceptions import ResourceNotFoundError # pylint: disable=import-outside-toplevel
+    row_vaults = backup_vaults_of_rows(vm_data)
 
-    for index in vm_data.index:
-        subscription_id = format_subscription_name(
-            vm_data.loc[index]['SubscriptionIdorName']
-        )
-        resource_group = vm_data.loc[index]['ResourceGroupName']
-        vm_name = vm_data.loc[index]['VMName']
+    try:
+        VAULT_INDEX.load([vault for vaults in row_vaults for vault in vaults])
+    except ResourceNotFoundError as e:
+        print(f"Resource not found: {e.message}")
+        sys.exit(1)
 
-        vm_data.loc[index, 'BackupProtection'] = backup_protection_check_vm(
-            subscription_id, VAULT_RESOURCE_GROUP_NAME, VAULT_NAME, vm_name
+    for row, vaults in zip(vm_data, row_vaults):
+        row['BackupProtection'] = any(
+            backup_protection_check_vm(*vault, row['VMName']) for vault in vaults
         )
 
     return vm_data
 
 
 
+class AsyncEngine:
+    """Run the ARM calls of --check, --snapshot and --check-backup on asyncio.
+
+    Uses the aio clients of the SDK and azure.identity.aio, sharing one aiohttp
+    session. At most `concurrency` ARM requests are in flight at once, plus
+    at most `concurrency` snapshot pollers polling their operation. VM models
+    and vault indexes are prefetched into RESOURCE_CACHE and VAULT_INDEX, so the
+    rows are then filled by the same code as without the engine.
+    """
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.requests = None
+        self.polls = None
+        self.session = None
+        self.credential = None
+        self.clients = {}
+        self.modules = {}
+        self.journal = None
+
+    async def __aenter__(self):
+        try:
+            import aiohttp # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise RuntimeError("--async needs aiohttp, please run: pip install aiohttp") from e
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        from azure.core.pipeline.transport import AioHttpTransport
+        from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+        from azure.mgmt.compute.aio import ComputeManagementClient as AsyncComputeManagementClient
+        from azure.mgmt.recoveryservicesbackup.aio import RecoveryServicesBackupClient as AsyncRecoveryServicesBackupClient
+        self.modules = {
+            'transport': AioHttpTransport,
+            'compute': AsyncComputeManagementClient,
+            'backup': AsyncRecoveryServicesBackupClient,
+        }
+        self.requests = asyncio.Semaphore(self.concurrency)
+        self.polls = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        self.credential = AsyncDefaultAzureCredential()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for client in self.clients.values():
+            await client.close()
+        await self.credential.close()
+        await self.session.close()
+
+    def client(self, kind: str, subscription: str):
+        """Return the shared aio client of kind ('compute' or 'backup') for subscription."""
+        key = (kind, subscription)
+        if key not in self.clients:
+            self.clients[key] = self.modules[kind](
+                credential=self.credential,
+                subscription_id=subscription,
+                transport=self.modules['transport'](session=self.session, session_owner=False)
+            )
+        return self.clients[key]
+
+    async def fetch_vm(self, subscription: str, resource_group: str, vm_name: str) -> None:
+        """Fetch one VM model into RESOURCE_CACHE."""
+        async with self.requests:
+            vm = await self.client('compute', subscription).virtual_machines.get(resource_group, vm_name)
+        RESOURCE_CACHE.put(resource_id(subscription, resource_group, 'virtualMachines', vm_name), vm)
+
+    async def prefetch_vms(self, vm_data: list) -> None:
+        """Fetch the models of every VM of the rows of vm_data not cached yet."""
+        import asyncio # pylint: disable=import-outside-toplevel
+        keys = {}
+        for row in vm_data:
+            subscription_id = format_subscription_name(row['SubscriptionIdorName'])
+            key = (subscription_id, row['ResourceGroupName'], row['VMName'])
+            if resource_id(key[0], key[1], 'virtualMachines', key[2]).lower() not in RESOURCE_CACHE.models:
+                keys[tuple(part.lower() for part in key)] = key
+        await asyncio.gather(*(self.fetch_vm(*key) for key in keys.values()))
+
+    async def fetch_vault(self, vault: tuple) -> None:
+        """Page through the protected items of one vault into VAULT_INDEX."""
+        vault_subscription, vault_resource_group, vault_name = vault
+        backup_items = self.client('backup', vault_subscription).backup_protected_items.list(
+            resource_group_name=vault_resource_group,
+            vault_name=vault_name
+        )
+        protected_vms = set()
+        async with self.requests:
+            async for backup_item in backup_items:
+                backup_item_details = backup_item.name.split(';')
+                if len(backup_item_details) > 3:
+                    protected_vms.add(backup_item_details[3].lower())
+        if not protected_vms:
+            print(f"No protected VM found in {vault_name} in resource group {vault_resource_group}")
+        with VAULT_INDEX.lock:
+            VAULT_INDEX.vaults[vault] = protected_vms
+
+    async def prefetch_vaults(self, vm_data: list) -> None:
+        """Index every vault checked for the rows of vm_data.
+
+        Like list_backup_vm_details, exits when a vault does not exist.
+        """
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        from azure.core.exceptions import ResourceNotFoundError
+        vaults = {vault for vaults in backup_vaults_of_rows(vm_data) for vault in vaults}
+        # Let every fetch finish before the session is closed
+        results = await asyncio.gather(*(self.fetch_vault(vault) for vault in vaults if vault not in VAULT_INDEX.vaults),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors:
+            if isinstance(error, ResourceNotFoundError):
+                print(f"Resource not found: {error.message}")
+                sys.exit(1)
+        if errors:
+            raise errors[0]
+
+    async def begin_snapshot_disk(self, job: dict):
+        """Send the create request of the snapshot of one job and return its poller."""
+        job['snapshot_name'] = f"{job['disk_name']}-{VM_SNAPSHOT_POSTFIX}"
+        job['started'] = time.monotonic()
+        if self.journal:
+            self.journal.record(job, 'started')
+        compute_client = self.client('compute', job['subscription'])
+        disk_id = job.get('disk_id')
+        if not disk_id:
+            disk = await compute_client.disks.get(job['resource_group'], job['disk_name'])
+            disk_id = disk.id
+        return await compute_client.snapshots.begin_create_or_update(
+            job['resource_group'], job['snapshot_name'],
+            snapshot_parameters(job['location'], disk_id, job.get('tags'))
+        )
+
+    async def snapshot_group(self, group: list) -> None:
+        """Create the snapshots of a group of jobs, see snapshot_disks for the job keys.
+
+        The create requests of the group share one request slot and are sent
+        together. The pollers then wait for a polling slot instead, so long
+        snapshots do not hold back the create requests of other groups. A
+        snapshot keeps running in Azure while its poller waits.
+        """
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        from azure.core.exceptions import AzureError
+        async with self.requests:
+            pollers = await asyncio.gather(*(self.begin_snapshot_disk(job) for job in group), return_exceptions=True)
+        for job, poller in zip(group, pollers):
+            try:
+                if isinstance(poller, BaseException):
+                    raise poller
+                async with self.polls:
+                    snapshot = await poller.result()
+                job.update(state='Succeeded', error=None, time_created=snapshot.time_created)
+                print(f"Snapshot {job['snapshot_name']} of disk {job['disk_name']} of VM {job['vm_name']} created")
+            except AzureError as e:
+                job.update(state='Failed', error=str(e.message))
+                print(f"Snapshot {job['snapshot_name']} of VM {job['vm_name']} failed: {e.message}")
+            job['seconds'] = time.monotonic() - job['started']
+            if self.journal:
+                self.journal.record(job, job['state'].lower(), job['error'])
+
+    async def snapshot_disks(self, jobs: list, max_per_subscription: int, max_per_region: int, journal: SnapshotJournal = None) -> list:
+        """Asyncio version of snapshot_disks, with the same limits, groups, journal and result."""
+        import asyncio # pylint: disable=import-outside-toplevel
+        self.journal = journal
+        groups = []
+        for job in jobs:
+            if job.get('group') is not None and groups and groups[-1][0].get('group') == job['group']:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        slots = asyncio.Condition()
+        per_subscription = {}
+        per_region = {}
+        counts = {'completed': 0, 'running': 0, 'failed': 0, 'pending': len(jobs)}
+
+        def fits(subscription, region, size):
+            return (per_subscription.get(subscription, 0) + size <= max_per_subscription or per_subscription.get(subscription, 0) == 0) and \
+                (per_region.get(region, 0) + size <= max_per_region or per_region.get(region, 0) == 0)
+
+        def print_summary():
+            print(f"Snapshots: {counts['completed']} completed, {counts['running']} running, {counts['failed']} failed, {counts['pending']} pending")
+
+        async def run_group(group):
+            subscription = group[0]['subscription']
+            region = (subscription, group[0]['location'])
+            async with slots:
+                await slots.wait_for(lambda: fits(subscription, region, len(group)))
+                per_subscription[subscription] = per_subscription.get(subscription, 0) + len(group)
+                per_region[region] = per_region.get(region, 0) + len(group)
+                counts['pending'] -= len(group)
+                counts['running'] += len(group)
+            await self.snapshot_group(group)
+            async with slots:
+                per_subscription[subscription] -= len(group)
+                per_region[region] -= len(group)
+                counts['running'] -= len(group)
+                for job in group:
+                    counts['failed' if job['state'] == 'Failed' else 'completed'] += 1
+                print_summary()
+                slots.notify_all()
+
+        await asyncio.gather(*(run_group(group) for group in groups))
+        return jobs
+
+def run_async(concurrency: int, action):
+    """Run action(engine) on a new AsyncEngine and return its result."""
+    import asyncio # pylint: disable=import-outside-toplevel
+    async def runner():
+        async with AsyncEngine(concurrency) as engine:
+            return await action(engine)
+    try:
+        return asyncio.run(runner())
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
 def backup_protection_enable_vm(vault_subscription: str, vault_resource_group: str, vault_name: str, vm_name: str) -> None:
     """
     Enable backup protection for a VM.
@@ -325,6 +1401,8 @@ def backup_protection_enable_vm(vault_subscription: str, vault_resource_group: s
 def main() -> None:
     """Parse command-line arguments and execute the appropriate VM maintenance action."""
 
+    load_config()
+
     parser = argparse.ArgumentParser(
         description="Azure VM Maintenance",
         epilog="Example: az-vm-matinenance.py --check")
@@ -347,41 +1425,93 @@ def main() -> None:
         action="store_true",
         help="Check if the VM has backup protection enabled"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --snapshot, skip the snapshots the journal of VM_SNAPSHOT_POSTFIX records as done"
+    )
+    parser.add_argument(
+        "--resource-graph",
+        action="store_true",
+        help="With --check/--snapshot, read the VM details from Azure Resource Graph in bulk"
+    )
+    parser.add_argument(
+        "--group",
+        action="store_true",
+        help="With --snapshot, snapshot all disks of each VM together as one crash-consistent group"
+    )
+    parser.add_argument(
+        "--max-per-subscription",
+        type=int,
+        default=SNAPSHOT_MAX_PER_SUBSCRIPTION,
+        help=f"Snapshots running at once per subscription (default: {SNAPSHOT_MAX_PER_SUBSCRIPTION})"
+    )
+    parser.add_argument(
+        "--max-per-region",
+        type=int,
+        default=SNAPSHOT_MAX_PER_REGION,
+        help=f"Snapshots running at once per region of a subscription (default: {SNAPSHOT_MAX_PER_REGION})"
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run the ARM calls of --check/--snapshot/--check-backup on asyncio"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=ASYNC_CONCURRENCY,
+        help=f"With --async, ARM requests in flight at once (default: {ASYNC_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--refresh-subscriptions",
+        action="store_true",
+        help="Ignore the cached subscription list and list the subscriptions again"
+    )
 
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
     args = parser.parse_args()
 
+    if args.refresh_subscriptions:
+        SUBSCRIPTION_RESOLVER.refresh()
+
     if args.show_csv:
         #
-        # Read CSV file
+        # Read CSV file, without pandas or the Azure SDK
         #
-        pd_data = read_csv_file(VM_PROJECT_CSV)
+        vm_data = read_csv_file(VM_PROJECT_CSV)
+        print(format_table(vm_data))
 
     if args.check:
         #
         # Read CSV file
         #
-        pd_data = read_csv_file(VM_PROJECT_CSV)
+        vm_data = read_csv_file(VM_PROJECT_CSV)
 
         #
         # List VM details
         #
-        pd_data = list_vm_details(pd_data)
-        print(pd_data)
+        if args.use_async and not args.resource_graph:
+            run_async(args.concurrency, lambda engine: engine.prefetch_vms(vm_data))
+        vm_data = list_vm_details_graph(vm_data) if args.resource_graph else list_vm_details(vm_data)
+        print_table(vm_data)
 
     if args.snapshot:
         #
         # Read CSV file
         #
-        pd_data = read_csv_file(VM_PROJECT_CSV)
+        vm_data = read_csv_file(VM_PROJECT_CSV)
 
         #
         # List VM details
         #
-        pd_data = list_vm_details(pd_data)
-        print(pd_data)
+        if args.use_async and not args.resource_graph:
+            run_async(args.concurrency, lambda engine: engine.prefetch_vms(vm_data))
+        vm_data = list_vm_details_graph(vm_data) if args.resource_graph else list_vm_details(vm_data)
+        print_table(vm_data)
 
         #
         # Ask for confirmation
@@ -392,40 +1522,60 @@ def main() -> None:
             sys.exit(1)
 
         #
-        # Snapshot the disk of each VM
+        # Snapshot the disks of all VMs at once
         #
-        for index in pd_data.index:
-            #
-            # Get the subscription ID, resource group, VM name, OS disk, and location
-            #
-            subscription_id = format_subscription_name(
-                pd_data.loc[index]['SubscriptionIdorName']
-            )
-            resource_group = pd_data.loc[index]['ResourceGroupName']
-            vm_name = pd_data.loc[index]['VMName']
-            os_disk = pd_data.loc[index]['OSDisk']
-            location = pd_data.loc[index]['Location']
+        snapshot_jobs = vm_snapshot_jobs(vm_data, args.group)
 
-            # Snapshot the OS disk
-            snapshot_disk(subscription_id, resource_group, vm_name, os_disk, location)
-
-            # Snapshot the data disk
-            if pd_data.loc[index]['DataDisk']:
-                data_disk = pd_data.loc[index]['DataDisk']
-                snapshot_disk(subscription_id, resource_group, vm_name, data_disk, location)
+        #
+        # Skip what an earlier run of the same VM_SNAPSHOT_POSTFIX has done
+        #
+        journal = SnapshotJournal(SNAPSHOT_JOURNAL)
+        if args.resume:
+            snapshot_jobs = resume_snapshot_jobs(snapshot_jobs, journal)
+        elif journal.states():
+            print(f"Journal {SNAPSHOT_JOURNAL} of an earlier run exists, use --resume to skip its completed snapshots")
+
+        started = time.monotonic()
+        if args.use_async:
+            snapshot_results = run_async(args.concurrency, lambda engine: engine.snapshot_disks(
+                snapshot_jobs, args.max_per_subscription, args.max_per_region, journal))
+        else:
+            snapshot_results = snapshot_disks(snapshot_jobs, args.max_per_subscription, args.max_per_region, journal)
+        journal.close()
+        failed_jobs = [job for job in snapshot_results if job['state'] == 'Failed']
+        slowest = max((job['seconds'] for job in snapshot_results), default=0)
+        print(f"{len(snapshot_results)} snapshots in {time.monotonic() - started:.1f}s (slowest single snapshot {slowest:.1f}s)")
+        for job in failed_jobs:
+            print(f"Failed: {job['snapshot_name']} of VM {job['vm_name']} in resource group {job['resource_group']}: {job['error']}")
+        if args.group:
+            group_skew = snapshot_group_skew(snapshot_results)
+            for group, skew in sorted(group_skew.items()):
+                print(f"Snapshot group {group}: {sum(1 for job in snapshot_results if job['group'] == group)} disks, skew {skew:.1f}s")
+            if group_skew:
+                print(f"Largest skew between the disks of one VM: {max(group_skew.values()):.1f}s")
 
     if args.check_backup:
 
         #
         # Read CSV file
         #
-        pd_data = read_csv_file(VM_PROJECT_CSV)
+        vm_data = read_csv_file(VM_PROJECT_CSV)
 
         #
         # List VM details
         #
-        pd_data = list_backup_vm_details(pd_data)
-        print(pd_data)
+        if args.use_async:
+            run_async(args.concurrency, lambda engine: engine.prefetch_vaults(vm_data))
+        vm_data = list_backup_vm_details(vm_data)
+        print_table(vm_data)
+
+    if args.check or args.snapshot or args.check_backup:
+        print(RESOURCE_CACHE.summary())
+        if CLIENT_REGISTRY.requested:
+            print(CLIENT_REGISTRY.summary())
+
+    if args.snapshot and failed_jobs:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,308 @@
+"""A local HTTPS mock of the ARM endpoints used by az-vm-maintenance.py.
+
+Serves subscriptions, VMs, disks, snapshots (created through a long-running
+operation that completes after `snapshot_seconds`), Recovery Services
+protected items and Resource Graph queries. Every VM name exists in every
+subscription and resource group, with `<digits> % 3` data disks. The server
+counts the requests of each kind and the most requests of a kind (and of all
+kinds) it handled at once, see MockArm.stats.
+
+Used by tests/test_async_engine.py.
+"""
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import os
+import re
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from recorded_arm import FakeCredential
+
+
+def write_certificate(directory):
+    """Write a self-signed certificate of 127.0.0.1 and its key, return their paths."""
+    # pylint: disable=import-outside-toplevel
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5)).not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    with open(cert_file, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_file, key_file
+
+
+def vm_model(subscription, resource_group, name):
+    """Return the VirtualMachine JSON of a VM, its data disks follow from the digits of its name."""
+    number = int(re.sub(r'\D', '', name) or 0)
+    base = f"/subscriptions/{subscription}/resourceGroups/{resource_group}/providers/Microsoft.Compute"
+    data_disks = [{'lun': lun, 'name': f"datadisk-{name}-{lun}", 'createOption': 'Attach',
+                   'managedDisk': {'id': f"{base}/disks/datadisk-{name}-{lun}"}} for lun in range(number % 3)]
+    return {
+        'id': f"{base}/virtualMachines/{name}", 'name': name, 'type': 'Microsoft.Compute/virtualMachines',
+        'location': 'eastus2' if number % 2 else 'japaneast',
+        'properties': {'storageProfile': {
+            'osDisk': {'name': f"osdisk-{name}", 'createOption': 'FromImage', 'osType': 'Linux',
+                       'managedDisk': {'id': f"{base}/disks/osdisk-{name}"}},
+            'dataDisks': data_disks,
+        }},
+    }
+
+
+class MockArm:
+    """Run the mock on a free port of 127.0.0.1 in a background thread.
+
+    Args:
+        subscriptions (dict): {display name: subscription ID}.
+        delay (float): Seconds each request takes.
+        snapshot_seconds (float): Seconds until a snapshot is created.
+        retry_after (int): Retry-After of a running snapshot operation, None to leave it to the client.
+        backup_items (int): Protected VMs of every vault, vm-case1, vm-case3, ...
+    """
+    def __init__(self, subscriptions, delay=0.02, snapshot_seconds=0.5, retry_after=1, backup_items=400):
+        self.subscriptions = subscriptions
+        self.delay = delay
+        self.snapshot_seconds = snapshot_seconds
+        self.retry_after = retry_after
+        self.backup_items = backup_items
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.active = collections.Counter()
+        self.most_active = collections.Counter()
+        self.snapshots = {}
+        self.operations = {}
+        self.directory = tempfile.TemporaryDirectory()
+        self.cert_file, key_file = write_certificate(self.directory.name)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, self))
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_file, key_file)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.url = f"https://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def stats(self):
+        """Return {kind: requests} and {'most active <kind>': requests at once}, '*' for all kinds."""
+        with self.lock:
+            result = dict(self.counts)
+            result.update((f"most active {kind}", count) for kind, count in self.most_active.items())
+        return result
+
+    def reset(self):
+        """Forget the counters."""
+        with self.lock:
+            self.counts.clear()
+            self.most_active.clear()
+
+    @contextlib.contextmanager
+    def request(self, kind):
+        """Count a request of kind while it is handled."""
+        with self.lock:
+            self.counts[kind] += 1
+            for key in (kind, '*'):
+                self.active[key] += 1
+                self.most_active[key] = max(self.most_active[key], self.active[key])
+        try:
+            time.sleep(self.delay)
+            yield
+        finally:
+            with self.lock:
+                self.active[kind] -= 1
+                self.active['*'] -= 1
+
+    def patch(self, module, monkeypatch, polling_interval=None):
+        """Send the management clients of module, sync and async, to the mock.
+
+        Args:
+            polling_interval (float): Seconds between the polls of an operation
+                without Retry-After, instead of the SDK default.
+        """
+        import requests # pylint: disable=import-outside-toplevel
+        registry = module.ClientRegistry(module.HTTP_POOL_SIZE)
+        registry.credential = FakeCredential()
+        registry.session = requests.Session()
+        registry.adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=registry.pool_size)
+        registry.session.mount('https://', registry.adapter)
+        monkeypatch.setattr(module, 'CLIENT_REGISTRY', registry)
+
+        monkeypatch.setenv('REQUESTS_CA_BUNDLE', self.cert_file)
+        client_options = {'base_url': self.url}
+        if polling_interval is not None:
+            client_options['polling_interval'] = polling_interval
+        sdk_client_class = module.sdk_client_class
+        monkeypatch.setattr(module, 'sdk_client_class', lambda kind: functools.partial(sdk_client_class(kind), **client_options))
+
+        enter = module.AsyncEngine.__aenter__
+
+        async def __aenter__(engine):
+            await enter(engine)
+            await engine.credential.close()
+            engine.credential = AsyncFakeCredential()
+            for kind in ('compute', 'backup'):
+                engine.modules[kind] = functools.partial(engine.modules[kind], **client_options)
+            engine.modules['transport'] = functools.partial(engine.modules['transport'], connection_verify=self.cert_file)
+            return engine
+
+        monkeypatch.setattr(module.AsyncEngine, '__aenter__', __aenter__)
+
+
+class AsyncFakeCredential(FakeCredential):
+    """The asyncio version of FakeCredential."""
+    async def get_token(self, *scopes, **kwargs): # pylint: disable=invalid-overridden-method
+        return super().get_token(*scopes, **kwargs)
+
+    async def close(self): # pylint: disable=invalid-overridden-method
+        pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Route a request to the mock, see MockArm."""
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, mock, *args, **kwargs):
+        self.mock = mock
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def send(self, code, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self.route('GET')
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        self.route('PUT')
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.route('POST')
+
+    def route(self, method): # pylint: disable=too-many-return-statements
+        mock = self.mock
+        url = urlparse(self.path)
+        path = url.path
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        if path == '/subscriptions':
+            with mock.request('subscriptions.list'):
+                return self.send(200, {'value': [
+                    {'id': f"/subscriptions/{subscription}", 'subscriptionId': subscription, 'displayName': name, 'state': 'Enabled'}
+                    for name, subscription in mock.subscriptions.items()
+                ]})
+
+        match = re.match(r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)/providers/Microsoft.Compute/(virtualMachines|disks|snapshots)/([^/]+)$', path, re.I)
+        if match:
+            subscription, resource_group, kind, name = match.groups()
+            if kind == 'virtualMachines':
+                with mock.request('virtual_machines.get'):
+                    return self.send(200, vm_model(subscription, resource_group, name))
+            if kind == 'disks':
+                with mock.request('disks.get'):
+                    return self.send(200, {'id': path, 'name': name, 'location': 'eastus2', 'properties': {'diskSizeGB': 32}})
+            key = path.lower()
+            if method == 'PUT':
+                with mock.request('snapshots.put'):
+                    now = datetime.datetime.now(datetime.timezone.utc)
+                    snapshot = {'id': path, 'name': name, 'location': body.get('location'), 'tags': body.get('tags') or {},
+                                'properties': dict(body.get('properties') or {}, provisioningState='Creating', timeCreated=now.isoformat())}
+                    operation = str(uuid.uuid4())
+                    with mock.lock:
+                        mock.snapshots[key] = snapshot
+                        mock.operations[operation] = (time.monotonic() + mock.snapshot_seconds, key)
+                    return self.send(202, snapshot, {'Azure-AsyncOperation': f"{mock.url}/operations/{operation}?api-version=2024-03-02"})
+            with mock.request('snapshots.get'):
+                if key in mock.snapshots:
+                    return self.send(200, mock.snapshots[key])
+                return self.send(404, {'error': {'code': 'ResourceNotFound', 'message': f"{name} not found"}})
+
+        match = re.match(r'^/operations/([^/]+)$', path)
+        if match:
+            with mock.request('operations.get'):
+                done_at, key = mock.operations[match.group(1)]
+                if time.monotonic() < done_at:
+                    headers = {} if mock.retry_after is None else {'Retry-After': str(mock.retry_after)}
+                    return self.send(200, {'status': 'InProgress'}, headers)
+                mock.snapshots[key]['properties']['provisioningState'] = 'Succeeded'
+                return self.send(200, {'status': 'Succeeded'})
+
+        match = re.match(r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)/providers/Microsoft.RecoveryServices/vaults/([^/]+)/backupProtectedItems$', path, re.I)
+        if match:
+            with mock.request('backup_protected_items.list'):
+                resource_group, vault = match.group(2), match.group(3)
+                if 'missing' in vault:
+                    return self.send(404, {'error': {'code': 'ResourceNotFound', 'message':
+                        f"The Resource 'Microsoft.RecoveryServices/vaults/{vault}' under resource group '{resource_group}' was not found."}})
+                skip = int(query.get('$skiptoken', ['0'])[0])
+                page = [{'id': f"{path}/{i}", 'name': f"VM;iaasvmcontainerv2;{resource_group};vm-case{i}",
+                         'properties': {'protectedItemType': 'Microsoft.Compute/virtualMachines', 'friendlyName': f"vm-case{i}"}}
+                        for i in range(skip + 1, min(skip + 200, mock.backup_items) + 1, 2)]
+                result = {'value': page}
+                if skip + 200 < mock.backup_items:
+                    result['nextLink'] = f"{mock.url}{path}?api-version=2024-04-01&$skiptoken={skip + 200}"
+                return self.send(200, result)
+
+        if path == '/providers/Microsoft.ResourceGraph/resources':
+            with mock.request('resourcegraph.resources'):
+                names = re.findall(r"'([^']+)'", body['query'].split('name in~', 1)[1].split(')', 1)[0])
+                rows = []
+                for subscription in body['subscriptions']:
+                    for name in names:
+                        vm = vm_model(subscription, 'rg-vm', name)
+                        os_disk = vm['properties']['storageProfile']['osDisk']
+                        rows.append({'id': vm['id'], 'subscriptionId': subscription, 'resourceGroup': 'rg-vm', 'name': name,
+                                     'location': vm['location'], 'osDisk': os_disk['name'], 'osDiskId': os_disk['managedDisk']['id'],
+                                     'dataDisks': vm['properties']['storageProfile']['dataDisks']})
+                options = body.get('options') or {}
+                top = options.get('$top') or 1000
+                skip = int(options.get('$skipToken') or 0)
+                result = {'totalRecords': len(rows), 'count': len(rows[skip:skip + top]), 'data': rows[skip:skip + top], 'resultTruncated': 'false'}
+                if skip + top < len(rows):
+                    result['$skipToken'] = str(skip + top)
+                return self.send(200, result)
+
+        with mock.request('unknown'):
+            return self.send(404, {'error': {'code': 'NotFound', 'message': f"{method} {path}"}})
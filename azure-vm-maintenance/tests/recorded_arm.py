@@ -0,0 +1,93 @@
+"""Replay recorded ARM responses to the management clients of az-vm-maintenance.py.
+
+Shared by the tests, which import it from the tests directory.
+"""
+import importlib.util
+import io
+import json
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+import urllib3
+from azure.core.credentials import AccessToken
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECORDINGS_DIR = os.path.join(MODULE_DIR, 'tests', 'recordings')
+
+
+def load_module():
+    """Import az-vm-maintenance.py as a new module, reading the environment again."""
+    spec = importlib.util.spec_from_file_location('az_vm_maintenance', os.path.join(MODULE_DIR, 'az-vm-maintenance.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_recording(name):
+    """Return the exchanges of tests/recordings/<name>.json."""
+    with open(os.path.join(RECORDINGS_DIR, f"{name}.json"), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def without_api_version(url):
+    """Drop the api-version parameter, which depends on the installed SDK version."""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != 'api-version']
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class FakeCredential:
+    """A credential handing out a token that never expires during a test."""
+    def get_token(self, *scopes, **kwargs): # pylint: disable=unused-argument
+        return AccessToken('token', int(time.time()) + 3600)
+
+    def close(self):
+        pass
+
+
+class RecordedAdapter(requests.adapters.HTTPAdapter):
+    """Answer the requests of a session with recorded responses, in order.
+
+    Each request still takes a connection from the pool of its host, like
+    HTTPAdapter.send, without connecting, so the pool counts the connections
+    that would have been opened. Any request not next in the recording fails.
+    """
+    def __init__(self, exchanges, **kwargs):
+        super().__init__(**kwargs)
+        self.exchanges = list(exchanges)
+        self.sent = []
+
+    def send(self, request, **kwargs): # pylint: disable=arguments-differ,unused-argument
+        pool = self.poolmanager.connection_from_url(request.url)
+        pool._put_conn(pool._get_conn()) # pylint: disable=protected-access
+
+        sent = {
+            'method': request.method,
+            'url': without_api_version(request.url),
+            'body': json.loads(request.body) if request.body else None,
+        }
+        self.sent.append(sent)
+        assert self.exchanges, f"unexpected request {sent['method']} {sent['url']}"
+        exchange = self.exchanges.pop(0)
+        assert sent == exchange['request']
+        content = json.dumps(exchange['response']).encode()
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response.raw = urllib3.HTTPResponse(body=io.BytesIO(content), preload_content=False, status=200)
+        response._content = content # pylint: disable=protected-access
+        response.request = request
+        response.url = request.url
+        return response
+
+
+def recorded_registry(module, exchanges, pool_size=4):
+    """Return a ClientRegistry of module whose clients are answered by a RecordedAdapter."""
+    registry = module.ClientRegistry(pool_size)
+    registry.credential = FakeCredential()
+    registry.session = requests.Session()
+    registry.adapter = RecordedAdapter(exchanges, pool_connections=4, pool_maxsize=pool_size)
+    registry.session.mount('https://', registry.adapter)
+    return registry
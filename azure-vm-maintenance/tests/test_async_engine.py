@@ -0,0 +1,100 @@
+"""Tests of the --async engine against the local ARM mock of tests/mock_arm.py.
+
+Run from azure-vm-maintenance/ with: python -m pytest tests
+"""
+import pytest
+
+from mock_arm import MockArm
+from recorded_arm import load_module
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('cryptography')
+
+vm = load_module()
+
+SUBSCRIPTIONS = {'Contoso Prod': '11111111-1111-1111-1111-111111111111', 'Contoso Data': '22222222-2222-2222-2222-222222222222'}
+CONCURRENCY = 2
+
+
+@pytest.fixture
+def mock(tmp_path, monkeypatch):
+    """The ARM mock, with the module's clients and subscription cache pointed at it."""
+    with MockArm(SUBSCRIPTIONS, delay=0.05, snapshot_seconds=0.3, retry_after=None) as arm:
+        arm.patch(vm, monkeypatch, polling_interval=0.01)
+        monkeypatch.setattr(vm, 'SUBSCRIPTION_RESOLVER', vm.SubscriptionResolver(str(tmp_path / 'subscriptions.json'), 3600))
+        monkeypatch.setattr(vm, 'RESOURCE_CACHE', vm.ResourceCache())
+        monkeypatch.setattr(vm, 'VAULT_INDEX', vm.VaultIndex())
+        monkeypatch.setattr(vm, 'VM_SNAPSHOT_POSTFIX', 'snapshot-test')
+        yield arm
+
+
+def snapshot_jobs(count):
+    return [
+        {
+            'subscription': subscription,
+            'resource_group': 'rg-vm',
+            'vm_name': f"vm-{k}",
+            'location': 'japaneast',
+            'disk_name': f"osdisk-vm-{k}",
+            'disk_id': f"/subscriptions/{subscription}/resourceGroups/rg-vm/providers/Microsoft.Compute/disks/osdisk-vm-{k}",
+        }
+        for k in range(count) for subscription in SUBSCRIPTIONS.values()
+    ]
+
+
+def test_requests_and_polls_in_flight_are_bounded(mock, monkeypatch):
+    polling = {'now': 0, 'most': 0}
+    begin_snapshot_disk = vm.AsyncEngine.begin_snapshot_disk
+
+    async def counted_begin_snapshot_disk(engine, job):
+        poller = await begin_snapshot_disk(engine, job)
+        result = poller.result
+
+        async def counted_result():
+            polling['now'] += 1
+            polling['most'] = max(polling['most'], polling['now'])
+            try:
+                return await result()
+            finally:
+                polling['now'] -= 1
+
+        poller.result = counted_result
+        return poller
+
+    monkeypatch.setattr(vm.AsyncEngine, 'begin_snapshot_disk', counted_begin_snapshot_disk)
+    jobs = snapshot_jobs(6)
+    results = vm.run_async(CONCURRENCY, lambda engine: engine.snapshot_disks(jobs, 20, 10))
+    assert [job['state'] for job in results] == ['Succeeded'] * len(jobs)
+    # The operations keep running for a while, so pollers pile up unless they are limited
+    assert polling['most'] == CONCURRENCY
+
+    stats = mock.stats()
+    assert stats['snapshots.put'] == len(jobs)
+    assert stats['operations.get'] > len(jobs)
+    assert stats['most active snapshots.put'] <= CONCURRENCY
+    assert stats['most active operations.get'] <= CONCURRENCY
+    assert stats['most active *'] <= 2 * CONCURRENCY
+
+
+def test_prefetch_vms_fills_the_resource_cache(mock):
+    rows = [{'SubscriptionIdorName': name, 'ResourceGroupName': 'rg-vm', 'VMName': f"vm-{k}"}
+            for k in range(5) for name in SUBSCRIPTIONS]
+    vm.run_async(CONCURRENCY, lambda engine: engine.prefetch_vms(rows))
+    assert mock.stats()['virtual_machines.get'] == len(rows)
+    assert mock.stats()['most active virtual_machines.get'] <= CONCURRENCY
+
+    # The rows are then filled from the cache, without another request
+    mock.reset()
+    vm.list_vm_details(rows)
+    assert rows[4]['DataDisk'] == 'datadisk-vm-2-0'
+    assert 'virtual_machines.get' not in mock.stats()
+
+
+def test_missing_vault_exits_like_the_sync_path(mock, monkeypatch, capsys):
+    monkeypatch.setattr(vm, 'VAULTS', 'Contoso Prod/rg-backup/vault-missing')
+    rows = [{'SubscriptionIdorName': 'Contoso Prod', 'ResourceGroupName': 'rg-vm', 'VMName': 'vm-case1'}]
+    with pytest.raises(SystemExit) as exit_info:
+        vm.run_async(CONCURRENCY, lambda engine: engine.prefetch_vaults(rows))
+    assert exit_info.value.code == 1
+    assert "Resource not found: " in capsys.readouterr().out
+    assert mock.stats()['backup_protected_items.list'] == 1
@@ -0,0 +1,34 @@
+"""Tests of the management clients shared through ClientRegistry.
+
+Run from azure-vm-maintenance/ with: python -m pytest tests
+"""
+from recorded_arm import load_module, load_recording, recorded_registry
+
+vm = load_module()
+
+SUB_A = '11111111-1111-1111-1111-111111111111'
+SUB_B = '22222222-2222-2222-2222-222222222222'
+
+
+def test_clients_share_one_connection_pool(tmp_path, monkeypatch):
+    registry = recorded_registry(vm, load_recording('client_registry'))
+    monkeypatch.setattr(vm, 'CLIENT_REGISTRY', registry)
+    monkeypatch.setattr(vm, 'SUBSCRIPTION_RESOLVER', vm.SubscriptionResolver(str(tmp_path / 'subscriptions.json'), 3600))
+    monkeypatch.setattr(vm, 'RESOURCE_CACHE', vm.ResourceCache())
+
+    subscription_a = vm.format_subscription_name('Contoso Prod')
+    subscription_b = vm.format_subscription_name('Contoso Data')
+    assert (subscription_a, subscription_b) == (SUB_A, SUB_B)
+    assert vm.find_os_disk(SUB_A, 'rg-app', 'vm-web1') == 'osdisk-web1'
+    assert vm.find_vm_location(SUB_A, 'rg-app', 'vm-web1') == 'japaneast'
+    assert vm.find_os_disk(SUB_B, 'rg-db', 'vm-db1') == 'osdisk-db1'
+    assert vm.find_disk_id(SUB_B, 'rg-db', 'osdisk-db1').endswith('/disks/osdisk-db1')
+    assert not registry.adapter.exchanges
+
+    # A subscription client and a compute client per subscription, one per use site before
+    assert sorted(registry.clients, key=str) == [('compute', SUB_A), ('compute', SUB_B), ('subscription', None)]
+    assert registry.requested == 4
+    # The four requests of the three clients went over a single keep-alive connection
+    assert registry.connections() == 1
+    assert registry.summary() == "Management clients: 3 created for 4 uses, 1 HTTPS connections opened"
+
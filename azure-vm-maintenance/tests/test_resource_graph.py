@@ -0,0 +1,91 @@
+"""Tests of the --resource-graph inventory against recorded Resource Graph responses.
+
+The management clients send their requests through a requests adapter that
+replays tests/recordings/resource_graph.json in order, and fails on any other
+request, so a VM or disk lookup sent to Azure makes the test fail.
+
+Run from azure-vm-maintenance/ with: python -m pytest tests
+"""
+import pytest
+
+from recorded_arm import load_module, load_recording, recorded_registry
+
+vm = load_module()
+
+SUB_A = '11111111-1111-1111-1111-111111111111'
+SUB_B = '22222222-2222-2222-2222-222222222222'
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    """Route every management client through a RecordedAdapter of the recording."""
+    registry = recorded_registry(vm, load_recording('resource_graph'))
+    monkeypatch.setattr(vm, 'CLIENT_REGISTRY', registry)
+
+    resolver = vm.SubscriptionResolver(None, 0)
+    resolver.by_id = {SUB_A: SUB_A, SUB_B: SUB_B}
+    resolver.by_name = {'Contoso Prod': SUB_A}
+    monkeypatch.setattr(vm, 'SUBSCRIPTION_RESOLVER', resolver)
+    monkeypatch.setattr(vm, 'RESOURCE_GRAPH_BATCH_SIZE', 2)
+    monkeypatch.setattr(vm, 'RESOURCE_GRAPH_PAGE_SIZE', 2)
+    monkeypatch.setattr(vm, 'VM_SNAPSHOT_POSTFIX', 'snapshot-test')
+    return registry.adapter
+
+
+def csv_rows():
+    """Return the rows of a VM CSV file, as read_csv_file does."""
+    return [
+        {'SubscriptionIdorName': 'Contoso Prod', 'ResourceGroupName': 'rg-app', 'VMName': 'VM-Web1'},
+        {'SubscriptionIdorName': SUB_A, 'ResourceGroupName': 'RG-App', 'VMName': 'vm-web2'},
+        {'SubscriptionIdorName': SUB_B, 'ResourceGroupName': 'rg-db', 'VMName': 'vm-db1'},
+        {'SubscriptionIdorName': SUB_B, 'ResourceGroupName': 'rg-db', 'VMName': 'vm-missing'},
+    ]
+
+
+def disk_id(subscription, resource_group, disk_name):
+    return f"/subscriptions/{subscription}/resourceGroups/{resource_group}/providers/Microsoft.Compute/disks/{disk_name}"
+
+
+def test_batches_and_skip_tokens(transport):
+    vm.list_vm_details_graph(csv_rows())
+    # Two batches of two names, the first one on two pages
+    assert [(sent['body']['subscriptions'], '$skipToken' in sent['body']['options']) for sent in transport.sent] == [
+        ([SUB_A], False),
+        ([SUB_A], True),
+        ([SUB_B], False),
+    ]
+    assert not transport.exchanges
+
+
+def test_join_on_subscription_resource_group_and_name(transport, capsys):
+    rows = vm.list_vm_details_graph(csv_rows())
+    details = [(row['OSDisk'], row['DataDisk'], row['Location'], row['DataDisks']) for row in rows]
+    assert details == [
+        ('osdisk-web1', None, 'japaneast', None),
+        # Not the vm-web2 of rg-other on the first page
+        ('osdisk-web2', 'datadisk-web2-0', 'japaneast', 'datadisk-web2-0,datadisk-web2-1'),
+        ('osdisk-db1', 'datadisk-db1-0', 'japaneast', 'datadisk-db1-0'),
+        (None, None, None, None),
+    ]
+    assert rows[1]['DiskIds'] == {
+        'osdisk-web2': disk_id(SUB_A, 'RG-APP', 'osdisk-web2'),
+        'datadisk-web2-0': disk_id(SUB_A, 'RG-APP', 'datadisk-web2-0'),
+        'datadisk-web2-1': disk_id(SUB_A, 'RG-APP', 'datadisk-web2-1'),
+    }
+    assert 'VM vm-missing not found in resource group rg-db' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('group', [False, True], ids=['disks', 'group'])
+def test_snapshot_jobs_use_the_disk_ids_of_the_graph(transport, group):
+    rows = vm.list_vm_details_graph(csv_rows())
+    jobs = vm.vm_snapshot_jobs(rows, group)
+    # Without group, the OS disk and the first data disk of each VM
+    expected = ['osdisk-web1', 'osdisk-web2', 'datadisk-web2-0', 'osdisk-db1', 'datadisk-db1-0']
+    if group:
+        expected.insert(3, 'datadisk-web2-1')
+    assert [job['disk_name'] for job in jobs] == expected
+    for job in jobs:
+        resource_group = 'RG-APP' if job['subscription'] == SUB_A else 'RG-DB'
+        assert job['disk_id'] == disk_id(job['subscription'], resource_group, job['disk_name'])
+    # No VM or disk was fetched after the Resource Graph queries
+    assert len(transport.sent) == 3
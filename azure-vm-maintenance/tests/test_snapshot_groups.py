@@ -0,0 +1,118 @@
+"""Tests of the --group snapshot scheduling of az-vm-maintenance.py, without Azure.
+
+Run from azure-vm-maintenance/ with: python -m pytest tests
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from recorded_arm import load_module
+
+vm = load_module()
+
+SUB_A = '11111111-1111-1111-1111-111111111111'
+SUB_B = '22222222-2222-2222-2222-222222222222'
+CREATED = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FakePoller:
+    """An LRO poller of a snapshot that is already created."""
+    def __init__(self, started):
+        self.snapshot = SimpleNamespace(time_created=CREATED + timedelta(seconds=started))
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self.snapshot
+
+
+def web01_jobs():
+    """Group jobs of two VMs named web01, next to each other as in a CSV file."""
+    jobs = []
+    for subscription in (SUB_A, SUB_B):
+        disks = [(f"{name}-{subscription[:4]}", f"/subscriptions/{subscription}/resourceGroups/rg-web/providers/Microsoft.Compute/disks/{name}")
+                 for name in ('osdisk-web01', 'datadisk-web01-0')]
+        jobs.extend(vm.snapshot_group_jobs(subscription, 'rg-web', 'web01', 'japaneast', disks=disks))
+    return jobs
+
+
+@pytest.fixture(autouse=True)
+def postfix(monkeypatch):
+    monkeypatch.setattr(vm, 'VM_SNAPSHOT_POSTFIX', 'snapshot-test')
+
+
+def test_same_vm_name_in_two_subscriptions_forms_two_groups():
+    jobs = web01_jobs()
+    assert [job['group'] for job in jobs] == [f"{SUB_A}/rg-web/web01"] * 2 + [f"{SUB_B}/rg-web/web01"] * 2
+    assert jobs[0]['tags']['SnapshotGroup'] != jobs[2]['tags']['SnapshotGroup']
+
+
+def test_sync_scheduler_keeps_the_groups_and_slots_apart(monkeypatch):
+    started = []
+
+    def begin_snapshot_disk(subscription, resource_group, disk_name, location, tags=None, disk_id=None): # pylint: disable=unused-argument
+        started.append(subscription)
+        return FakePoller(len(started))
+
+    monkeypatch.setattr(vm, 'begin_snapshot_disk', begin_snapshot_disk)
+    results = vm.snapshot_disks(web01_jobs(), max_per_subscription=2, max_per_region=2)
+    assert sorted(started) == [SUB_A, SUB_A, SUB_B, SUB_B]
+    assert [job['state'] for job in results] == ['Succeeded'] * 4
+    assert sorted(vm.snapshot_group_skew(results)) == [f"{SUB_A}/rg-web/web01", f"{SUB_B}/rg-web/web01"]
+
+
+def test_async_scheduler_keeps_the_groups_apart():
+    running = {}
+    most = {}
+
+    class AsyncPoller(FakePoller):
+        def __init__(self, subscription, started):
+            super().__init__(started)
+            self.subscription = subscription
+
+        async def result(self): # pylint: disable=invalid-overridden-method
+            await asyncio.sleep(0.01)
+            running[self.subscription] -= 1
+            return self.snapshot
+
+    async def begin_snapshot_disk(job):
+        job['snapshot_name'] = f"{job['disk_name']}-{vm.VM_SNAPSHOT_POSTFIX}"
+        job['started'] = 0
+        running[job['subscription']] = running.get(job['subscription'], 0) + 1
+        most[job['subscription']] = max(most.get(job['subscription'], 0), running[job['subscription']])
+        return AsyncPoller(job['subscription'], sum(most.values()))
+
+    async def run():
+        engine = vm.AsyncEngine(4)
+        engine.requests = asyncio.Semaphore(4)
+        engine.polls = asyncio.Semaphore(4)
+        engine.begin_snapshot_disk = begin_snapshot_disk
+        return await engine.snapshot_disks(web01_jobs(), max_per_subscription=2, max_per_region=2)
+
+    results = asyncio.run(run())
+    assert [job['state'] for job in results] == ['Succeeded'] * 4
+    assert most == {SUB_A: 2, SUB_B: 2}
+    assert sorted(vm.snapshot_group_skew(results)) == [f"{SUB_A}/rg-web/web01", f"{SUB_B}/rg-web/web01"]
+
+
+def test_resume_takes_a_split_group_again_as_a_whole(tmp_path, monkeypatch, capsys):
+    jobs = web01_jobs()
+    journal = vm.SnapshotJournal(str(tmp_path / 'journal.jsonl'))
+    # The earlier run finished the group in SUB_B, but only the OS disk of the one in SUB_A
+    for job in jobs[:1] + jobs[2:]:
+        journal.record(job, 'started')
+        journal.record(job, 'succeeded')
+    journal.record(jobs[1], 'started')
+    monkeypatch.setattr(vm, 'find_snapshot_state', lambda subscription, resource_group, snapshot_name: None)
+    deleted = []
+    monkeypatch.setattr(vm, 'delete_snapshot', lambda subscription, resource_group, snapshot_name: deleted.append((subscription, snapshot_name)))
+
+    remaining = vm.resume_snapshot_jobs(jobs, journal)
+    journal.close()
+    assert remaining == jobs[:2]
+    assert deleted == [(SUB_A, 'osdisk-web01-1111-snapshot-test')]
+    assert journal.states()[vm.SnapshotJournal.key(jobs[0])] == 'deleted'
+    assert f"Snapshot group {SUB_A}/rg-web/web01 split by the earlier run (1 of 2 disks done)" in capsys.readouterr().out
@@ -0,0 +1,23 @@
+"""Tests of the subscription name cache of az-vm-maintenance.py.
+
+Run from azure-vm-maintenance/ with: python -m pytest tests
+"""
+import json
+import time
+
+from recorded_arm import load_module
+
+SUB_A = '11111111-1111-1111-1111-111111111111'
+
+
+def test_resolve_reads_the_default_cache_before_load_config(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    cache_file = tmp_path / 'az-vm-maintenance' / 'subscriptions.json'
+    cache_file.parent.mkdir()
+    cache_file.write_text(json.dumps({'fetchedAt': time.time(), 'byName': {'Contoso Prod': SUB_A}, 'byId': {SUB_A: SUB_A}}))
+
+    vm = load_module()
+    assert vm.SUBSCRIPTION_RESOLVER.cache_file == str(cache_file)
+    # Answered from the cache, without a client to list the subscriptions
+    monkeypatch.setattr(vm, 'CLIENT_REGISTRY', None)
+    assert vm.format_subscription_name('Contoso Prod') == SUB_A
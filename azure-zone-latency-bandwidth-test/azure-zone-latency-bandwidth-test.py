@@ -2,13 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import ipaddress
 import time
 import re
 import logging
 import subprocess
 import json
 import os
+import random
+import socket
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import paramiko
 
 from azure.identity import DefaultAzureCredential
@@ -47,6 +51,9 @@ def create_virtual_network(network_client, resource_group_name, vnet_name, subne
         subnet_name (str): The name of the subnet.
         network_cidr (str): The CIDR block for the network.
         location (str): The location where the virtual network will be created.
+
+    Returns:
+        Subnet: The created subnet.
     """
     vnet_params = {
         'location': location,
@@ -66,6 +73,7 @@ def create_virtual_network(network_client, resource_group_name, vnet_name, subne
         }
     ).result()
     logging.info("Subnet %s has been 建立.", subnet_name)
+    return subnet_info
 
 def create_network_security_group(network_client, resource_group_name, nsg_name, location):
     """
@@ -76,6 +84,9 @@ def create_network_security_group(network_client, resource_group_name, nsg_name,
         resource_group_name (str): The name of the resource group.
         nsg_name (str): The name of the network security group.
         location (str): The location where the network security group will be created.
+
+    Returns:
+        NetworkSecurityGroup: The created network security group.
     """
     ssh_rule = SecurityRule(
         protocol='Tcp',
@@ -162,55 +173,97 @@ def create_network_security_group(network_client, resource_group_name, nsg_name,
     )
 
     nsg_params = NetworkSecurityGroup(location=location, security_rules=[ssh_rule, iperf3_rule, icmp_rule, asn_rule, sockperf_rule,two_ping_rule, outbound_rule])
-    network_client.network_security_groups.begin_create_or_update(resource_group_name, nsg_name, nsg_params).result()
+    nsg = network_client.network_security_groups.begin_create_or_update(resource_group_name, nsg_name, nsg_params).result()
     logging.info("Network security group %s has been 建立.", nsg_name)
+    return nsg
 
-def create_vm_without_progress(compute_client, network_client, resource_client, resource_group_name, vm_name, location, vm_type, username, password, nsg_name, vnet_name, subnet_name, zone, enable_accelerated_networking):
+def create_vnet_peering(network_client, resource_group_name, vnet_name, remote_vnet_name, remote_vnet_id):
     """
-    Create a virtual machine without showing progress.
+    Peer a virtual network with another one, so their VMs reach each other over private IPs.
+
+    A peering only goes one way, peer the remote virtual network back as well.
 
     Args:
-        compute_client (ComputeManagementClient): The compute management client.
         network_client (NetworkManagementClient): The network management client.
-        resource_client (ResourceManagementClient): The resource management client.
         resource_group_name (str): The name of the resource group.
-        vm_name (str): The name of the virtual machine.
-        location (str): The location where the virtual machine will be created.
-        vm_type (str): The type of the virtual machine.
-        username (str): The admin username for the virtual machine.
-        password (str): The admin password for the virtual machine.
-        nsg_name (str): The name of the network security group.
         vnet_name (str): The name of the virtual network.
-        subnet_name (str): The name of the subnet.
-        zone (str): The availability zone for the virtual machine.
-        enable_accelerated_networking (bool): Whether to enable accelerated networking.
+        remote_vnet_name (str): The name of the remote virtual network.
+        remote_vnet_id (str): The ID of the remote virtual network.
+    """
+    peering_params = {
+        'remote_virtual_network': {'id': remote_vnet_id},
+        'allow_virtual_network_access': True
+    }
+    network_client.virtual_network_peerings.begin_create_or_update(resource_group_name, vnet_name, f"{vnet_name}-to-{remote_vnet_name}", peering_params).result()
+    logging.info("VNet peering %s -> %s has been 建立.", vnet_name, remote_vnet_name)
+
+def create_public_ip(network_client, resource_group_name, vm_name, location, zone):
     """
-    subnet_info = network_client.subnets.get(resource_group_name, vnet_name, subnet_name)
+    Create the public IP address of a virtual machine.
 
-    nic_name = f"{vm_name}-nic"
-    ip_config_name = f"{vm_name}-ipconfig"
-    public_ip_name = f"{vm_name}-pip"
+    Args:
+        network_client (NetworkManagementClient): The network management client.
+        resource_group_name (str): The name of the resource group.
+        vm_name (str): The name of the virtual machine.
+        location (str): The location where the public IP address will be created.
+        zone (str): The availability zone of the public IP address, None for a regional one.
 
+    Returns:
+        PublicIPAddress: The created public IP address.
+    """
     public_ip_params = {
         'location': location,
         'public_ip_allocation_method': 'Static',
-        'sku': {'name': 'Standard'},
-        'zones': [zone]
+        'sku': {'name': 'Standard'}
     }
-    public_ip = network_client.public_ip_addresses.begin_create_or_update(resource_group_name, public_ip_name, public_ip_params).result()
+    if zone:
+        public_ip_params['zones'] = [zone]
+    return network_client.public_ip_addresses.begin_create_or_update(resource_group_name, f"{vm_name}-pip", public_ip_params).result()
+
+def create_network_interface(network_client, resource_group_name, vm_name, location, subnet_id, public_ip_id, nsg_id, enable_accelerated_networking):
+    """
+    Create the network interface of a virtual machine.
+
+    Args:
+        network_client (NetworkManagementClient): The network management client.
+        resource_group_name (str): The name of the resource group.
+        vm_name (str): The name of the virtual machine.
+        location (str): The location where the network interface will be created.
+        subnet_id (str): The ID of the subnet.
+        public_ip_id (str): The ID of the public IP address.
+        nsg_id (str): The ID of the network security group.
+        enable_accelerated_networking (bool): Whether to enable accelerated networking.
 
+    Returns:
+        NetworkInterface: The created network interface.
+    """
     nic_params = {
         'location': location,
         'ip_configurations': [{
-            'name': ip_config_name,
-            'subnet': {'id': subnet_info.id},
-            'public_ip_address': {'id': public_ip.id}
+            'name': f"{vm_name}-ipconfig",
+            'subnet': {'id': subnet_id},
+            'public_ip_address': {'id': public_ip_id}
         }],
-        'network_security_group': {'id': network_client.network_security_groups.get(resource_group_name, nsg_name).id},
+        'network_security_group': {'id': nsg_id},
         'enable_accelerated_networking': enable_accelerated_networking
     }
-    nic = network_client.network_interfaces.begin_create_or_update(resource_group_name, nic_name, nic_params).result()
+    return network_client.network_interfaces.begin_create_or_update(resource_group_name, f"{vm_name}-nic", nic_params).result()
+
+def create_vm(compute_client, resource_group_name, vm_name, location, vm_type, username, password, nic_id, zone):
+    """
+    Create a virtual machine on an existing network interface.
 
+    Args:
+        compute_client (ComputeManagementClient): The compute management client.
+        resource_group_name (str): The name of the resource group.
+        vm_name (str): The name of the virtual machine.
+        location (str): The location where the virtual machine will be created.
+        vm_type (str): The type of the virtual machine.
+        username (str): The admin username for the virtual machine.
+        password (str): The admin password for the virtual machine.
+        nic_id (str): The ID of the network interface.
+        zone (str): The availability zone for the virtual machine, None for a regional one.
+    """
     vm_params = {
         'location': location,
         'hardware_profile': {'vm_size': vm_type},
@@ -228,13 +281,276 @@ def create_vm_without_progress(compute_client, network_client, resource_client,
             'admin_password': password
         },
         'network_profile': {
-            'network_interfaces': [{'id': nic.id}]
-        },
-        'zones': [zone]
+            'network_interfaces': [{'id': nic_id}]
+        }
     }
+    if zone:
+        vm_params['zones'] = [zone]
     compute_client.virtual_machines.begin_create_or_update(resource_group_name, vm_name, vm_params).result()
     logging.info("VM %s has been 建立.", vm_name)
-    return public_ip.ip_address
+
+def run_dependency_graph(tasks, max_workers=16):
+    """
+    Run tasks concurrently, each one as soon as the tasks it depends on have finished.
+
+    Args:
+        tasks (dict): {name: (dependencies, function)}, function is called with the
+            dict of the results of the finished tasks and returns the result of the task.
+        max_workers (int): The maximum number of tasks running at once.
+
+    Returns:
+        tuple: The {name: result} of every task and the {name: (start, end)} seconds
+            since the graph started.
+
+    Raises:
+        Exception: The first error of a task, once the running tasks have finished.
+            The tasks depending on a failed task are not started.
+    """
+    for name, (dependencies, _) in tasks.items():
+        missing = [dependency for dependency in dependencies if dependency not in tasks]
+        if missing:
+            raise ValueError(f"Task {name} depends on unknown tasks: {', '.join(missing)}")
+
+    results = {}
+    timings = {}
+    errors = []
+    started = time.monotonic()
+    pending = dict(tasks)
+    running = {}
+
+    def run(name, function):
+        start = time.monotonic() - started
+        try:
+            return function(results)
+        finally:
+            timings[name] = (start, time.monotonic() - started)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not errors:
+                for name, (dependencies, function) in list(pending.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        running[executor.submit(run, name, function)] = name
+                        del pending[name]
+            if not running:
+                if not errors:
+                    raise ValueError(f"Dependency cycle between tasks: {', '.join(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.error(f"Provisioning step {name} failed: {e}")
+                    errors.append(e)
+    if errors:
+        raise errors[0]
+    return results, timings
+
+def critical_path(tasks, timings):
+    """
+    Return the chain of tasks that ended last, following for each task the dependency that ended last.
+
+    Args:
+        tasks (dict): The tasks given to run_dependency_graph.
+        timings (dict): The timings returned by run_dependency_graph.
+
+    Returns:
+        list: The task names, first task first.
+    """
+    if not timings:
+        return []
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while True:
+        dependencies = [dependency for dependency in tasks[path[-1]][0] if dependency in timings]
+        if not dependencies:
+            return path[::-1]
+        path.append(max(dependencies, key=lambda name: timings[name][1]))
+
+def log_stage_timings(tasks, timings):
+    """
+    Log when each provisioning step started and ended, and the critical path.
+
+    Args:
+        tasks (dict): The tasks given to run_dependency_graph.
+        timings (dict): The timings returned by run_dependency_graph.
+    """
+    logging.info("Provisioning steps (seconds since start):")
+    for name, (start, end) in sorted(timings.items(), key=lambda item: item[1]):
+        logging.info(f"  {name:<24} {start:7.1f} -> {end:7.1f}  ({end - start:6.1f}s)")
+    path = critical_path(tasks, timings)
+    if path:
+        steps = ' -> '.join(f"{name} ({timings[name][1] - timings[name][0]:.1f}s)" for name in path)
+        logging.info(f"Critical path: {steps}, total {timings[path[-1]][1]:.1f}s")
+
+def default_mesh(location, vm_type):
+    """
+    Get the default test mesh: one VM in each of the three availability zones of a region.
+
+    Args:
+        location (str): The location of the virtual machines.
+        vm_type (str): The type of the virtual machines.
+
+    Returns:
+        dict: The mesh, see load_mesh_config.
+    """
+    return {
+        'vms': [{'name': f"azping-vm{zone}", 'location': location, 'zone': str(zone), 'vm_type': vm_type} for zone in range(1, 4)],
+        'network_cidrs': {}
+    }
+
+def load_mesh_config(path, location, vm_type):
+    """
+    Load the virtual machines of the test mesh from a JSON file.
+
+    The file lists the VMs, each with an optional name, location, zone and
+    vm_type, and optionally the network CIDR of some regions:
+
+        {
+          "network_cidrs": {"japaneast": "192.168.110.0/24"},
+          "vms": [
+            {"name": "sea-z1-a", "location": "southeastasia", "zone": "1"},
+            {"name": "jpe-z1", "location": "japaneast", "zone": "1", "vm_type": "Standard_D16lds_v5"}
+          ]
+        }
+
+    Args:
+        path (str): The path of the config file.
+        location (str): The location of the VMs that do not have one.
+        vm_type (str): The type of the VMs that do not have one.
+
+    Returns:
+        dict: {'vms': [{'name', 'location', 'zone', 'vm_type'}, ...], 'network_cidrs': {location: cidr}}.
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    vms = []
+    for index, vm in enumerate(config.get('vms') or [], start=1):
+        zone = vm.get('zone')
+        vms.append({
+            'name': vm.get('name') or f"azping-vm{index}",
+            'location': vm.get('location') or location,
+            'zone': str(zone) if zone not in (None, '') else None,
+            'vm_type': vm.get('vm_type') or vm_type
+        })
+    if len(vms) < 2:
+        raise ValueError(f"{path} must list at least two VMs")
+    names = [vm['name'] for vm in vms]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate VM names in {path}: {', '.join(duplicates)}")
+    return {'vms': vms, 'network_cidrs': config.get('network_cidrs') or {}}
+
+def region_networks(vm_specs, location, network_cidr, network_cidrs=None):
+    """
+    Plan one virtual network and NSG for each region of the mesh.
+
+    VNets and NSGs are regional, so every region the VMs are in gets its own.
+    The region given by --location keeps the plain names, and the regions
+    without a CIDR in network_cidrs take the blocks that follow network_cidr,
+    so the VNets can be peered.
+
+    Args:
+        vm_specs (list): The VMs of the mesh, see load_mesh_config.
+        location (str): The default location.
+        network_cidr (str): The CIDR block of the first region.
+        network_cidrs (dict): {location: cidr} of the regions with a CIDR of their own.
+
+    Returns:
+        dict: {location: {'vnet': str, 'nsg': str, 'cidr': str}}, in the order of the regions.
+    """
+    network_cidrs = network_cidrs or {}
+    locations = sorted(dict.fromkeys(vm['location'] for vm in vm_specs), key=lambda region: region != location)
+    base = ipaddress.ip_network(network_cidr, strict=False)
+    networks = {}
+    for index, region in enumerate(locations):
+        suffix = '' if region == location else f"-{region}"
+        cidr = network_cidrs.get(region) or str(ipaddress.ip_network((int(base.network_address) + index * base.num_addresses, base.prefixlen)))
+        networks[region] = {'vnet': f"azping-mgmt-vnet{suffix}", 'nsg': f"azping-nsg{suffix}", 'cidr': cidr}
+
+    cidrs = [ipaddress.ip_network(network['cidr'], strict=False) for network in networks.values()]
+    for index, cidr in enumerate(cidrs):
+        for other in cidrs[index + 1:]:
+            if cidr.overlaps(other):
+                raise ValueError(f"Network CIDRs {cidr} and {other} overlap, the VNets cannot be peered")
+    return networks
+
+def provision_vms(compute_client, network_client, resource_client, resource_group_name, location, vm_specs, username, password, network_cidr, enable_accelerated_networking, network_cidrs=None):
+    """
+    Create the resource group, networks and VMs of the test mesh as one dependency graph.
+
+    Resource group -> VNet/subnet and NSG of each region -> public IP -> NIC -> VM,
+    and the VNets of different regions are peered once both exist. The public IPs
+    only need the resource group, so they are created alongside the networks, and
+    the public IPs, NICs and VMs of all VMs are in flight at once. Existing VMs are
+    kept as they are. The addresses of the new VMs are taken from their public IP
+    and NIC, so the topology needs no further ARM call.
+
+    Args:
+        compute_client (ComputeManagementClient): The compute management client.
+        network_client (NetworkManagementClient): The network management client.
+        resource_client (ResourceManagementClient): The resource management client.
+        resource_group_name (str): The name of the resource group.
+        location (str): The location of the resource group.
+        vm_specs (list): The VMs of the mesh, see load_mesh_config.
+        username (str): The admin username for the virtual machines.
+        password (str): The admin password for the virtual machines.
+        network_cidr (str): The CIDR block for the network of the first region.
+        enable_accelerated_networking (bool): Whether to enable accelerated networking.
+        network_cidrs (dict): {location: cidr} of the regions with a CIDR of their own.
+
+    Returns:
+        dict: The topology for save_topology, {vm_name: {'public_ip': str, 'private_ip': str,
+              'location': str, 'zone': str, 'vm_type': str}} in the order of vm_specs.
+    """
+    subnet_name = 'default'
+    networks = region_networks(vm_specs, location, network_cidr, network_cidrs)
+
+    resource_group_exists = resource_client.resource_groups.check_existence(resource_group_name)
+    tasks = {
+        'resource-group': ([], lambda _: None if resource_group_exists else create_resource_group(resource_client, resource_group_name, location)),
+    }
+    for region, network in networks.items():
+        tasks[f"vnet:{region}"] = (['resource-group'], lambda _, region=region, network=network: create_virtual_network(
+            network_client, resource_group_name, network['vnet'], subnet_name, network['cidr'], region))
+        tasks[f"nsg:{region}"] = (['resource-group'], lambda _, region=region, network=network: create_network_security_group(
+            network_client, resource_group_name, network['nsg'], region))
+    for region in networks:
+        for remote_region in networks:
+            if region == remote_region:
+                continue
+            tasks[f"peering:{region}:{remote_region}"] = ([f"vnet:{region}", f"vnet:{remote_region}"], lambda results, region=region, remote_region=remote_region: create_vnet_peering(
+                network_client, resource_group_name, networks[region]['vnet'], networks[remote_region]['vnet'],
+                results[f"vnet:{remote_region}"].id.split('/subnets/')[0]))
+
+    for vm in vm_specs:
+        vm_name, region, zone = vm['name'], vm['location'], vm['zone']
+        if resource_group_exists and vm_exists(compute_client, resource_group_name, vm_name):
+            logging.info(f"VM {vm_name} already exists. Skipping creation.")
+            tasks[f"ip:{vm_name}"] = ([], lambda _, vm_name=vm_name: get_vm_addresses(network_client, resource_group_name, vm_name))
+            continue
+        tasks[f"pip:{vm_name}"] = (['resource-group'], lambda _, vm_name=vm_name, region=region, zone=zone: create_public_ip(
+            network_client, resource_group_name, vm_name, region, zone))
+        tasks[f"nic:{vm_name}"] = ([f"vnet:{region}", f"nsg:{region}", f"pip:{vm_name}"], lambda results, vm_name=vm_name, region=region: create_network_interface(
+            network_client, resource_group_name, vm_name, region, results[f"vnet:{region}"].id, results[f"pip:{vm_name}"].id,
+            results[f"nsg:{region}"].id, enable_accelerated_networking))
+        tasks[f"vm:{vm_name}"] = ([f"nic:{vm_name}"], lambda results, vm=vm: create_vm(
+            compute_client, resource_group_name, vm['name'], vm['location'], vm['vm_type'], username, password, results[f"nic:{vm['name']}"].id, vm['zone']))
+
+    results, timings = run_dependency_graph(tasks, max_workers=max(16, len(vm_specs)))
+    log_stage_timings(tasks, timings)
+    topology = {}
+    for vm in vm_specs:
+        vm_name = vm['name']
+        if f"ip:{vm_name}" in results:
+            addresses = results[f"ip:{vm_name}"]
+        else:
+            addresses = {'public_ip': results[f"pip:{vm_name}"].ip_address,
+                         'private_ip': results[f"nic:{vm_name}"].ip_configurations[0].private_ip_address}
+        topology[vm_name] = dict(addresses, location=vm['location'], zone=vm['zone'], vm_type=vm['vm_type'])
+    return topology
 
 def get_public_ip_address(network_client, resource_group_name, vm_name):
     """
@@ -268,6 +584,94 @@ def get_private_ip_address(network_client, resource_group_name, vm_name):
     nic = network_client.network_interfaces.get(resource_group_name, f"{vm_name}-nic")
     return nic.ip_configurations[0].private_ip_address
 
+def get_vm_addresses(network_client, resource_group_name, vm_name):
+    """
+    Get the public and private IP addresses of a virtual machine, with one NIC GET and one public IP GET.
+
+    Args:
+        network_client (NetworkManagementClient): The network management client.
+        resource_group_name (str): The name of the resource group.
+        vm_name (str): The name of the virtual machine.
+
+    Returns:
+        dict: {'public_ip': str, 'private_ip': str}.
+    """
+    nic = network_client.network_interfaces.get(resource_group_name, f"{vm_name}-nic")
+    ip_configuration = nic.ip_configurations[0]
+    public_ip = network_client.public_ip_addresses.get(resource_group_name, ip_configuration.public_ip_address.id.split('/')[-1])
+    return {'public_ip': public_ip.ip_address, 'private_ip': ip_configuration.private_ip_address}
+
+def resolve_topology(network_client, resource_group_name, vm_names):
+    """
+    Resolve the public and private IP addresses of virtual machines, all at once.
+
+    Each VM costs one NIC GET and one public IP GET, and the VMs are resolved
+    concurrently. The tests then read their addresses from the returned map.
+
+    Args:
+        network_client (NetworkManagementClient): The network management client.
+        resource_group_name (str): The name of the resource group.
+        vm_names (list): The list of virtual machine names.
+
+    Returns:
+        dict: {vm_name: {'public_ip': str, 'private_ip': str}}.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(vm_names))) as executor:
+        return dict(zip(vm_names, executor.map(lambda vm_name: get_vm_addresses(network_client, resource_group_name, vm_name), vm_names)))
+
+def topology_file(subscription, resource_group_name):
+    """
+    Get the path of the saved topology of a resource group.
+
+    Args:
+        subscription (str): The subscription name or ID, as given on the command line.
+        resource_group_name (str): The name of the resource group.
+
+    Returns:
+        str: ~/.cache/azure-zone-latency-bandwidth-test/topology-<subscription>-<resource group>.json
+    """
+    cache_dir = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'azure-zone-latency-bandwidth-test')
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', f"topology-{subscription}-{resource_group_name}")
+    return os.path.join(cache_dir, f"{name}.json")
+
+def load_topology(path, vm_names=None):
+    """
+    Load a saved topology.
+
+    Args:
+        path (str): The path of the topology file.
+        vm_names (list): The virtual machines the topology must contain, None for all the saved ones.
+
+    Returns:
+        dict: The topology, or None if the file is missing, unreadable or lacks a VM.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            topology = json.load(f)['vms']
+    except (OSError, ValueError, KeyError):
+        return None
+    if vm_names is None:
+        return topology or None
+    if not all(vm_name in topology for vm_name in vm_names):
+        return None
+    return {vm_name: topology[vm_name] for vm_name in vm_names}
+
+def save_topology(path, topology):
+    """
+    Save a topology for the next runs.
+
+    Args:
+        path (str): The path of the topology file.
+        topology (dict): The topology returned by provision_vms, or by resolve_topology with the location, zone and vm_type of each VM.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'resolved_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'vms': topology}, f, indent=2)
+        logging.info(f"VM addresses saved to {path}")
+    except OSError as e:
+        logging.warning(f"Failed to save the VM addresses to {path}: {e}")
+
 def create_ssh_client(ip_address, username, password, skip_setup=False):
     """
     Create an SSH client to connect to a virtual machine.
@@ -371,115 +775,190 @@ def run_latency_test(client, vm_name, target_vm_name, target_ip, is_public=True)
         logging.error(f"Failed to find 'percentile 99.000' in sockperf output (Public IP: {is_public})")
         return "N/A"
 
-def run_latency_bandwidth_tests(network_client, resource_group_name, vm_names, admin_username, admin_password, skip_bandwidth_test, skip_latency_test, skip_setup=False):
+def round_robin_pairs(vm_names):
+    """
+    Arrange every pair of virtual machines into rounds in which each VM is in at most one pair.
+
+    This is the circle method of round-robin tournaments: N VMs give N - 1 rounds
+    (N rounds if N is odd, one VM then sits each round out).
+
+    Args:
+        vm_names (list): The list of virtual machine names.
+
+    Returns:
+        list: The rounds, each a list of (vm_name, vm_name) pairs.
+    """
+    vms = list(vm_names)
+    if len(vms) % 2:
+        vms.append(None)
+    rounds = []
+    for _ in range(len(vms) - 1):
+        rounds.append([(vms[i], vms[-1 - i]) for i in range(len(vms) // 2) if vms[i] is not None and vms[-1 - i] is not None])
+        vms = [vms[0], vms[-1]] + vms[1:-1]
+    return rounds
+
+def schedule_measurements(measurements, serialize_bandwidth=False):
+    """
+    Split measurements into rounds in which no VM is the source or target of two measurements.
+
+    The measurements of a round can run at the same time. The VM pairs are arranged
+    with round_robin_pairs, and the measurements of the pairs of one such round (both
+    directions, each test type and IP) then fill as many rounds as the busiest pair
+    needs. For a full N x N matrix this is the fewest rounds possible.
+
+    Args:
+        measurements (list): Dicts with 'source', 'target' and 'kind' ('bandwidth' or 'latency').
+        serialize_bandwidth (bool): Whether to give each bandwidth measurement a round of its own,
+            so iperf3 runs never share the network with another measurement.
+
+    Returns:
+        list: The rounds, each a list of measurements.
+    """
+    rounds = []
+    if serialize_bandwidth:
+        rounds = [[measurement] for measurement in measurements if measurement['kind'] == 'bandwidth']
+        measurements = [measurement for measurement in measurements if measurement['kind'] != 'bandwidth']
+
+    by_pair = {}
+    for measurement in measurements:
+        by_pair.setdefault(frozenset((measurement['source'], measurement['target'])), []).append(measurement)
+    vm_names = list(dict.fromkeys(vm_name for measurement in measurements for vm_name in (measurement['source'], measurement['target'])))
+    for pairs in round_robin_pairs(vm_names):
+        pair_measurements = [by_pair.get(frozenset(pair), []) for pair in pairs]
+        for index in range(max([0] + [len(items) for items in pair_measurements])):
+            rounds.append([items[index] for items in pair_measurements if index < len(items)])
+    return rounds
+
+def matrix_labels(topology, vm_names):
+    """
+    Get the row and column labels of the result matrices.
+
+    A mesh of one VM per zone of a single region is labelled by zone, as the
+    zones are what is compared. Any other mesh is labelled by VM name.
+
+    Args:
+        topology (dict): The topology, with the location and zone of each VM.
+        vm_names (list): The list of virtual machine names.
+
+    Returns:
+        list: The label of each VM.
+    """
+    zones = [topology[vm_name].get('zone') for vm_name in vm_names]
+    locations = {topology[vm_name].get('location') for vm_name in vm_names}
+    if len(locations) == 1 and all(zones) and len(set(zones)) == len(zones):
+        return [f"zone {zone}" for zone in zones]
+    return list(vm_names)
+
+def format_matrix(title, labels, matrix):
+    """
+    Format an N x N result matrix as a table, source VMs as rows and target VMs as columns.
+
+    Args:
+        title (str): The title of the table.
+        labels (list): The label of each VM.
+        matrix (list): The N x N results, matrix[i][j] from VM i to VM j.
+
+    Returns:
+        list: The lines of the table.
+    """
+    cell_width = max([12] + [len(label) for label in labels] + [len(str(value)) for row in matrix for value in row])
+    label_width = max(len(label) for label in labels)
+    header = " " * (label_width + 3) + "|" + "".join(f"{label:^{cell_width + 2}}|" for label in labels)
+    lines = [
+        f"{title}:",
+        " " * (label_width + 3) + "-" * (len(header) - label_width - 3),
+        header,
+        "-" * len(header),
+    ]
+    for i, label in enumerate(labels):
+        row = f"| {label:<{label_width}} |"
+        for j, value in enumerate(matrix[i]):
+            row += " " * (cell_width + 2) + "|" if i == j else f" {value:>{cell_width}} |"
+        lines.append(row)
+    lines.append("-" * len(header))
+    return lines
+
+def run_latency_bandwidth_tests(topology, vm_names, admin_username, admin_password, skip_bandwidth_test, skip_latency_test, skip_setup=False, serialize_bandwidth=False):
     """
     Run latency and bandwidth tests between virtual machines.
 
+    The tests run in rounds of concurrent tests, see schedule_measurements.
+
     Args:
-        network_client (NetworkManagementClient): The network management client.
-        resource_group_name (str): The name of the resource group.
+        topology (dict): The VM addresses returned by resolve_topology.
         vm_names (list): The list of virtual machine names.
         admin_username (str): The admin username for the virtual machines.
         admin_password (str): The admin password for the virtual machines.
         skip_bandwidth_test (bool): Whether to skip the bandwidth tests.
         skip_latency_test (bool): Whether to skip the latency tests.
         skip_setup (bool): Whether to skip the setup process.
+        serialize_bandwidth (bool): Whether to run the bandwidth tests one at a time.
     """
     clients = {}
+    public_ips = []
     for vm_name in vm_names:
-        ip_address = get_public_ip_address(network_client, resource_group_name, vm_name)
+        ip_address = topology[vm_name]['public_ip']
         logging.info(f"Public IP address for {vm_name}: {ip_address}")
         if ip_address:
             clients[vm_name] = create_ssh_client(ip_address, admin_username, admin_password, skip_setup)
+            public_ips.append(ip_address)
         else:
             logging.error(f"Failed to get public IP address for VM: {vm_name}")
             continue
 
+    # The setup starts iperf3 and sockperf in the background, wait until they listen
+    measurement_ports = tuple(port for port, skipped in ((5201, skip_bandwidth_test), (11111, skip_latency_test)) if not skipped)
+    if measurement_ports:
+        wait_for_vms_to_be_ready(public_ips, ports=measurement_ports, timeout=600)
+
     latency_public = [["" for _ in range(len(vm_names))] for _ in range(len(vm_names))]
     bandwidth_public = [["" for _ in range(len(vm_names))] for _ in range(len(vm_names))]
     latency_private = [["" for _ in range(len(vm_names))] for _ in range(len(vm_names))]
     bandwidth_private = [["" for _ in range(len(vm_names))] for _ in range(len(vm_names))]
 
-    for i, vm_name in enumerate(vm_names):
-        for j, target_vm_name in enumerate(vm_names):
-            if i != j:
-                client = clients[vm_name]
-
-                if not skip_bandwidth_test:
-                    # Bandwidth Test using iperf3 (Public IP)
-                    target_ip = get_public_ip_address(network_client, resource_group_name, target_vm_name)
-                    bandwidth_public[i][j] = run_bandwidth_test(client, vm_name, target_vm_name, target_ip, is_public=True)
-
-                    # Bandwidth Test using iperf3 (Private IP)
-                    target_ip = get_private_ip_address(network_client, resource_group_name, target_vm_name)
-                    bandwidth_private[i][j] = run_bandwidth_test(client, vm_name, target_vm_name, target_ip, is_public=False)
-
-                if not skip_latency_test:
-                    # Latency Test using sockperf (Public IP)
-                    target_ip = get_public_ip_address(network_client, resource_group_name, target_vm_name)
-                    latency_public[i][j] = run_latency_test(client, vm_name, target_vm_name, target_ip, is_public=True)
-
-                    # Latency Test using sockperf (Private IP)
-                    target_ip = get_private_ip_address(network_client, resource_group_name, target_vm_name)
-                    latency_private[i][j] = run_latency_test(client, vm_name, target_vm_name, target_ip, is_public=False)
-
-    # Show Tenant ID, Subscription ID, and Location
-    logging.info("Latency (Public IP):")
-    logging.info("         ----------------------------------------------")
-    logging.info("         |    zone 1    |    zone 2    |    zone 3    |")
-    logging.info("-------------------------------------------------------")
-    for i in range(len(vm_names)):
-        row = f"| zone {i+1} |"
-        for j in range(len(vm_names)):
-            if i == j:
-                row += "              |"
-            else:
-                row += f" {latency_public[i][j]:>12} |"
-        logging.info(row)
-    logging.info("-------------------------------------------------------")
-
-    logging.info("Latency (Private IP):")
-    logging.info("         ----------------------------------------------")
-    logging.info("         |    zone 1    |    zone 2    |    zone 3    |")
-    logging.info("-------------------------------------------------------")
-    for i in range(len(vm_names)):
-        row = f"| zone {i+1} |"
-        for j in range(len(vm_names)):
-            if i == j:
-                row += "              |"
-            else:
-                row += f" {latency_private[i][j]:>12} |"
-        logging.info(row)
-    logging.info("-------------------------------------------------------")
-
+    # Bandwidth tests use iperf3, latency tests sockperf, each via the public and the private IP
+    matrices = {
+        ('bandwidth', True): bandwidth_public,
+        ('bandwidth', False): bandwidth_private,
+        ('latency', True): latency_public,
+        ('latency', False): latency_private,
+    }
+    kinds = [kind for kind, skipped in (('bandwidth', skip_bandwidth_test), ('latency', skip_latency_test)) if not skipped]
+    measurements = [
+        {'source': vm_name, 'target': target_vm_name, 'kind': kind, 'is_public': is_public}
+        for vm_name in vm_names for target_vm_name in vm_names if vm_name != target_vm_name
+        for kind in kinds for is_public in (True, False)
+    ]
+
+    def measure(measurement):
+        run_test = run_bandwidth_test if measurement['kind'] == 'bandwidth' else run_latency_test
+        target_ip = topology[measurement['target']]['public_ip' if measurement['is_public'] else 'private_ip']
+        result = run_test(clients[measurement['source']], measurement['source'], measurement['target'], target_ip, is_public=measurement['is_public'])
+        i, j = vm_names.index(measurement['source']), vm_names.index(measurement['target'])
+        matrices[(measurement['kind'], measurement['is_public'])][i][j] = result
+
+    rounds = schedule_measurements(measurements, serialize_bandwidth)
+    logging.info(f"{len(measurements)} measurements in {len(rounds)} rounds, no VM takes part in two measurements at once")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max([1] + [len(measurement_round) for measurement_round in rounds])) as executor:
+        for number, measurement_round in enumerate(rounds, start=1):
+            round_started = time.monotonic()
+            list(executor.map(measure, measurement_round))
+            logging.info(f"Round {number}/{len(rounds)}: {len(measurement_round)} measurement(s) in {time.monotonic() - round_started:.1f}s")
+    logging.info(f"All measurements done in {time.monotonic() - started:.1f}s")
+
+    labels = matrix_labels(topology, vm_names)
+    if labels == list(vm_names):
+        for vm_name in vm_names:
+            vm = topology[vm_name]
+            logging.info(f"{vm_name}: {vm.get('location') or '-'}, zone {vm.get('zone') or '-'}, {vm.get('vm_type') or '-'}")
+    for title, matrix in (("Latency (Public IP)", latency_public), ("Latency (Private IP)", latency_private)):
+        for line in format_matrix(title, labels, matrix):
+            logging.info(line)
     logging.info("")
-    logging.info("Bandwidth (Public IP):")
-    logging.info("         ----------------------------------------------")
-    logging.info("         |    zone 1    |    zone 2    |    zone 3    |")
-    logging.info("-------------------------------------------------------")
-    for i in range(len(vm_names)):
-        row = f"| zone {i+1} |"
-        for j in range(len(vm_names)):
-            if i == j:
-                row += "              |"
-            else:
-                row += f" {bandwidth_public[i][j]:>12} |"
-        logging.info(row)
-    logging.info("-------------------------------------------------------")
-
-    logging.info("Bandwidth (Private IP):")
-    logging.info("         ----------------------------------------------")
-    logging.info("         |    zone 1    |    zone 2    |    zone 3    |")
-    logging.info("-------------------------------------------------------")
-    for i in range(len(vm_names)):
-        row = f"| zone {i+1} |"
-        for j in range(len(vm_names)):
-            if i == j:
-                row += "              |"
-            else:
-                row += f" {bandwidth_private[i][j]:>12} |"
-        logging.info(row)
-    logging.info("-------------------------------------------------------")
+    for title, matrix in (("Bandwidth (Public IP)", bandwidth_public), ("Bandwidth (Private IP)", bandwidth_private)):
+        for line in format_matrix(title, labels, matrix):
+            logging.info(line)
 
 def delete_resource_group(resource_client, resource_group_name):
     """
@@ -492,41 +971,74 @@ def delete_resource_group(resource_client, resource_group_name):
     delete_operation = resource_client.resource_groups.begin_delete(resource_group_name)
     logging.info(f"Resource group {resource_group_name} deletion initiated, No need to wait for the deletion to complete")
 
-def wait_for_vms_to_be_ready(vm_ips, timeout=240):
+def probe_tcp_port(ip, port, deadline, connect_timeout=3, initial_backoff=0.5, max_backoff=5):
     """
-    Wait for virtual machines to be reachable.
+    Try to open a TCP connection to ip:port until it succeeds or the deadline passes.
+
+    Failed attempts are retried after an exponential backoff with full jitter, so
+    the endpoints of several VMs are not probed in lockstep.
 
     Args:
-        vm_ips (list): The list of virtual machine IP addresses.
-        timeout (int): The timeout period in seconds.
+        ip (str): The IP address to probe.
+        port (int): The TCP port to probe.
+        deadline (float): The time.monotonic() after which to give up.
+        connect_timeout (float): The timeout of one connection attempt in seconds.
+        initial_backoff (float): The longest wait after the first failed attempt in seconds.
+        max_backoff (float): The longest wait between two attempts in seconds.
+
+    Returns:
+        float: The seconds until the port accepted a connection, or None on timeout.
+    """
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            with socket.create_connection((ip, port), timeout=min(connect_timeout, remaining)):
+                return time.monotonic() - started
+        except OSError as e:
+            logging.debug(f"{ip}:{port} not reachable yet: {e}")
+        backoff = random.uniform(0, min(max_backoff, initial_backoff * 2 ** attempt))
+        attempt += 1
+        time.sleep(max(0, min(backoff, deadline - time.monotonic())))
+
+def wait_for_vms_to_be_ready(vm_ips, ports=(22,), timeout=240):
     """
-    logging.info("Checking if VMs are reachable...")
-    start_time = time.time()
-    is_cloud_shell = os.getenv('ACC_CLOUD') is not None
+    Wait for virtual machines to accept TCP connections on the given ports.
 
-    while time.time() - start_time < timeout:
-        all_reachable = True
-        for ip in vm_ips:
-            if is_cloud_shell:
-                logging.info(f"Skipping ping check for {ip} in Azure Cloud Shell environment.")
-                continue
+    Every (IP, port) endpoint is probed concurrently with its own backoff, see
+    probe_tcp_port, and the wait ends as soon as all of them accept connections.
 
-            try:
-                result = subprocess.run(["ping", "-c", "1", "-W", "10", ip], capture_output=True, text=True)
-                logging.debug(result.stdout)
-                if result.returncode != 0:
-                    all_reachable = False
-                    break
-            except Exception as e:
-                logging.error(f"Error pinging {ip}: {e}")
-                all_reachable = False
-                break
+    Args:
+        vm_ips (list): The list of virtual machine IP addresses.
+        ports (tuple): The TCP ports that must be open on every VM.
+        timeout (int): The timeout period in seconds.
 
-        if all_reachable:
-            logging.info("All VMs are reachable.")
-            return
-        time.sleep(10)
-    logging.warning("Timeout reached. Some VMs may not be reachable.")
+    Returns:
+        list: The (IP, port) endpoints still not reachable when the timeout was reached.
+    """
+    endpoints = [(ip, port) for ip in vm_ips if ip for port in ports]
+    logging.info(f"Checking if VMs are reachable on TCP port(s) {', '.join(str(port) for port in ports)}...")
+    if not endpoints:
+        return []
+    deadline = time.monotonic() + timeout
+    unreachable = []
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        futures = {executor.submit(probe_tcp_port, ip, port, deadline): (ip, port) for ip, port in endpoints}
+        for future in as_completed(futures):
+            ip, port = futures[future]
+            elapsed = future.result()
+            if elapsed is None:
+                unreachable.append((ip, port))
+            else:
+                logging.info(f"{ip}:{port} accepts connections after {elapsed:.1f}s")
+    if unreachable:
+        logging.warning(f"Timeout reached. Not reachable: {', '.join(f'{ip}:{port}' for ip, port in unreachable)}")
+    else:
+        logging.info("All VMs are reachable.")
+    return unreachable
 
 def vm_exists(compute_client, resource_group_name, vm_name):
     """
@@ -549,20 +1061,20 @@ def vm_exists(compute_client, resource_group_name, vm_name):
         else:
             raise
 
-def show_vm_info(network_client, resource_group_name, vm_names, username, password):
+def show_vm_info(topology, vm_names, username, password):
     """
     Show information about virtual machines.
 
     Args:
-        network_client (NetworkManagementClient): The network management client.
-        resource_group_name (str): The name of the resource group.
+        topology (dict): The VM addresses returned by resolve_topology.
         vm_names (list): The list of virtual machine names.
         username (str): The admin username for the virtual machines.
         password (str): The admin password for the virtual machines.
     """
     for vm_name in vm_names:
-        ip_address = get_public_ip_address(network_client, resource_group_name, vm_name)
-        logging.info(f"VM Name: {vm_name}, IP: {ip_address}, Username: {username}, Password: {password}")
+        vm = topology[vm_name]
+        ip_address = vm['public_ip']
+        logging.info(f"VM Name: {vm_name}, Location: {vm.get('location') or '-'}, Zone: {vm.get('zone') or '-'}, IP: {ip_address}, Username: {username}, Password: {password}")
         logging.info(f"To login {vm_name} with one command: expect -c 'spawn ssh {username}@{ip_address}; expect \"password:\"; send \"{password}\\r\"; interact'")
 
 def get_tenant_id_by_name(credential, tenant_name):
@@ -643,11 +1155,37 @@ def main():
     parser.add_argument('--show-info', required=False, action='store_true', help='Show VM info (IP, username, password)')
     parser.add_argument('--skip-bandwidth-test', required=False, default=False, action='store_true', help='Skip bandwidth tests')
     parser.add_argument('--skip-latency-test', required=False, default=False, action='store_true', help='Skip latency tests')
+    parser.add_argument('--serialize-bandwidth', required=False, default=False, action='store_true', help='Run bandwidth tests one at a time, only latency tests run in parallel')
+    parser.add_argument('--config', required=False, help='JSON file listing the VMs of the test mesh (default: one VM in each of the 3 zones of --location)')
+    parser.add_argument('--refresh-topology', required=False, default=False, action='store_true', help='With --run/--show-info, resolve the VM addresses again instead of using the saved ones')
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
     args = parser.parse_args()
 
+    topology_path = topology_file(args.subscription, args.resource_group_name)
+    mesh = load_mesh_config(args.config, args.location, args.vm_type) if args.config else default_mesh(args.location, args.vm_type)
+    if not args.config and (args.run or args.show_info):
+        # Without --config, test the VMs the resource group was provisioned with
+        saved_topology = load_topology(topology_path)
+        if saved_topology is not None:
+            mesh['vms'] = [
+                {'name': vm_name, 'location': vm.get('location') or args.location, 'zone': vm.get('zone'), 'vm_type': vm.get('vm_type') or args.vm_type}
+                for vm_name, vm in saved_topology.items()
+            ]
+    vm_names = [vm['name'] for vm in mesh['vms']]
+
+    # Reruns against an existing resource group do not need Azure at all
+    if (args.run or args.show_info) and not args.force_delete and not args.refresh_topology:
+        topology = load_topology(topology_path, vm_names)
+        if topology is not None:
+            logging.info(f"Using the VM addresses saved in {topology_path} (--refresh-topology to resolve them again)")
+            if args.run:
+                run_latency_bandwidth_tests(topology, vm_names, args.admin_username, args.admin_password, args.skip_bandwidth_test, args.skip_latency_test, skip_setup=True, serialize_bandwidth=args.serialize_bandwidth)
+            else:
+                show_vm_info(topology, vm_names, args.admin_username, args.admin_password)
+            sys.exit(0)
+
     credential = DefaultAzureCredential()
 
     if args.tenant:
@@ -665,47 +1203,41 @@ def main():
     compute_client = ComputeManagementClient(credential, subscription_id)
     network_client = NetworkManagementClient(credential, subscription_id)
 
+    def resolve_and_save_topology():
+        topology = resolve_topology(network_client, args.resource_group_name, vm_names)
+        for vm in mesh['vms']:
+            topology[vm['name']].update(location=vm['location'], zone=vm['zone'], vm_type=vm['vm_type'])
+        save_topology(topology_path, topology)
+        return topology
+
     if args.force_delete:
         delete_resource_group(resource_client, args.resource_group_name)
+        if os.path.exists(topology_path):
+            os.remove(topology_path)
         sys.exit(0)
 
     if args.run:
-        vm_names = [f"azping-vm{zone}" for zone in range(1, 4)]
-        run_latency_bandwidth_tests(network_client, args.resource_group_name, vm_names, args.admin_username, args.admin_password, args.skip_bandwidth_test, args.skip_latency_test, skip_setup=True)
+        topology = resolve_and_save_topology()
+        run_latency_bandwidth_tests(topology, vm_names, args.admin_username, args.admin_password, args.skip_bandwidth_test, args.skip_latency_test, skip_setup=True, serialize_bandwidth=args.serialize_bandwidth)
         sys.exit(0)
 
     if args.show_info:
-        vm_names = [f"azping-vm{zone}" for zone in range(1, 4)]
-        show_vm_info(network_client, args.resource_group_name, vm_names, args.admin_username, args.admin_password)
+        topology = resolve_and_save_topology()
+        show_vm_info(topology, vm_names, args.admin_username, args.admin_password)
         sys.exit(0)
 
-    resource_group_exists = resource_client.resource_groups.check_existence(args.resource_group_name)
-    if not resource_group_exists:
-        create_resource_group(resource_client, args.resource_group_name, args.location)
-
     if not args.resource_group_name or not args.location:
         raise ValueError("Resource group name and location cannot be empty")
-    create_virtual_network(network_client, args.resource_group_name, 'azping-mgmt-vnet', 'default', args.network_cidr, args.location)
-    create_network_security_group(network_client, args.resource_group_name, 'azping-nsg', args.location)
-
-    vm_ips = []
-    for zone in range(1, 4):
-        vm_name = f"azping-vm{zone}"
-        if vm_exists(compute_client, args.resource_group_name, vm_name):
-            logging.info(f"VM {vm_name} already exists. Skipping creation.")
-            public_ip = get_public_ip_address(network_client, args.resource_group_name, vm_name)
-        else:
-            public_ip = create_vm_without_progress(compute_client, network_client, resource_client, args.resource_group_name, vm_name, args.location, args.vm_type, args.admin_username, args.admin_password, 'azping-nsg', 'azping-mgmt-vnet', 'default', str(zone), args.enable_accelerated_networking)
-        vm_ips.append(public_ip)
+    topology = provision_vms(compute_client, network_client, resource_client, args.resource_group_name, args.location, mesh['vms'], args.admin_username, args.admin_password, args.network_cidr, args.enable_accelerated_networking, mesh['network_cidrs'])
+    save_topology(topology_path, topology)
 
     logging.info("All VMs created. Checking network reachability...")
-    wait_for_vms_to_be_ready(vm_ips)
+    wait_for_vms_to_be_ready([topology[vm_name]['public_ip'] for vm_name in vm_names])
 
-    vm_names = [f"azping-vm{zone}" for zone in range(1, 4)]
-    run_latency_bandwidth_tests(network_client, args.resource_group_name, vm_names, args.admin_username, args.admin_password, args.skip_bandwidth_test, args.skip_latency_test)
+    run_latency_bandwidth_tests(topology, vm_names, args.admin_username, args.admin_password, args.skip_bandwidth_test, args.skip_latency_test, serialize_bandwidth=args.serialize_bandwidth)
     logging.info(f"Tenant ID: {tenant_id}")
     logging.info(f"Subscription ID: {subscription_id}")
-    logging.info(f"Location: {args.location}")
+    logging.info(f"Location: {', '.join(dict.fromkeys(vm['location'] for vm in mesh['vms']))}")
 
 
 if __name__ == "__main__":